@@ -10,6 +10,7 @@ from numpy import column_stack, zeros
 from numpy.random import rand as rand_array
 from numpy.linalg import inv, eigh, qr
 import numpy as np
+import scipy.sparse
 
 from functools import partial
 from tools import DefaultPool
@@ -22,10 +23,11 @@ from sys import stdout
 # Params:
     # data_matrix - a Numpy matrix that contains the data - the columns of this
         # matrix are individual observations, and the rows are variables (i.e. dimensions)
+        # It can also be a scipy.sparse matrix, in which case only the non-missing data is stored
     # perc_missing_allowed - a value between 0 and 1 that tells what fraction of
         # missing data is allowed in a given dimension.
 # Returns:
-    # a smaller matrix
+    # a smaller (dense) matrix
 def remove_bad_dimensions(data_matrix, perc_missing_allowed=.01):
     
     n_vars, n_obs = data_matrix.shape
@@ -34,9 +36,17 @@ def remove_bad_dimensions(data_matrix, perc_missing_allowed=.01):
     # Compute the percentage of missing data in each dimension
     # We want to exclude observations where ALL dimensions are missing
     # while computing this percentage
-    num_all_missing = ((data_matrix==0).sum(axis=0)==n_vars).sum(axis=1) 
-    print("Num observations where ALL data is  missing: %d " % num_all_missing)
-    num_missing = ((data_matrix==0).sum(axis=1) - num_all_missing)
+    if(scipy.sparse.issparse(data_matrix)):
+        # Count the stored non-zero values, without expanding the matrix
+        data_matrix = data_matrix.tocsr()
+        data_matrix.eliminate_zeros()
+        num_all_missing = (data_matrix.getnnz(axis=0)==0).sum()
+        print("Num observations where ALL data is  missing: %d " % num_all_missing)
+        num_missing = (n_obs - data_matrix.getnnz(axis=1)) - num_all_missing
+    else:
+        num_all_missing = ((data_matrix==0).sum(axis=0)==n_vars).sum(axis=1) 
+        print("Num observations where ALL data is  missing: %d " % num_all_missing)
+        num_missing = ((data_matrix==0).sum(axis=1) - num_all_missing)
     perc_missing = num_missing.astype(float) / (n_obs - num_all_missing)
     
     
@@ -45,6 +55,8 @@ def remove_bad_dimensions(data_matrix, perc_missing_allowed=.01):
     
     # Return the matrix that has rows corresponding to good dimensions
     smaller_data_matrix = data_matrix[good_dims,:]
+    if(scipy.sparse.issparse(smaller_data_matrix)):
+        smaller_data_matrix = matrix(smaller_data_matrix.toarray())
     n_vars, n_obs = smaller_data_matrix.shape
     print("Full data matrix after cutting: %d x %d" % (n_vars, n_obs))
     stdout.flush()
@@ -55,7 +67,7 @@ def remove_bad_dimensions(data_matrix, perc_missing_allowed=.01):
 # the SAME dimensions from all of them.
 # Params:
     # vectors_grouped - a dictionary which maps some group->id to a list of Numpy
-        # column vectors
+        # column vectors (or scipy.sparse column vectors, see measureOutliers.readSparsePaceData())
     # perc_missing_allowed - a value between 0 and 1 that tells what fraction of
         # missing data is allowed in a given dimension.
 # Returns:
@@ -65,7 +77,10 @@ def remove_bad_dimensions_grouped(vectors_grouped, trip_names, perc_missing_allo
     # First, concatenate all pace vectors into one big data matrix (in a reasonable order)
     sorted_keys = sorted(vectors_grouped)
     all_vects = [vect for key in sorted_keys for vect in vectors_grouped[key]]
-    big_matrix = column_stack(all_vects)
+    if(scipy.sparse.issparse(all_vects[0])):
+        big_matrix = scipy.sparse.hstack(all_vects)
+    else:
+        big_matrix = column_stack(all_vects)
     
     # Now, remove dimensions that have missing data from the big matrix
     new_big_matrix, good_dims = remove_bad_dimensions(big_matrix, perc_missing_allowed)
@@ -89,6 +104,46 @@ def remove_bad_dimensions_grouped(vectors_grouped, trip_names, perc_missing_allo
         new_trip_names = ['missing' for j in range(len(good_dims)) if good_dims[j]]
     
     return new_vectors_grouped, new_trip_names
+
+
+
+# Like remove_bad_dimensions_grouped(), but for one matrix whose observations are grouped by
+# index arrays (see feature_store.group_by_weekday_hour()).  This avoids splitting the data into
+# vectors and stacking them again.
+# Params:
+    # data_matrix - a Numpy array whose ROWS are observations and whose columns are variables (see
+        # feature_store.load_feature_matrix()).  It can also be a scipy.sparse matrix
+    # trip_names - the names of the variables (or None)
+    # perc_missing_allowed - a value between 0 and 1 that tells what fraction of
+        # missing data is allowed in a given dimension.
+# Returns:
+    # new_data_matrix - a (dense) Numpy matrix whose COLUMNS are the (smaller) observations, in
+        # the same order as the rows of data_matrix, so the same index arrays select each group
+    # new_trip_names - the names of the remaining variables
+def remove_bad_dimensions_indexed(data_matrix, trip_names, perc_missing_allowed=.01):
+    # remove_bad_dimensions() expects the observations to be columns (this is a view, not a copy)
+    if(not scipy.sparse.issparse(data_matrix)):
+        data_matrix = np.asmatrix(data_matrix)
+    smaller_data_matrix, good_dims = remove_bad_dimensions(data_matrix.T, perc_missing_allowed)
+    
+    if(trip_names!=None):
+        new_trip_names = [trip_names[j] for j in range(len(good_dims)) if good_dims[j]]
+    else:
+        new_trip_names = ['missing' for j in range(len(good_dims)) if good_dims[j]]
+    
+    return np.asmatrix(smaller_data_matrix), new_trip_names
+
+
+# Gives the data matrix of a group of vectors
+# Params:
+    # vectors - a list of Numpy column vectors, or a matrix whose columns are the vectors
+        # (see remove_bad_dimensions_indexed()), which is used as it is
+# Returns:
+    # a matrix whose columns are the vectors
+def stack_vectors(vectors):
+    if(isinstance(vectors, np.ndarray) and vectors.ndim==2):
+        return vectors
+    return column_stack(vectors)
         
     
     
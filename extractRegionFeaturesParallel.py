@@ -11,6 +11,7 @@ Created on Sat May  3 12:33:42 2014
 import csv
 import os
 import shutil
+from fractions import gcd
 from multiprocessing import Pool
 from routing.Map import Map
 import traceback
@@ -18,137 +19,189 @@ import traceback
 from grid import *
 from regions import *
 from trip import *
+from trip_reader import read_trip_chunks, trip_filename, plan_shards
+from feature_store import merge_binary_stores, export_csv, resolution_name
+from micro_cube import MicroCubeWriter
 
 
 #Global settings
 TMP_DIR = "working_space"            #A directory for intermediate results.  Will be deleted at the end
 FINAL_OUTPUT_DIR = "4year_features"    #A directory for final results
 NUM_PROCESSORS = 8                #Number of cores to employ for parallel processing
+SKETCH_DRIVERS = False            #Estimate unique drivers with mergeable sketches instead of exact sets (see sketches.py)
+EXPORT_CSV = True                 #Also write the final features as CSV files, in addition to the binary files
+SPARSE_OUTPUT = False             #Only store the region pairs which have trips in each hour (recommended for large k)
+SHARDS_PER_MONTH = 4              #Each month file is split into this many pieces, which are processed in parallel
+PREFETCH_DEPTH = 2                #Number of blocks of the trip file that are read ahead by a background thread (0 to disable)
+GRANULARITY = timedelta(hours=1)  #Length of each row of features, e.g. timedelta(minutes=15) (see GridSystem)
+ROLLUPS = []                      #Coarser resolutions which are also output, e.g. [timedelta(hours=1)] (see grid.Rollup)
+                                  #Shards begin at the boundaries of the longest rollup, so no rollup row is split (see shardAlignment())
+MICRO_CUBE_DIR = None             #If set, a micro-cube of every shard is also written here, so features of new partitions
+                                  #can be derived later without reading the trips (see micro_cube.py)
 
-#Processes a month of trip data and outputs one month of features (mean pace vectors, trip counts, etc...) to a tmp directory
+#The region partitions of a worker process.  They are set once per worker by initWorker(), rather than being sent
+#(and pickled) with every shard
+workerMaps = None
+workerCacheFiles = None
+
+#Initializes a worker process of the Pool (see extractFeaturesMultiple())
+#Arguments:
+    #road_maps - a list of Map objects, one for each region partition.  flatten() should have already been called
+    #cache_files - a list of precomputed region caches (see regions.buildRegionCache()), or None for each partition without one
+def initWorker(road_maps, cache_files):
+    global workerMaps, workerCacheFiles
+    for road_map in road_maps:
+        road_map.unflatten()
+    workerMaps = road_maps
+    workerCacheFiles = cache_files
+
+#Processes a shard of a month of trip data (or the whole month) and outputs its features (mean pace vectors, trip counts, etc...) to a tmp directory
+#The shard is read and parsed only once, but its features are computed for several region partitions at the same time
 #Many of these can be run in parallel
 #Arguments: Takes one tuple for ease of use with Pool.map().  The tuple contains:
     #year - an integer. the year containing the month of interest
     #month - an integer (1 through 12) the month to be processed
-    #slice_id - a unique identifier for this (year,  month) pair.  Used to name the tmp files
+    #slice_id - a unique identifier for this shard.  Used to name the tmp files
+    #start, end - the byte range of the month file to read (see trip_reader.plan_shards()).  end is None for the end of the file
+    #start_time, end_time - datetimes of the first and last rows (see GRANULARITY) of this shard, or None to start at the beginning of the month
+        #(or end at the last trip), respectively
+    #partition_ids - the indexes of the region partitions to compute features for (in workerMaps, see initWorker())
 
-#Returns: The name of the tmp directory created for this month
-def processMonth((year, month, slice_id, road_map)):
-    road_map.unflatten()
-    
+#Returns: A list with the name of the tmp directory created for each partition, in the same order as partition_ids
+def processShard((year, month, slice_id, start, end, start_time, end_time, partition_ids)):
     try:
-                                                                                            #The year and month give the input file
-        infile = "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"    
+        #The year and month give the input file
+        infile = trip_filename(year, month)
         
         #The slice_id gives us the output directory - make it
-        outdir = TMP_DIR + "/slice_" + str(slice_id)
-        shutil.rmtree(outdir, ignore_errors=True)
-        os.mkdir(outdir)
+        slice_dir = TMP_DIR + "/slice_" + str(slice_id)
+        shutil.rmtree(slice_dir, ignore_errors=True)
+        os.mkdir(slice_dir)
         
-        #Begin the RegionSystem for this output directory - this will start outputting files there
-        gridSystem = RegionSystem(outdir, road_map)
+        #Begin a RegionSystem for each partition - each one will output files to its own subdirectory
+        output_format = "sparse" if SPARSE_OUTPUT else "binary"
+        outdirs = []
+        gridSystems = []
+        for i in partition_ids:
+            outdir = slice_dir + "/partition_" + str(i)
+            os.mkdir(outdir)
+            outdirs.append(outdir)
+            gridSystems.append(RegionSystem(outdir, workerMaps[i], workerCacheFiles[i], SKETCH_DRIVERS, output_format=output_format,
+                                            start_time=start_time, end_time=end_time,
+                                            granularity=GRANULARITY, rollups=ROLLUPS))
         
-        logMsg('Parsing file ' + infile)
+        #The micro-cube of each shard is named after its slice_id, so the cubes can be read in chronological order
+        cube = None
+        if(MICRO_CUBE_DIR != None):
+            cube = MicroCubeWriter(MICRO_CUBE_DIR + "/slice_" + str(slice_id))
         
-        #Open the input file as a CSV
-        with open(infile, 'r') as filePointer:
-            csvReader = csv.reader(filePointer)
-            
-            #Read the header and discard
-            header = csvReader.next()
-            del header
+        #Trips outside of this time range are in the wrong month file
+        month_start = datetimeToEpoch(datetime(year, month, 1))
+        month_end = datetimeToEpoch(datetime(year + month/12, month%12 + 1, 1))
+        
+        logMsg('Parsing file ' + infile + ' bytes ' + str(start) + ' to ' + str(end))
+        
+        #Read the shard in large chunks of trips (lines with parse errors are skipped)
+        #A background thread reads the next blocks while this one is being processed
+        for chunk in read_trip_chunks(infile, start=start, end=end, prefetch_depth=PREFETCH_DEPTH):
+            #Ignore trips that are placed in the wrong month file
+            chunk.has_other_error = (chunk.pickup_time < month_start) | (chunk.pickup_time >= month_end)
             
-            #Read the rest of the file
-            for line in csvReader:
-    
-                try:
-                    trip = Trip(line) #Parse the csv line into a trip object
-                except ValueError:
-                    trip = None      #A trip of None indicates a parsing error
-                    
-                
-                #Ignore trips that are placed in the wrong month file
-                if(trip!= None and (year!=trip.pickup_time.year or month!=trip.pickup_time.month)):
-                    trip.has_other_error = True
-                
-                #Record the trip - if trip==None, an error will be recorded
-                gridSystem.record(trip)
+            #The chunk is parsed and validated once, then recorded by every partition
+            codes = chunk.isValid()
+            for gridSystem in gridSystems:
+                gridSystem.recordChunk(chunk, codes)
+            if(cube != None):
+                cube.record_chunk(chunk, codes)
         
         #Finalize the output
-        gridSystem.close()
+        for gridSystem in gridSystems:
+            gridSystem.close()
+        if(cube != None):
+            cube.close()
     
-        #Return the name of the temporary directory that was created for this month    
-        return outdir
+        #Return the names of the temporary directories that were created for this shard
+        return outdirs
     except Exception as e:
         traceback.print_exc()
         print()
         raise e
 
-#Takes all of the temporary output directories created by processMonth() and merges them into one
-#(Many folders, each with 6 files) --> (one folder with 6 large files)
+#Takes all of the temporary output directories created by processShard() and merges them into one
+#Each directory holds a block of binary features (see feature_store.py), which are concatenated in order
+#(Many folders, each with one file per feature type) --> (one folder with one large file per feature type)
 #Arguments:
-    #slice_dirs - a list of names of temporary directories.  These names are returned by processMonth()
+    #slice_dirs - a list of names of temporary directories, in chronological order.  These names are returned by processShard()
     #out_dir - the directory where final output will be placed
+#The features of each rollup (see ROLLUPS) are in a subdirectory, which is merged the same way
+#Raises: a ValueError if two shards overlap in time
 def mergeTempFiles(slice_dirs, out_dir):
     logMsg("Merging tmp files")
     shutil.rmtree(out_dir, ignore_errors=True)
     os.mkdir(out_dir)
     
-    #Files that we care about (one for each type of feature):
-    #count_features.csv    miles_features.csv  pace_var_features.csv
-    #drivers_features.csv  global_features.csv  pace_features.csv
-    feature_types = ["count", "miles", "pace_var", "drivers", "global", "pace"]
-    
-    #Create a file object for each feature type
-    out_file_pointers = {}
-    for ft in feature_types:
-        fname = out_dir + "/" + ft + "_features.csv"
-        out_file_pointers[ft] = open(fname, 'w')
+    resolutions = [("", int(GRANULARITY.total_seconds()))]
+    for resolution in ROLLUPS:
+        seconds = int(resolution.total_seconds())
+        resolutions.append((resolution_name(seconds), seconds))
     
-    
-    first_slice = True
-    
-    #Iterate through temporary folders
-    for slice_dir in slice_dirs:
-        #Iterate through the files (one for each feature type) in this folder
-        for ft in feature_types:
-            try:
-                #Open the temporary file as input
-                fname = slice_dir + "/" + ft + "_features.csv"
-                infile = open(fname, 'r')
-                
-                
-                #If this is the first file, the header should be copied to the output file
-                #Otherwise, it should be skipped
-                if(not first_slice):
-                    infile.next()
-
-                #Copy the rest of the lines to the correct output file
-                for line in infile:
-                    out_file_pointers[ft].write(line)
-            except:
-                #Ignore lines with errors
-                pass
-
-        #First slice is complete - headers should not be copied anymore
-        first_slice = False
+    for (subdir, seconds) in resolutions:
+        merged_dir = os.path.join(out_dir, subdir)
+        if(not os.path.exists(merged_dir)):
+            os.mkdir(merged_dir)
+        merge_binary_stores([os.path.join(d, subdir) for d in slice_dirs], merged_dir, seconds)
+        
+        #The CSV files are still used by the rest of the pipeline (e.g. measureOutliers.py)
+        if(EXPORT_CSV):
+            logMsg("Exporting " + merged_dir + " to CSV")
+            export_csv(merged_dir, step_seconds=seconds)
             
 
 
-#An iterator function - produces tuples which serve as inputs to the processMonth() function
+#Gives the length of time that every shard must begin on a multiple of, in seconds.  A rollup row which
+#spans two shards would be written by both of them, and the partial rows could not be merged
+#Returns:
+    #the least common multiple of an hour and the lengths of all ROLLUPS, e.g. 86400 for daily rollups
+def shardAlignment():
+    alignment = 3600
+    for resolution in ROLLUPS:
+        seconds = int(resolution.total_seconds())
+        alignment = alignment * seconds // gcd(alignment, seconds)
+    return alignment
+
+
+#An iterator function - produces tuples which serve as inputs to the processShard() function
 #(This is convenient for parallel processing)
-#Each tuple represents a month to be processed (year and month), as well as a unique slice_id
+#Each month is split into SHARDS_PER_MONTH shards at hour boundaries (or the boundaries of the longest rollup - see
+#shardAlignment()), so more than 48 processes can be used, and large months don't hold up the rest.
+#Each tuple represents one shard, with a unique slice_id
 # Parameters:
-    # road_map - a Map object.  flatten() should have already been called
-def sliceIterator(road_map):
+    # partition_ids - the indexes of the region partitions (see processShard())
+def sliceIterator(partition_ids):
     slice_id = 0
     #Iterate through all years/months
     for year in [2010, 2011, 2012, 2013]:
         for month in range(1, 13):
-            #This tuple represents the arguments to processMonth()
-            yield (year, month, slice_id, road_map)
-            #Increment slice_id
-            slice_id += 1
+            month_start = datetimeToEpoch(datetime(year, month, 1))
+            month_end = datetimeToEpoch(datetime(year + month/12, month%12 + 1, 1))
+            shards = plan_shards(trip_filename(year, month), SHARDS_PER_MONTH, month_start, month_end,
+                                 align_seconds=shardAlignment())
+            for i in range(len(shards)):
+                (start, end, start_hour) = shards[i]
+                
+                #The first shard starts at the beginning of the month.  The others start at their first hour,
+                #and every shard but the last one ends right before the next shard begins
+                start_time = None
+                if(start_hour is not None):
+                    start_time = epochToDatetime(start_hour)
+                end_time = None
+                if(i + 1 < len(shards)):
+                    end_time = epochToDatetime(shards[i + 1][2]) - GRANULARITY
+                
+                #This tuple represents the arguments to processShard()
+                yield (year, month, slice_id, start, end, start_time, end_time, partition_ids)
+                #Increment slice_id
+                slice_id += 1
     
 
 
@@ -156,27 +209,51 @@ def sliceIterator(road_map):
 #########################################################################################################
 ################################### MAIN CODE BEGINS HERE ###############################################
 #########################################################################################################
-def extractFeatures(road_map, output_dir, pool):
+def extractFeatures(road_map, output_dir):
+    extractFeaturesMultiple([road_map], [output_dir])
+
+
+#Computes features for several region partitions with a single pass over the trip data
+#Every trip is read and parsed once, then assigned to a region pair in every partition
+#Arguments:
+    #road_maps - a list of Map objects, one for each partition (e.g. different values of k)
+    #output_dirs - a list of output directories, in the same order as road_maps
+    #cache_files - an optional list of region cache files (see regions.buildRegionCache()), in the same order as road_maps
+        #Every worker memory-maps these read-only, instead of building its own cache
+def extractFeaturesMultiple(road_maps, output_dirs, cache_files=None):
+    if(cache_files is None):
+        cache_files = [None]*len(road_maps)
+    
     #Setup temporary directory to store intermediate results for each month
     logMsg("Creating working directory for temp files...")
     shutil.rmtree(TMP_DIR, ignore_errors=True)
     os.mkdir(TMP_DIR)
+    if(MICRO_CUBE_DIR != None):
+        shutil.rmtree(MICRO_CUBE_DIR, ignore_errors=True)
+        os.mkdir(MICRO_CUBE_DIR)
+    
+    # Flatten road_maps so they can be serialized and sent to other processes
+    logMsg("Flattening maps")
+    for road_map in road_maps:
+        road_map.flatten()
     
-    # Flatten road_map so it can be serialized and sent to other processes
-    logMsg("Flattening map")
-    road_map.flatten()    
+    #The maps are given to each worker once, when the pool starts, so the shards only carry the partition indexes
+    pool = Pool(NUM_PROCESSORS, initializer=initWorker, initargs=(road_maps, cache_files))
     
-    #Run the main code on each month in parallel (to the extent possible on this machine)
-    #Each month will get a subdirectory inside the temporary directory
+    #Run the main code on each shard in parallel (to the extent possible on this machine)
+    #Each shard will get a subdirectory inside the temporary directory, with one folder for each partition
     logMsg("Processing months in parallel (" + str(NUM_PROCESSORS) + " cores)")
     
-    slice_dirs = pool.map(processMonth, sliceIterator(road_map)) #Map the main function onto each month (slice) in parallel
+    slice_dirs = pool.map(processShard, sliceIterator(range(len(road_maps)))) #Map the main function onto each shard (slice) in parallel
+    pool.close()
+    pool.join()
     #slice_dirs contains all of the intermediate subdirectories.  These will be merged in the next step
     
     
-    #Merge intermediate results into large files in one final output folder
+    #Merge intermediate results into large files - one final output folder for each partition
     logMsg("Merging output files")
-    mergeTempFiles(slice_dirs, output_dir)
+    for i in range(len(road_maps)):
+        mergeTempFiles([partition_dirs[i] for partition_dirs in slice_dirs], output_dirs[i])
     
     logMsg("Cleaning up")
     shutil.rmtree(TMP_DIR, ignore_errors=True)    
@@ -190,18 +267,24 @@ def extractFeatures(road_map, output_dir, pool):
 
 
 if(__name__=="__main__"):
-    pool = Pool(NUM_PROCESSORS) #Initialize the pool
     imb_vals = [20]
     k_vals = [1,2,3,4,5,6,7,8,9,10,15,20,25,30,35,40,45,50]
+    
+    #Load all of the partitions, so the trip data only needs to be read once
+    road_maps = []
+    output_dirs = []
+    cache_files = []
     for imb in imb_vals:        
         for k in k_vals:
             
             print ("imb=%d, k=%d" % (imb,k))
-            print("Saving")
             nodes_fn = 'nyc_map4/nodes_no_nj_imb%d_k%d.csv' % (imb, k)
             links_fn = 'nyc_map4/links_no_nj_imb%d_k%d.csv' % (imb, k)
-            output_dir = 'features_imb%d_k%d' % (imb, k)
+            output_dirs.append('features_imb%d_k%d' % (imb, k))
             road_map = Map(nodes_fn, links_fn, limit_bbox=Map.reasonable_nyc_bbox)
+            road_maps.append(road_map)
             
-            extractFeatures(road_map, output_dir, pool)
+            #The region cache is computed once (or loaded from a previous run) and shared by all workers
+            cache_files.append(buildRegionCache(road_map, nodes_fn))
     
+    extractFeaturesMultiple(road_maps, output_dirs, cache_files)
@@ -5,9 +5,11 @@ Created on Thu Jul  3 12:52:31 2014
 @author: brian
 """
 import csv
+import numpy as np
 from collections import defaultdict
 from grid import *
 from regions import *
+from trip_reader import read_trip_chunks, trip_filename
 from multiprocessing import Pool
 
 
@@ -44,6 +46,26 @@ class Histogram:
 		#Increment that bin
 		self.counts[rounded] += 1
 	
+	#Record many values at once - equivalent to calling record() on each of them
+	#Arguments:
+		#values - a Numpy array of feature values
+	def recordArray(self, values):
+		#Values which can't be rounded are skipped, just as record() would raise an error
+		if(values.dtype.kind == 'f'):
+			values = values[np.isfinite(values)]
+		
+		#Use rounding to determine the appropriate bins (integer division for integers, like record())
+		if(values.dtype.kind == 'i' and isinstance(self.granularity, int)):
+			rounded = (values // self.granularity) * self.granularity
+		else:
+			rounded = np.trunc(values / self.granularity) * self.granularity
+		rounded = np.clip(rounded, self.lower_bound, self.upper_bound)
+		
+		#Increment each bin by the number of values that fell into it
+		bins, counts = np.unique(rounded, return_counts=True)
+		for (val, count) in zip(bins.tolist(), counts.tolist()):
+			self.counts[val] += count
+	
 	#Saves the histogram into a CSV file - first column contains values, second column contains frequencies
 	#Arguments:
 		#filename - the name of the file to output
@@ -82,52 +104,42 @@ def computeMonth((year, month)):
 	hist_pace = Histogram('pace', 5, lower_bound=0, upper_bound = 10*3600)
 	
 	#The name of the trip file that will be read
-	filename = "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
+	filename = trip_filename(year, month)
 	
 	logMsg("Reading file " + filename)
-	r = csv.reader(open(filename, "r"))
 	
-	#Read the first line from the input file and use it to initialize the header
-	Trip.initHeader(r.next())
+	#The file is parsed in large chunks of trips (see trip_reader.py), and each histogram is updated with whole arrays
 	i = 0
-	for line in r:
-		try:
-			#Parse the line into a trip
-			trip = Trip(line)
-			
-			#Record longitudes for both the start and end of the trip
-			hist_lon.record(trip.fromLon)
-			hist_lon.record(trip.toLon)
-
-			#Record latitudes for both the start and end of the trip
-			hist_lat.record(trip.fromLat)
-			hist_lat.record(trip.toLat)
-			
-			#Record the stragihtline distance
-			hist_straightline.record(trip.straight_line_dist)
-			
-			#Record the trip time (and rounded trip time)
-			hist_time.record(trip.time)
-			hist_minutes.record(trip.time)
-			
-			#Record the trip distance (and rounded trip distance)
-			hist_dist.record(trip.dist)
-			hist_miles.record(trip.dist)
-			
-			#Record the winding factor
-			hist_winding.record(trip.winding_factor)
-			
-			#Record the pace if it is defined
-			if(trip.dist > 0):
-				hist_pace.record(float(trip.time) / trip.dist)
-				
-		except ValueError:
-			#Parse error - move on
-			pass
+	for chunk in read_trip_chunks(filename):
+		#Record longitudes for both the start and end of the trip
+		hist_lon.recordArray(chunk.fromLon)
+		hist_lon.recordArray(chunk.toLon)
+
+		#Record latitudes for both the start and end of the trip
+		hist_lat.recordArray(chunk.fromLat)
+		hist_lat.recordArray(chunk.toLat)
+		
+		#Record the stragihtline distance
+		hist_straightline.recordArray(chunk.straight_line_dist)
+		
+		#Record the trip time (and rounded trip time)
+		hist_time.recordArray(chunk.time)
+		hist_minutes.recordArray(chunk.time)
+		
+		#Record the trip distance (and rounded trip distance)
+		hist_dist.recordArray(chunk.dist)
+		hist_miles.recordArray(chunk.dist)
+		
+		#Record the winding factor
+		hist_winding.recordArray(chunk.winding_factor)
+		
+		#Record the pace if it is defined
+		hist_pace.recordArray(chunk.pace[chunk.dist > 0])
 
 		#Intermediate output
-		i += 1
-		if(i%1000000==0):
+		prev_i = i
+		i += len(chunk)
+		if(i/1000000 > prev_i/1000000):
 			logMsg(filename + " read " + str(i) + " rows")
 
 
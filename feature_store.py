@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+"""
+Feature sinks, which store the hourly features computed by a GridSystem.
+The CSV sink writes the original text files (pace_features.csv, etc...).  The binary sink
+appends each hour's arrays to one raw float64 file per feature type, with a companion time
+index, which can be memory-mapped by readers and exported to CSV later if necessary.  The
+sparse sink only stores the pairs of regions which have trips in each hour (a CSR matrix over time).
+"""
+import csv
+import hashlib
+import os
+import shutil
+import numpy as np
+import scipy.sparse
+
+from tools import *
+from trip import Trip
+
+
+# The feature types with one value for each pair of regions, in the order they are written
+PAIR_FEATURE_TYPES = ["pace", "pace_var", "count", "miles", "drivers"]
+
+# Pair features which use 0 as a placeholder for pairs with a bad sample size
+PLACEHOLDER_FEATURE_TYPES = ["pace", "pace_var"]
+
+# Every feature file begins with these time columns
+TIME_COLUMNS = ["Date", "Hour", "Weekday"]
+SUB_HOUR_COLUMN = "Time"    # Added after the other time columns if the rows are shorter than an hour, e.g. "13:45"
+weekdayname = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
+
+# The columns of the global features (across all regions)
+GLOBAL_COLUMNS = ["Count", "Pace", "Miles", "Drivers", "AvgWind", "SdWind"] + Trip.ERROR_NAMES
+
+# Global columns which hold integers (everything else is a float)
+GLOBAL_INT_COLUMNS = [GLOBAL_COLUMNS.index("Drivers")] + range(6, len(GLOBAL_COLUMNS))
+
+# Files of the binary store
+TIME_INDEX_FILE = "time_index.i8"       # int64 start time of each hour, in seconds since tools.EPOCH
+PAIR_COLUMNS_FILE = "pair_columns.csv"  # The names of the region pairs, one per line
+SKETCH_FILE = "drivers_sketch.bin"      # Hourly driver sketches, if they were computed (see GridSystem)
+
+# Files of the sparse store (which also has a time index, pair columns, and binary global features)
+SPARSE_COUNTS_FILE = "sparse_counts.i8" # int64 number of stored pairs in each hour
+SPARSE_PAIRS_FILE = "sparse_pairs.i4"   # int32 index of each stored pair, in increasing order within each hour
+
+# Size of the write buffer for each file (rows are not flushed individually)
+WRITE_BUFFER_BYTES = 1024*1024
+
+
+
+# Gives the name of the binary file for a feature type, e.g. "pace_features.f8"
+def binary_filename(dir_name, feature_type):
+    return os.path.join(dir_name, feature_type + "_features.f8")
+
+
+# Gives the name of the sparse file for a feature type, e.g. "pace_sparse.f8"
+def sparse_filename(dir_name, feature_type):
+    return os.path.join(dir_name, feature_type + "_sparse.f8")
+
+
+# Tells whether a directory holds a sparse store (see SparseFeatureSink)
+def is_sparse_store(dir_name):
+    return os.path.exists(os.path.join(dir_name, SPARSE_COUNTS_FILE))
+
+
+# Opens a sink for features
+# Params:
+    # output_format - "csv", "binary", or "sparse"
+    # dir_name, pair_names, sub_hour - see CsvFeatureSink
+def open_sink(output_format, dir_name, pair_names, sub_hour=False):
+    if(output_format=="binary"):
+        return BinaryFeatureSink(dir_name, pair_names)
+    if(output_format=="sparse"):
+        return SparseFeatureSink(dir_name, pair_names)
+    return CsvFeatureSink(dir_name, pair_names, sub_hour)
+
+
+# Gives the name of a time resolution, which is used to name the directory of its features
+# e.g. 900 --> "15min", 3600 --> "1h", 86400 --> "1d"
+# Params:
+    # seconds - the length of a row of features
+def resolution_name(seconds):
+    if(seconds % 86400 == 0):
+        return "%dd" % (seconds // 86400)
+    if(seconds % 3600 == 0):
+        return "%dh" % (seconds // 3600)
+    return "%dmin" % (seconds // 60)
+
+
+# Gives the Date, Hour, and Weekday columns for an hour
+# Params:
+    # hour - a datetime at the beginning of the hour (or a shorter time bin)
+    # sub_hour - if True, the Time column is also given (see SUB_HOUR_COLUMN)
+def time_columns(hour, sub_hour=False):
+    columns = [str(hour.date()), hour.hour, weekdayname[hour.weekday()]]
+    if(sub_hour):
+        columns.append(hour.strftime("%H:%M"))
+    return columns
+
+
+
+# Writes features as CSV files, with one row per hour (the original output format)
+class CsvFeatureSink:
+    # Opens a file for each type of feature, and writes the headers
+    # Params:
+        # dir_name - the directory where the files are written
+        # pair_names - the names of the region pairs, in the same order as the pair features
+        # sub_hour - if True, the rows are shorter than an hour, and a Time column is written (see SUB_HOUR_COLUMN)
+    def __init__(self, dir_name, pair_names, sub_hour=False):
+        self.sub_hour = sub_hour
+        time_header = TIME_COLUMNS + [SUB_HOUR_COLUMN]*sub_hour
+        self.files = {}
+        self.writers = {}
+        for ft in PAIR_FEATURE_TYPES + ["global"]:
+            self.files[ft] = open(os.path.join(dir_name, ft + "_features.csv"), "w", WRITE_BUFFER_BYTES)
+            self.writers[ft] = csv.writer(self.files[ft])
+
+        for ft in PAIR_FEATURE_TYPES:
+            self.writers[ft].writerow(time_header + list(pair_names))
+        self.writers["global"].writerow(time_header + GLOBAL_COLUMNS)
+
+    # Writes the features of one hour
+    # Params:
+        # hour - a datetime at the beginning of the hour
+        # features - a dictionary which maps each of PAIR_FEATURE_TYPES to an array of features
+        # global_row - a list of global features, in the order of GLOBAL_COLUMNS
+    def write(self, hour, features, global_row):
+        prefix = time_columns(hour, self.sub_hour)
+        for ft in PAIR_FEATURE_TYPES:
+            values = features[ft]
+            if(ft in PLACEHOLDER_FEATURE_TYPES):
+                # Placeholders are written as the integer 0
+                values = values.astype(object)
+                values[values==0] = 0
+            self.writers[ft].writerow(prefix + values.tolist())
+        self.writers["global"].writerow(prefix + list(global_row))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+
+# Writes features as raw float64 binary files, one row per hour, which can be
+# memory-mapped with read_features().  The hours are listed in the time index
+class BinaryFeatureSink:
+    # Params:
+        # dir_name - the directory where the files are written
+        # pair_names - the names of the region pairs, in the same order as the pair features
+        # sub_hour - ignored.  The length of the rows is known from the time index
+    def __init__(self, dir_name, pair_names, sub_hour=False):
+        with open(os.path.join(dir_name, PAIR_COLUMNS_FILE), "w") as f:
+            for name in pair_names:
+                f.write(name + "\n")
+
+        self.files = {}
+        for ft in PAIR_FEATURE_TYPES + ["global"]:
+            self.files[ft] = open(binary_filename(dir_name, ft), "wb", WRITE_BUFFER_BYTES)
+        self.time_file = open(os.path.join(dir_name, TIME_INDEX_FILE), "wb")
+
+    # Writes the features of one hour - see CsvFeatureSink.write()
+    def write(self, hour, features, global_row):
+        for ft in PAIR_FEATURE_TYPES:
+            np.asarray(features[ft], dtype="<f8").tofile(self.files[ft])
+        np.array(global_row, dtype="<f8").tofile(self.files["global"])
+        np.array([datetimeToEpoch(hour)], dtype="<i8").tofile(self.time_file)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.time_file.close()
+
+
+
+# Writes only the pairs of regions which have trips in each hour, since most pairs don't have any (especially
+# with many regions).  Every pair feature is 0 for the pairs which are not stored.  The global features are dense,
+# just like a BinaryFeatureSink.  The stores can be read with read_sparse_features()
+class SparseFeatureSink:
+    # Params:
+        # dir_name - the directory where the files are written
+        # pair_names - the names of the region pairs, in the same order as the pair features
+    def __init__(self, dir_name, pair_names):
+        with open(os.path.join(dir_name, PAIR_COLUMNS_FILE), "w") as f:
+            for name in pair_names:
+                f.write(name + "\n")
+
+        self.files = {}
+        for ft in PAIR_FEATURE_TYPES:
+            self.files[ft] = open(sparse_filename(dir_name, ft), "wb", WRITE_BUFFER_BYTES)
+        self.files["global"] = open(binary_filename(dir_name, "global"), "wb", WRITE_BUFFER_BYTES)
+        self.files["counts"] = open(os.path.join(dir_name, SPARSE_COUNTS_FILE), "wb")
+        self.files["pairs"] = open(os.path.join(dir_name, SPARSE_PAIRS_FILE), "wb", WRITE_BUFFER_BYTES)
+        self.time_file = open(os.path.join(dir_name, TIME_INDEX_FILE), "wb")
+
+    # Writes the features of one hour - see CsvFeatureSink.write()
+    def write(self, hour, features, global_row):
+        observed = np.flatnonzero(features["count"])
+        np.array([len(observed)], dtype="<i8").tofile(self.files["counts"])
+        observed.astype("<i4").tofile(self.files["pairs"])
+        for ft in PAIR_FEATURE_TYPES:
+            np.asarray(features[ft], dtype="<f8")[observed].tofile(self.files[ft])
+        np.array(global_row, dtype="<f8").tofile(self.files["global"])
+        np.array([datetimeToEpoch(hour)], dtype="<i8").tofile(self.time_file)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.time_file.close()
+
+
+
+# Reads one type of pair feature from a sparse feature store
+# Params:
+    # dir_name - the directory of the store
+    # feature_type - one of PAIR_FEATURE_TYPES
+# Returns:
+    # a scipy.sparse.csr_matrix, with one row for each hour (see read_time_index()) and one column for each
+    # pair (see read_pair_names()).  Pairs without trips are not stored - they are 0
+def read_sparse_features(dir_name, feature_type):
+    counts = np.fromfile(os.path.join(dir_name, SPARSE_COUNTS_FILE), dtype="<i8")
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    pairs = np.fromfile(os.path.join(dir_name, SPARSE_PAIRS_FILE), dtype="<i4")
+    values = np.fromfile(sparse_filename(dir_name, feature_type), dtype="<f8")
+    return scipy.sparse.csr_matrix((values, pairs, indptr), shape=(len(counts), len(read_pair_names(dir_name))))
+
+
+
+# Reads the time index of a binary feature store
+# Returns:
+    # an int64 array with the start time of each hour (row), in seconds since tools.EPOCH
+def read_time_index(dir_name):
+    return np.fromfile(os.path.join(dir_name, TIME_INDEX_FILE), dtype="<i8")
+
+
+# Reads the names of the region pairs of a binary feature store
+def read_pair_names(dir_name):
+    with open(os.path.join(dir_name, PAIR_COLUMNS_FILE), "r") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+# Memory-maps one type of feature from a binary feature store
+# Params:
+    # dir_name - the directory of the store
+    # feature_type - one of PAIR_FEATURE_TYPES, or "global"
+# Returns:
+    # a read-only float64 array, with one row for each hour (see read_time_index())
+    # and one column for each pair (see read_pair_names()) or each of GLOBAL_COLUMNS
+def read_features(dir_name, feature_type):
+    if(feature_type=="global"):
+        num_columns = len(GLOBAL_COLUMNS)
+    else:
+        num_columns = len(read_pair_names(dir_name))
+
+    filename = binary_filename(dir_name, feature_type)
+    if(os.path.getsize(filename)==0):
+        return np.zeros((0, num_columns))
+    return np.memmap(filename, dtype="<f8", mode="r").reshape((-1, num_columns))
+
+
+# Gives the names of the binary cache of a CSV feature file in a cache directory (see load_feature_matrix())
+# e.g. pace_features.csv --> <hash>_pace_features.csv.f8 (the values) and <hash>_pace_features.csv.i8 (the time index)
+# The hash of the CSV file's full path keeps the caches of different feature directories apart
+def csv_cache_filenames(csv_filename, cache_dir):
+    path_hash = hashlib.md5(os.path.abspath(csv_filename)).hexdigest()[:16]
+    base = os.path.join(cache_dir, path_hash + "_" + os.path.basename(csv_filename))
+    return (base + ".f8", base + ".i8")
+
+
+# Parses a CSV feature file (see CsvFeatureSink) in bulk, rather than one value at a time
+# Params:
+    # csv_filename - the name of the file, e.g. 4year_features/pace_features.csv
+# Returns: (values, times, column_names).  Breakdown:
+    # values - a float64 array, with one row for each line of the file and one column for each feature
+    # times - an int64 array with the start time of each row, in seconds since tools.EPOCH
+    # column_names - the names of the feature columns (e.g. the region pairs)
+def parse_feature_csv(csv_filename):
+    with open(csv_filename, "r") as f:
+        header = csv.reader([f.readline()]).next()
+        num_time_columns = len(TIME_COLUMNS) + (SUB_HOUR_COLUMN in header)
+
+        time_strs = []
+        value_strs = []
+        for line in f:
+            fields = line.rstrip("\r\n").split(",", num_time_columns)
+            if(num_time_columns > len(TIME_COLUMNS)):
+                time_strs.append(fields[0] + " " + fields[3] + ":00")
+            else:
+                time_strs.append("%s %02d:00:00" % (fields[0], int(fields[1])))
+            value_strs.append(fields[-1])
+
+    column_names = header[num_time_columns:]
+    values = np.fromstring(",".join(value_strs), dtype=float, sep=",") if len(value_strs) > 0 else np.zeros(0)
+    return (values.reshape((len(time_strs), len(column_names))), parseUtcArray(time_strs), column_names)
+
+
+# Loads one type of feature as a single (hours x columns) array, whatever kind of store it was written to
+# Binary stores are memory-mapped.  CSV files are parsed in bulk, and if a cache directory is given, a binary
+# cache is written there (see csv_cache_filenames()), which is memory-mapped instead as long as it is newer than the CSV file
+# Params:
+    # dir_name - the directory of the features.  Nothing is ever written to it
+    # feature_type - one of PAIR_FEATURE_TYPES, or "global"
+    # cache_dir - an optional directory for binary caches of CSV files.  By default, CSV files are always parsed.
+        # If the cache can't be written, the parsed values are still returned
+# Returns: (values, times, column_names).  Breakdown:
+    # values - a float64 array with one row for each hour and one column for each pair (or global feature).
+        # For the pair features of a sparse store, it is a scipy.sparse.csr_matrix instead (see read_sparse_features())
+    # times - an int64 array with the start time of each hour, in seconds since tools.EPOCH
+    # column_names - the names of the pairs (or GLOBAL_COLUMNS), in the same order as the columns
+def load_feature_matrix(dir_name, feature_type, cache_dir=None):
+    if(feature_type != "global" and is_sparse_store(dir_name)):
+        return (read_sparse_features(dir_name, feature_type), read_time_index(dir_name), read_pair_names(dir_name))
+    if(os.path.exists(binary_filename(dir_name, feature_type))):
+        column_names = GLOBAL_COLUMNS if feature_type=="global" else read_pair_names(dir_name)
+        return (read_features(dir_name, feature_type), read_time_index(dir_name), column_names)
+
+    csv_filename = os.path.join(dir_name, feature_type + "_features.csv")
+    if(cache_dir is not None):
+        (values_fn, times_fn) = csv_cache_filenames(csv_filename, cache_dir)
+    if(cache_dir is not None and os.path.exists(values_fn) and os.path.exists(times_fn)
+            and os.path.getmtime(values_fn) >= os.path.getmtime(csv_filename)):
+        with open(csv_filename, "r") as f:
+            header = csv.reader([f.readline()]).next()
+        pair_names = header[len(TIME_COLUMNS) + (SUB_HOUR_COLUMN in header):]
+        times = np.fromfile(times_fn, dtype="<i8")
+        if(os.path.getsize(values_fn) == len(times) * len(pair_names) * 8):
+            if(len(times)==0):
+                return (np.zeros((0, len(pair_names))), times, pair_names)
+            return (np.memmap(values_fn, dtype="<f8", mode="r").reshape((len(times), len(pair_names))), times, pair_names)
+
+    logMsg("Parsing " + csv_filename)
+    (values, times, pair_names) = parse_feature_csv(csv_filename)
+    if(cache_dir is not None):
+        try:
+            if(not os.path.isdir(cache_dir)):
+                os.makedirs(cache_dir)
+            # Write to temporary files first, so a partial cache is never used
+            values.astype("<f8").tofile(values_fn + ".tmp")
+            times.astype("<i8").tofile(times_fn + ".tmp")
+            os.rename(times_fn + ".tmp", times_fn)
+            os.rename(values_fn + ".tmp", values_fn)
+        except (IOError, OSError) as e:
+            logMsg("WARNING: could not write the cache of %s (%s)" % (csv_filename, e))
+            for fn in [values_fn + ".tmp", times_fn + ".tmp"]:
+                if(os.path.exists(fn)):
+                    os.remove(fn)
+    return (values, times, pair_names)
+
+
+# Groups the hours of a time index by weekday and hour of the day, e.g. all of the Wednesdays at 5am
+# Params:
+    # times - an int64 array of hours, in seconds since tools.EPOCH (see read_time_index())
+# Returns:
+    # a dictionary which maps (weekday, hour) (e.g. ("Wednesday", 5)) to an int array of the positions of its
+    # hours in times, in order.  These can be used to index the rows of load_feature_matrix()
+def group_by_weekday_hour(times):
+    days = times // 86400
+    weekdays = (days + EPOCH.weekday()) % 7
+    hours = (times // 3600) % 24
+    group_ids = weekdays * 24 + hours
+
+    # A stable sort keeps the hours of each group in chronological order
+    order = np.argsort(group_ids, kind="mergesort")
+    bounds = np.searchsorted(group_ids[order], np.arange(7*24 + 1))
+    groups = {}
+    for g in xrange(7*24):
+        if(bounds[g+1] > bounds[g]):
+            groups[(weekdayname[g // 24], g % 24)] = order[bounds[g]:bounds[g+1]]
+    return groups
+
+
+# Converts a binary (or sparse) feature store into the CSV files that a CsvFeatureSink would have written
+# Params:
+    # dir_name - the directory of the binary or sparse store
+    # out_dir - the directory where the CSV files are written.  By default, dir_name
+    # step_seconds - the length of a row of features.  Rows shorter than an hour get a Time column
+def export_csv(dir_name, out_dir=None, step_seconds=3600):
+    if(out_dir is None):
+        out_dir = dir_name
+
+    times = read_time_index(dir_name)
+    sparse = is_sparse_store(dir_name)
+    if(sparse):
+        features = dict([(ft, read_sparse_features(dir_name, ft)) for ft in PAIR_FEATURE_TYPES])
+    else:
+        features = dict([(ft, read_features(dir_name, ft)) for ft in PAIR_FEATURE_TYPES])
+    global_features = read_features(dir_name, "global")
+
+    sink = CsvFeatureSink(out_dir, read_pair_names(dir_name), step_seconds < 3600)
+    for i in xrange(len(times)):
+        if(sparse):
+            hour_features = dict([(ft, features[ft][i].toarray().ravel()) for ft in PAIR_FEATURE_TYPES])
+        else:
+            hour_features = dict([(ft, features[ft][i]) for ft in PAIR_FEATURE_TYPES])
+        hour_features["drivers"] = hour_features["drivers"].astype(int)
+
+        global_row = global_features[i].tolist()
+        for c in GLOBAL_INT_COLUMNS:
+            global_row[c] = int(global_row[c])
+        # Like the pair features, global features which could not be computed (no trips) are the integer 0
+        if(global_row[GLOBAL_COLUMNS.index("Miles")]==0):
+            global_row[GLOBAL_COLUMNS.index("Pace")] = 0
+        if(global_row[GLOBAL_COLUMNS.index("Count")]==0):
+            global_row[GLOBAL_COLUMNS.index("AvgWind")] = 0
+            global_row[GLOBAL_COLUMNS.index("SdWind")] = 0
+
+        sink.write(epochToDatetime(times[i]), hour_features, global_row)
+    sink.close()
+
+
+# Concatenates several binary (or sparse) feature stores (e.g. one for each month) into one, in the given order
+# The stores must not overlap in time.  A gap between two stores is allowed, but logged
+# Params:
+    # in_dirs - the directories of the stores, in chronological order
+    # out_dir - the directory of the merged store.  It should already exist
+    # step_seconds - the length of a row of features (one hour by default).  Used to detect gaps
+# Raises:
+    # a ValueError if the stores overlap, or if they have different region pairs
+def merge_binary_stores(in_dirs, out_dir, step_seconds=3600):
+    pair_names = None
+    last_time = None
+    blocks = []
+    for in_dir in in_dirs:
+        if(pair_names is None):
+            pair_names = read_pair_names(in_dir)
+        elif(read_pair_names(in_dir) != pair_names):
+            raise ValueError("Region pairs of %s do not match %s" % (in_dir, in_dirs[0]))
+
+        times = read_time_index(in_dir)
+        if(len(times)==0):
+            continue
+
+        # Each block must be sorted and must begin after the previous block ends
+        if(np.any(np.diff(times) <= 0)):
+            raise ValueError("Time index of %s is not in increasing order" % in_dir)
+        if(last_time is not None):
+            if(times[0] <= last_time):
+                raise ValueError("%s overlaps the previous block (%s <= %s)" % (
+                    in_dir, epochToDatetime(times[0]), epochToDatetime(last_time)))
+            if(times[0] != last_time + step_seconds):
+                logMsg("WARNING: gap in features between %s and %s" % (
+                    epochToDatetime(last_time), epochToDatetime(times[0])))
+        last_time = times[-1]
+        blocks.append(in_dir)
+
+    sparse = len(in_dirs) > 0 and is_sparse_store(in_dirs[0])
+    sink = open_sink("sparse" if sparse else "binary", out_dir, pair_names or [])
+    sink.close()
+
+    # Rows are stored back to back, so the files of each block can simply be appended
+    # (a sparse store has the number of pairs in each row, rather than offsets, so this works for them too)
+    if(sparse):
+        filenames = [TIME_INDEX_FILE, binary_filename("", "global"), SPARSE_COUNTS_FILE, SPARSE_PAIRS_FILE]
+        filenames += [sparse_filename("", ft) for ft in PAIR_FEATURE_TYPES]
+    else:
+        filenames = [TIME_INDEX_FILE] + [binary_filename("", ft) for ft in PAIR_FEATURE_TYPES + ["global"]]
+    if(len(blocks) > 0 and all([os.path.exists(os.path.join(d, SKETCH_FILE)) for d in blocks])):
+        filenames.append(SKETCH_FILE)
+
+    for filename in filenames:
+        with open(os.path.join(out_dir, filename), "wb") as out_file:
+            for in_dir in blocks:
+                with open(os.path.join(in_dir, filename), "rb") as in_file:
+                    shutil.copyfileobj(in_file, out_file, WRITE_BUFFER_BYTES)
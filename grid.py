@@ -9,12 +9,15 @@ Created on Sat May  3 12:33:42 2014
 """
 
 from datetime import date, datetime, timedelta
-from sets import Set
 import csv
 import os
+import numpy as np
 
 from tools import *
 from trip import *
+from trip_reader import IdCodebook, trips_to_chunk
+from sketches import HyperLogLog
+from feature_store import open_sink, SKETCH_FILE, resolution_name
 
 weekdayname = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
 
@@ -38,75 +41,305 @@ class Cell:
 	def gridRange(self):
 		return "lon(" + str(self.lLon) + " --> " + str(self.rLon) + ")  lat(" + str(self.bLat) + " --> " + str(self.tLat) + ")"
 	
-#This class represents the unit of analysis - an origin destination pair at a point in time
-#Specifically, it is identified by a pair of Cells
-#We will, for example, be computing the average pace of trips between region A and region B at time T
-class Entry:
+#Holds the features of every origin-destination pair during one hour, as dense Numpy arrays
+#The unit of analysis is a pair of Cells (A, B) - e.g. we compute the average pace of trips from region A to region B
+#Every array has one element per pair, at index A*numCells + B (the same order as the columns of the output files)
+class HourAccumulator:
 	#Simple constructor
 	#Arguments:
-		#fromCell - the beginning region of trips
-		#toCell - the end region of trips
-	def __init__(self, fromCell, toCell):
-		#Store the cells
-		self.fromCell = fromCell
-		self.toCell = toCell
-
-		#Initialize all features to zero - they will be incremented when trips are matched to this entry
-		self.numtrips = 0.0			#Sum(1)
-		self.s_time = 0.0			#Sum(t)
-		self.ss_time = 0.0			#Sum(t^2)
-		self.s_dist = 0.0			#Sum(d)
-		self.ss_dist = 0.0			#Sum(d^2)
-		self.ss_time_over_dist = 0.0	#Sum(t^2 / d)
-		
-		self.s_wind = 0
-		self.ss_wind = 0
-		
-		
-		self.drivers = Set()			#The set of unique drivers
-		
-		#self.trips = []
+		#numCells - the number of Cells (regions).  There are numCells**2 pairs of them
+		#sketchDrivers - if True, unique drivers are estimated with HyperLogLog sketches instead of being counted exactly
+	def __init__(self, numCells, sketchDrivers=False):
+		self.numCells = numCells
+		numPairs = numCells**2
+		
+		#Initialize all features to zero - they will be incremented when trips are matched to pairs
+		self.numtrips = np.zeros(numPairs)			#Sum(1)
+		self.s_time = np.zeros(numPairs)			#Sum(t)
+		self.ss_time = np.zeros(numPairs)			#Sum(t^2)
+		self.s_dist = np.zeros(numPairs)			#Sum(d)
+		self.ss_dist = np.zeros(numPairs)			#Sum(d^2)
+		self.ss_time_over_dist = np.zeros(numPairs)	#Sum(t^2 / d)
+		
+		self.s_wind = np.zeros(numPairs)
+		self.ss_wind = np.zeros(numPairs)
+		
+		#Unique drivers are found at the end of the hour - until then, every (pair, driver) key is kept
+		#Or, in sketch mode, a fixed-size sketch is kept for each pair (and one for all trips)
+		self.driver_keys = []
+		self.sketchDrivers = sketchDrivers
+		if(sketchDrivers):
+			self.pairSketches = HyperLogLog(numPairs, PAIR_SKETCH_PRECISION)
+			self.globalSketch = HyperLogLog(1, GLOBAL_SKETCH_PRECISION)
+		
+		self.error_counts = np.zeros(len(Trip.ERROR_NAMES), dtype=int)		#Counts various types of errors.  The indexes are founded in trip.py right above the definition of isValid()
+	
+	#Records many valid trips by updating the features of their pairs
+	#Arguments:
+		#pairs - an int array with the index of each trip's pair, i.e. fromCell*numCells + toCell
+		#time, dist, winding_factor, driver_id - arrays of the trips' features (see TripChunk)
+		#driver_hash - an array of driver hashes (see TripChunk).  Only needed in sketch mode
+	def record(self, pairs, time, dist, winding_factor, driver_id, driver_hash=None):
+		numPairs = len(self.numtrips)
+		
+		#Sums each weight over the trips of each pair
+		def pairSums(weights):
+			return np.bincount(pairs, weights=weights, minlength=numPairs)
+		
+		time = time.astype(float)
+		self.numtrips += np.bincount(pairs, minlength=numPairs)
+		self.s_time += pairSums(time)
+		self.ss_time += pairSums(time**2)
+		self.s_dist += pairSums(dist)
+		self.ss_dist += pairSums(dist**2)
+		self.ss_time_over_dist += pairSums(time**2 / dist)
+		
+		self.s_wind += pairSums(winding_factor)
+		self.ss_wind += pairSums(winding_factor**2)
+		
+		if(self.sketchDrivers):
+			self.pairSketches.add(pairs, driver_hash)
+			self.globalSketch.add(np.zeros(len(pairs), dtype=int), driver_hash)
+		else:
+			self.driver_keys.append(pairs.astype(np.int64) * DRIVER_KEY_SIZE + driver_id)
 		
-		self.error_counts = [0]*25		#A list which counts various types of errors.  The indexes are founded in trip.py right above the definition of isValid()
+		self.error_counts[Trip.VALID] += len(pairs)
 	
-	def __str__(self):
-		s = "<<ENTRY>>\n" + "time " + str(self.s_time) + "\n" + "dist " + str(self.s_dist) + "\n" + " num " + str(self.numtrips)
-		return s
+	#Records the error codes of many trips (valid trips are counted by record() instead)
+	#Arguments:
+		#codes - an array of error codes, see TripChunk.isValid()
+	def recordErrors(self, codes):
+		counts = countErrorCodes(codes)
+		counts[Trip.VALID] = 0
+		self.error_counts += counts
 	
-	#Records a trip into this entry by updating the features
+	#Adds the features of another HourAccumulator to this one, e.g. to roll several time bins up into an hour or a day
+	#All of the features are sums (or sets of drivers), so the result is exactly the same as recording all of the trips here
 	#Arguments:
-		#trip - the Trip to be recorded
-	def record(self, trip):
-		self.numtrips += 1
-		self.s_time += trip.time
-		self.ss_time += trip.time**2
-		self.s_dist += trip.dist
-		self.ss_dist += trip.dist**2
-		self.ss_time_over_dist += (trip.time**2 / trip.dist)
-		
-		self.drivers.add(trip.driver_id)
-		#self.trips.append(trip)
-		
-
+		#other - an HourAccumulator with the same number of Cells and the same sketchDrivers
+	def merge(self, other):
+		self.numtrips += other.numtrips
+		self.s_time += other.s_time
+		self.ss_time += other.ss_time
+		self.s_dist += other.s_dist
+		self.ss_dist += other.ss_dist
+		self.ss_time_over_dist += other.ss_time_over_dist
+		self.s_wind += other.s_wind
+		self.ss_wind += other.ss_wind
+		
+		if(self.sketchDrivers):
+			self.pairSketches.merge(other.pairSketches)
+			self.globalSketch.merge(other.globalSketch)
+		elif(len(other.driver_keys) > 0):
+			#Only the unique keys need to be kept
+			self.driver_keys = [np.unique(np.concatenate(self.driver_keys + other.driver_keys))]
+		
+		self.error_counts += other.error_counts
 	
-		self.s_wind += trip.winding_factor
-		self.ss_wind += trip.winding_factor**2
-		
-		self.error_counts[Trip.VALID] += 1
+	#Counts the unique drivers of each pair
+	#Returns: (pair_drivers, total_drivers)
+		#pair_drivers - an int array with the number of unique drivers for each pair
+		#total_drivers - the number of unique drivers over all pairs
+	def countDrivers(self):
+		if(self.sketchDrivers):
+			#Estimates are rounded, so the output looks the same as an exact count
+			pair_drivers = np.round(self.pairSketches.count()).astype(int)
+			total_drivers = int(round(self.globalSketch.count()[0]))
+			return (pair_drivers, total_drivers)
+		
+		if(len(self.driver_keys)==0):
+			return (np.zeros(len(self.numtrips), dtype=int), 0)
+		
+		keys = np.unique(np.concatenate(self.driver_keys))
+		pair_drivers = np.bincount(keys // DRIVER_KEY_SIZE, minlength=len(self.numtrips))
+		total_drivers = len(np.unique(keys % DRIVER_KEY_SIZE))
+		return (pair_drivers, total_drivers)
+
+#Driver codes are combined with pair indexes into one integer key: pair*DRIVER_KEY_SIZE + driver
+DRIVER_KEY_SIZE = 2**32
+
+#Sizes of the driver sketches - 2**precision bytes each, with about 1.04/sqrt(2**precision) relative error
+PAIR_SKETCH_PRECISION = 8		#About 6.5% error
+GLOBAL_SKETCH_PRECISION = 10		#About 3.3% error.  One of these is written to drivers_sketch.bin for every hour
 	
 #The time granularity of analysis - this timedelta object will be used a lot, so let's just generate it once...	
 HOUR_GRANULARITY = timedelta(hours = 1)
+HOUR_SECONDS = 3600
+DAY_SECONDS = 86400
+
+
+#Computes the output features from the sums in an HourAccumulator
+#Arguments:
+	#acc - an HourAccumulator
+#Returns: (features, globalRow)
+	#features - a dictionary which maps each pair feature type ("pace", "count", etc...) to an array with one value per pair
+	#globalRow - a list of global features (over all pairs), in the order of feature_store.GLOBAL_COLUMNS
+def computeFeatures(acc):
+	#Pace features, and pace variance features - one value for each pair of regions
+	#Pairs with a bad sample size get 0 as a placeholder
+	good = (acc.s_dist!=0) & (acc.numtrips >= MIN_SAMPLE_SIZE)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		#Distance-weighted average pace
+		pace = acc.s_time / acc.s_dist
+		#Distance-weighted pace unbiased sample variance
+		correction = acc.s_dist / (acc.s_dist**2 - acc.ss_dist)
+		v_pace = correction * (acc.ss_time_over_dist - (acc.s_time**2)/acc.s_dist)
+	
+	(pair_drivers, total_drivers) = acc.countDrivers()
+	
+	#Count, "total miles", and unique driver features - one value for each pair of regions
+	features = {"pace":np.where(good, pace, 0.0), "pace_var":np.where(good, v_pace, 0.0),
+			"count":acc.numtrips, "miles":acc.s_dist, "drivers":pair_drivers}
+	
+	#Global features - this contains the same features as above, except for all trips
+	numtrips = float(acc.numtrips.sum())
+	s_dist = float(acc.s_dist.sum())
+	if(s_dist==0):
+		pace = 0
+	else:
+		pace = float(acc.s_time.sum()) / s_dist
+	
+	#Compute winding vactor if possible
+	if(numtrips > 0):
+		avg_wind = float(acc.s_wind.sum()) / numtrips
+		variance = (float(acc.ss_wind.sum()) / numtrips) - (avg_wind)**2
+
+		sdev_wind = math.sqrt(variance)
+	else:
+		avg_wind = 0
+		sdev_wind = 0
+	
+	globalRow = [numtrips, pace, s_dist, total_drivers, avg_wind, sdev_wind] + acc.error_counts.tolist()
+	return (features, globalRow)
+
+
+#Gives the time bin (e.g. the hour) of every trip in a TripChunk
+#Trips with has_other_error don't advance time - GridSystem.record() puts them in whatever hour is current
+#So each of them takes the bin of the last trip before it (or -1 if there is no such trip in this chunk)
+#Arguments:
+	#chunk - a TripChunk
+	#binSeconds - the length of a time bin, in seconds
+#Returns:
+	#an int array with the start of each trip's bin, in seconds since tools.EPOCH, or -1
+def tripBins(chunk, binSeconds):
+	bins = (chunk.pickup_time // binSeconds) * binSeconds
+	last_ordered = np.where(chunk.has_other_error, -1, np.arange(len(chunk)))
+	last_ordered = np.maximum.accumulate(last_ordered)
+	return np.where(last_ordered >= 0, bins[np.maximum(last_ordered, 0)], -1)
+
+
+#Finds which interval of a regular grid line each value falls strictly inside of
+#The index is computed arithmetically, then corrected by one if floating point rounding put it in a neighbouring
+#interval, so the result is exactly the same as comparing the value against every pair of edges
+#Arguments:
+	#values - an array of coordinates (e.g. longitudes)
+	#edges - the n+1 edges of the n intervals, in increasing order and evenly spaced
+#Returns:
+	#an int array with the index of each value's interval, or -1 if it is out of bounds or exactly on an edge
+def edgeIndex(values, edges):
+	n = len(edges) - 1
+	with np.errstate(invalid='ignore'):
+		guess = np.floor((values - edges[0]) * (n / (edges[-1] - edges[0])))
+		idx = np.clip(np.nan_to_num(guess), 0, n - 1).astype(int)
+		idx -= (idx > 0) & (values <= edges[idx])
+		idx += (idx < n - 1) & (values >= edges[idx + 1])
+		inside = (values > edges[idx]) & (values < edges[idx + 1])
+	return np.where(inside, idx, -1)
+
+
+#Rolls the time bins of a GridSystem up into a coarser resolution (e.g. hours or days), and writes their features
+#Since the rolled-up features are computed from the merged sums, they are exactly the same as if the trips had been
+#processed at that resolution.  The features are written to a subdirectory of the GridSystem's directory, e.g. 4year_cells/1d
+class Rollup:
+	#Simple constructor
+	#Arguments:
+		#dirName - the directory of the GridSystem.  The features are written to a subdirectory named after the resolution
+		#pairNames - the names of the pairs of Cells, in the order of the pair features
+		#numCells - the number of Cells
+		#resolution - a timedelta, the length of each rolled-up row.  Must be a multiple of the GridSystem's granularity
+		#sketchDrivers, outputFormat - the same as the GridSystem's
+	def __init__(self, dirName, pairNames, numCells, resolution, sketchDrivers, outputFormat):
+		self.seconds = int(resolution.total_seconds())
+		self.numCells = numCells
+		self.sketchDrivers = sketchDrivers
+		self.dirName = os.path.join(dirName, resolution_name(self.seconds))
+		try:
+			os.mkdir(self.dirName)
+		except:
+			pass
+		
+		self.sink = open_sink(outputFormat, self.dirName, pairNames, self.seconds < HOUR_SECONDS)
+		if(sketchDrivers):
+			self.sketchFp = open(os.path.join(self.dirName, SKETCH_FILE), "wb")
+		
+		self.currentTime = None
+		self.accumulator = None
+	
+	#Adds a committed time bin to the current row.  If the bin belongs to a later row, the current row is written first
+	#Arguments:
+		#binTime - a datetime, the start of the bin.  Bins should be added in chronological order
+		#acc - the HourAccumulator of the bin
+	def add(self, binTime, acc):
+		seconds = datetimeToEpoch(binTime)
+		rowTime = epochToDatetime(seconds - seconds % self.seconds)
+		if(self.currentTime != None and rowTime != self.currentTime):
+			self.commit()
+		
+		if(self.accumulator==None):
+			self.currentTime = rowTime
+			self.accumulator = HourAccumulator(self.numCells, self.sketchDrivers)
+		self.accumulator.merge(acc)
+	
+	#Writes the features of the current row
+	def commit(self):
+		if(self.accumulator != None):
+			(features, globalRow) = computeFeatures(self.accumulator)
+			self.sink.write(self.currentTime, features, globalRow)
+			if(self.sketchDrivers):
+				self.accumulator.globalSketch.write(self.sketchFp)
+			self.accumulator = None
+	
+	#Writes the last row, and closes the files
+	def close(self):
+		self.commit()
+		self.sink.close()
+		if(self.sketchDrivers):
+			self.sketchFp.close()
 
 #This object is used to sequentially process trips in chronological order
-#It contains a number of Cells (or regions), as well as Entries (pairs of cells)
-#It has the ability to record a trip, which updates the relevant entry
-#It can also output the current entries, and reset the current entries so the next hour can be processed
+#It contains a number of Cells (or regions), and an HourAccumulator with the features of each pair of cells
+#It has the ability to record trips, which updates the features of the relevant pairs
+#It can also output the current features, and reset them so the next hour can be processed
 #This behavior is fully encapsulated - THE ONLY METHOD THAT NEES TO BE CALLED FROM OUTSIDE OF THE CLASS IS record().
 #All files will be written automatically
 class GridSystem:
 	currentTime = None #Stores the internal time state of this GridSystem	
 	#This is the hour that we are currently processing trips for - it is advanced when necessary
 	
+	driverCodebook = None #Encodes the driver ids of Trips given to record() - see trip_reader.IdCodebook
+	
+	sketchDrivers = False #If True, unique drivers are estimated with sketches - see HourAccumulator
+	
+	outputFormat = "csv" #Either "csv", "binary", or "sparse" (only pairs with trips are stored) - see feature_store.py
+	
+	#Optional first and last hours to output.  By default, the output begins at the start of the first trip's month
+	#and ends at the last trip's hour.  These are used when a month is split into shards (see trip_reader.plan_shards())
+	startTime = None
+	endTime = None
+	
+	#The number of hours that are kept open after the newest trip's hour, so trips which arrive out of order
+	#can still be recorded in the correct hour.  An hour is only committed once a trip more than reorderHours
+	#later has been seen.  With 0 (the default), trips must be given in chronological order
+	reorderHours = 0
+	lateTrips = 0 #The number of trips which arrived after their hour was committed (they are counted in the oldest open hour)
+
+	#The length of each row of features.  It can be shorter than an hour (e.g. 15 minutes), as long as it divides a day evenly
+	granularity = HOUR_GRANULARITY
+
+	#Coarser resolutions (timedeltas, e.g. one hour and one day) which are also output, by rolling up the rows of the
+	#base granularity (see Rollup).  This avoids processing the trips again for each resolution
+	rollups = []
+
 	#A simple way of initializing a grid system, by dividing the map into an NxM grid
 	#Arguments:
 		#lLon - the leftmost longitude of the grid
@@ -115,7 +348,15 @@ class GridSystem:
 		#bLat - the bottom latitude of the grid
 		#tLat - the top latitude of the grid
 		#nLat - the number of ways to split the grid vertically. The height of each cell will be (tLat - bLat)/nLat
-	def __init__(self, lLon, rLon, nLon, bLat, tLat, nLat):
+		#sketch_drivers - if True, unique drivers are estimated with bounded-memory sketches instead of being counted exactly
+		#output_format - "csv" to write the features as CSV files, "binary" to write raw binary files, or "sparse" to write
+			#only the pairs which have trips in each hour (see feature_store.py)
+		#start_time, end_time - optional datetimes of the first and last hours to output (see startTime and endTime)
+		#reorder_hours - the number of hours to keep open for trips that arrive out of order (see reorderHours)
+		#granularity - a timedelta, the length of each row of features (see granularity)
+		#rollups - a list of coarser timedeltas, whose features are also output (see rollups)
+	def __init__(self, lLon, rLon, nLon, bLat, tLat, nLat, sketch_drivers=False, output_format="csv", start_time=None, end_time=None, reorder_hours=0,
+				granularity=HOUR_GRANULARITY, rollups=[]):
 		#Determine width and height of cells
 		width = (rLon - lLon)/nLon
 		height = (tLat - bLat)/nLat
@@ -135,9 +376,20 @@ class GridSystem:
 				cell.tLat = bLat + (y+1)*height
 				#add to list of cells
 				self.cells.append(cell)
-		self.entries = {}
 		
+		#The edges of the columns and rows of cells, so getCell() can find a cell arithmetically
+		#The cell in column x and row y is self.cells[x*nLat + y]
+		self.lonEdges = np.array([lLon + x*width for x in range(nLon + 1)])
+		self.latEdges = np.array([bLat + y*height for y in range(nLat + 1)])
+
 		self.dirName="4year_cells"
+		self.sketchDrivers = sketch_drivers
+		self.outputFormat = output_format
+		self.startTime = start_time
+		self.endTime = end_time
+		self.reorderHours = reorder_hours
+		self.granularity = granularity
+		self.rollups = rollups
 		self.begin()
 	
 	#Initialize the GridSystem for outputting features.  Opens a file for each type of feature.
@@ -147,263 +399,246 @@ class GridSystem:
 			os.mkdir(self.dirName)
 		except:
 			pass
-		
-		#Open the files and give them each a CSV writer object
-		self.countFp = open(self.dirName + "/count_features.csv", "w")		#Trip counts from region A to region B
-		self.countF = csv.writer(self.countFp)
-		
-		self.paceFp = open(self.dirName + "/pace_features.csv", "w")		#Average pace of trips from A to B
-		self.paceF = csv.writer(self.paceFp)
-		
-		self.paceVarFp = open(self.dirName + "/pace_var_features.csv", "w")	#Variance of pace of trips from A to B
-		self.paceVarF = csv.writer(self.paceVarFp)
-		
-		self.milesFp = open(self.dirName + "/miles_features.csv", "w")		#Total miles driven in trips from A to B
-		self.milesF = csv.writer(self.milesFp)
-		
-		
-		self.driversFp = open(self.dirName + "/drivers_features.csv", "w")	#Unique number of drivers seen driving from A to B
-		self.driversF =  csv.writer(self.driversFp)
-		
-		self.globalFp = open(self.dirName + "/global_features.csv", "w")	#A special file to contain global features (across all regions)
-		self.globalF = csv.writer(self.globalFp)
-		
+
+		#Rows must line up with hours and days, so they can be rolled up
+		self.binSeconds = int(self.granularity.total_seconds())
+		if(self.binSeconds <= 0 or DAY_SECONDS % self.binSeconds != 0):
+			raise ValueError("The granularity must divide a day evenly: " + str(self.granularity))
+		for resolution in self.rollups:
+			seconds = int(resolution.total_seconds())
+			if(seconds % self.binSeconds != 0 or DAY_SECONDS % seconds != 0):
+				raise ValueError("Rollups must be multiples of the granularity which divide a day evenly: " + str(resolution))
+
+		#The features are written by a sink - either CSV files, binary files, or sparse binary files (see feature_store.py)
+		pairNames = []
+		for fromCell in self.cells:
+			for toCell in self.cells:
+				pairNames.append(str(fromCell) + "-" + str(toCell))
+		self.sink = open_sink(self.outputFormat, self.dirName, pairNames, self.binSeconds < HOUR_SECONDS)
+		self.rollupWriters = [Rollup(self.dirName, pairNames, len(self.cells), resolution, self.sketchDrivers, self.outputFormat)
+					for resolution in self.rollups]
+
 		self.errorFp = open(self.dirName + "/errors.csv", "w")			#A special file to contain error data
 		self.errorF = csv.writer(self.errorFp)
 		
+		#In sketch mode, the global driver sketch of every hour is saved, so distinct drivers can be counted
+		#over days, weeks, etc... later (see sketches.read_sketches() and sketches.rollup_counts())
+		if(self.sketchDrivers):
+			self.sketchFp = open(self.dirName + "/" + SKETCH_FILE, "wb")
 		
-		#Write a header to each file, which contains time information and the names of region pairs
-		for w in (self.countF, self.paceF, self.paceVarF, self.milesF, self.driversF):
-			header = ["Date", "Hour", "Weekday"]
-			for fromCell in self.cells:
-				for toCell in self.cells:
-					header.append(str(fromCell) + "-" + str(toCell))
-			w.writerow(header)
-		
-		#Flush files
-		for w in (self.countFp, self.paceFp, self.paceVarFp, self.milesFp, self.driversFp):
-			w.flush()
-		
-		#The global feature file gets a special header
-		self.globalF.writerow(["Date", "Hour", "Weekday", "Count", "Pace", "Miles", "Drivers", "AvgWind", "SdWind", 'VALID','BAD_GPS','ERR_GPS','BAD_LO_STRAIGHTLINE','BAD_HI_STRAIGHTLINE','ERR_LO_STRAIGHTLINE','ERR_HI_STRAIGHTLINE','BAD_LO_DIST','BAD_HI_DIST','ERR_LO_DIST','ERR_HI_DIST','BAD_LO_WIND','BAD_HI_WIND','ERR_LO_WIND','ERR_HI_WIND','BAD_LO_TIME','BAD_HI_TIME','ERR_LO_TIME','ERR_HI_TIME','BAD_LO_PACE','BAD_HI_PACE','ERR_LO_PACE','ERR_HI_PACE','ERR_DATE','ERR_OTHER'])
-		self.globalFp.flush()		
 		self.errorF.writerow(Trip.header_line + ["error_code"])		
 		self.errorFp.flush()
+		
+		#Accumulators of the hours after currentTime that are still open (see reorderHours), keyed by hour
+		self.openHours = {}
+		self.newestTime = None
+		
+		#If the first hour is known, start there (so errors before the first valid trip are also counted)
+		if(self.startTime != None):
+			self.currentTime = self.startTime
+			self.reset()
 	
 	#Finalizes results and closes all of the files being written by this GridSystem
 	#This method should be called at the very end
 	def close(self):
+		#Output the hours that are still open, and empty hours up to the last hour, if it is known
+		lastTimes = [t for t in [self.endTime] + self.openHours.keys() if t != None]
+		if(len(lastTimes) > 0 and self.currentTime != None and max(lastTimes) > self.currentTime):
+			self.advanceTo(max(lastTimes))
+		
 		#Commit the last entry if necessary
 		self.commitEntry()
 		
+		if(self.lateTrips > 0):
+			logMsg("WARNING: " + str(self.lateTrips) + " trips arrived too late for their hour, and were counted in a later hour")
+		
 		#Close all of the files
-		self.countFp.close()
-		self.paceFp.close()
-		self.paceVarFp.close()
-		self.milesFp.close()
-		self.driversFp.close()
-		self.globalFp.close()
+		self.sink.close()
+		for rollup in self.rollupWriters:
+			rollup.close()
 		self.errorFp.close()
+		if(self.sketchDrivers):
+			self.sketchFp.close()
 
 		
-	#Reset all entries to zero - should be called at the end of an hour before the next hour is processed
+	#Reset all features to zero - should be called at the end of an hour before the next hour is processed
+	#If trips of the new hour have already been recorded (see reorderHours), their features are kept
 	def reset(self):
-		#Create an Entry for every pair of regions
-		self.entries = {}
-		for fromCell in self.cells:
-			for toCell in self.cells:
-				#Create the entry and store it in the dictionary
-				entry = Entry(fromCell, toCell)
-				self.entries[(fromCell, toCell)] = entry
-				
-		#Create a special Entry for global features
-		self.globalEntry = Entry(None, None)
+		self.accumulator = self.openHours.pop(self.currentTime, None)
+		if(self.accumulator==None):
+			self.accumulator = HourAccumulator(len(self.cells), self.sketchDrivers)
+	
+	#Gets the HourAccumulator of an open hour
+	#Arguments:
+		#hour - a datetime, rounded to the granularity.  Hours before currentTime are no longer open, so the
+		#accumulator of currentTime is used instead (as it is for None)
+	def getAccumulator(self, hour):
+		if(hour==None or hour <= self.currentTime):
+			return self.accumulator
+		if(not hour in self.openHours):
+			self.openHours[hour] = HourAccumulator(len(self.cells), self.sketchDrivers)
+		return self.openHours[hour]
 
 		
 	
 	#Gets the Cell which contains some geographical point
 	#This method should be overridden if other types of regions are desired
 	def getCell(self, lon, lat):
-		
-		#Easy way to determine cell...
-		for cell in self.cells:
-			if(lon > cell.lLon and lon < cell.rLon and lat > cell.bLat and lat < cell.tLat):
-				return cell
+		i = self.getCellIds(np.array([lon], dtype=float), np.array([lat], dtype=float))[0]
 		#Return none if this point is out of bounds
-		
-		return None
-				
-	#Gets the Entry which corresponds to a given trip at a given time
-	def getEntry(self, lon1, lat1, lon2, lat2):
-		fromCell = self.getCell(lon1, lat1)
-		toCell = self.getCell(lon2, lat2)
-		#If either coordinate is invalid, return none
-		if(fromCell is None or toCell is None):
+		if(i < 0):
 			return None
-		else:
-			#Now that we know the cells, just combine them with the date and time
-			#Then look up in hte dictionary
-			return self.entries[(fromCell, toCell)]
-	
-	#Records a trip by finding the corresponding entry, and recording this trip within
-	#This updates the features in that entry (increase count of trips, total distance, etc...)
-	#TRIPS SHOULD ALWAYS BE GIVEN TO THIS METHOD IN CHRONOLOGICAL ORDER
+		return self.cells[i]
+
+	#Gets the indexes (in self.cells) of the Cells which contain many geographical points at once
+	#This method should be overridden along with getCell() if other types of regions are desired
+	#Arguments:
+		#lons - an array of longitudes
+		#lats - an array of latitudes
+	#Returns:
+		#An int array of indexes into self.cells, with -1 wherever the point is out of bounds
+	def getCellIds(self, lons, lats):
+		#Points must be strictly inside a cell, so points on the border between two cells are out of bounds
+		x = edgeIndex(lons, self.lonEdges)
+		y = edgeIndex(lats, self.latEdges)
+		return np.where((x >= 0) & (y >= 0), x * (len(self.latEdges) - 1) + y, -1)
+
+	#Records a trip by finding the corresponding pair of cells, and updating the features of that pair
+	#(increase count of trips, total distance, etc...)
+	#TRIPS SHOULD ALWAYS BE GIVEN TO THIS METHOD IN CHRONOLOGICAL ORDER, unless reorderHours is set
 	#When we get to the end of an hour, this method will also output the features for that hour
-	#And reset all of the entries so the next hour can be computed.
+	#And reset all of the features so the next hour can be computed.
 	#This process is hidden from the outside - just give it a set of trips in chronological order.
+	#Recording a whole TripChunk at once with recordChunk() is much faster.
 	#Arguments:
 		#trip - a Trip object.  This trip's pickup_time should be greater than the pickup_time of the last trip passed to this method.
 	def record(self, trip):
-		
-		#If the trip contains an error, call recordError() instead
-		if(trip==None or trip.has_other_error):
-			if(self.globalEntry != None):
-				self.recordError(trip)
+		#Trips that could not be parsed are ignored
+		if(trip==None):
 			return
-
-			
 		
+		#Driver ids need to be encoded as integers, consistently between trips
+		if(self.driverCodebook==None):
+			self.driverCodebook = IdCodebook()
+		
+		self.recordChunk(trips_to_chunk([trip], self.driverCodebook))
+	
+	#Advances the internal time state of the GridSystem to the hour of a new trip
+	#Every hour that is completed along the way is output and reset
+	#Arguments:
+		#trip_hour - a datetime, the pickup time of the new trip rounded to the granularity
+		#pickup_time - the exact pickup time of the trip (only used for error messages)
+	#Returns:
+		#True if the trip's hour has already been committed (the trip is too late), otherwise False
+	def advanceTime(self, trip_hour, pickup_time):
 		if(self.currentTime==None):
 			#This is the first trip that we have seen
 			#Start time at the beginning of that trip's month
-			self.currentTime = datetime(year=trip.pickup_time.year, month=trip.pickup_time.month, day=1)
+			self.currentTime = datetime(year=trip_hour.year, month=trip_hour.month, day=1)
 			self.reset()
-				
-		
-		
-		trip_hour = roundTime(trip.pickup_time, HOUR_GRANULARITY)
 		
 		#If the trip's time is less than the current Time, then trips were received out of order.  Print error message.
-		if(trip_hour < self.currentTime):
+		late = trip_hour < self.currentTime
+		if(late):
 			logMsg("ERROR: Bad trip order -- please give trips to GridSystem in chronological order.")
-			logMsg("Trip time : " + str(trip.pickup_time) + "   GridSystem current time : " + str(self.currentTime))
+			logMsg("Trip time : " + str(pickup_time) + "   GridSystem current time : " + str(self.currentTime))
 		
+		#The newest hour is the watermark - only the hours up to reorderHours before it are kept open
+		if(self.newestTime==None or trip_hour > self.newestTime):
+			self.newestTime = trip_hour
+		self.advanceTo(trip_hour - self.reorderHours * HOUR_GRANULARITY)
+		return late
+	
+	#Commits every hour before a given hour, and makes that hour the current one
+	#Arguments:
+		#hour - a datetime, rounded to the granularity.  Nothing happens if it is not after currentTime
+	def advanceTo(self, hour):
 		#The trips are received in chronological order
 		#Thus, if the trip occurs in the NEXT hour (or later) then THIS hour is complete.  It can be output
 		#And the internal state of the GridSystem is advanced forward in time
-		while(trip_hour > self.currentTime):
+		while(hour > self.currentTime):
 			self.commitEntry() #Output the set of features for the current hour
-			self.reset()		#Reset the features so the next hour can be computed
-			
 			
-			#Advance time by one hour
-			self.currentTime += HOUR_GRANULARITY
+			#Advance time by one hour (or one bin of the granularity)
+			self.currentTime += self.granularity
 
+			self.reset()		#Reset the features so the next hour can be computed (keeping any trips it already has)
 			
-			if(self.currentTime.hour==0):
+			if(self.currentTime.hour==0 and self.currentTime.minute==0):
 				logMsg("Advancing to " + str(self.currentTime))
-		
-		#Figure out which entry this trip is assigned to, based on origin-destination coordinates
-		entry = self.getEntry(trip.fromLon, trip.fromLat, trip.toLon, trip.toLat)
-		
-		#Update that entry's features using this trip's data
-		if(entry != None and trip.isValid()==Trip.VALID):	
-			entry.record(trip)
-			self.globalEntry.record(trip)
-		else:
-			self.recordError(trip)
-
-	#A separate method for recording trips that have an error.  Updates error counts in the global entry
-	def recordError(self, trip):
-		if(trip==None):
+	
+	#Records a whole TripChunk (see trip.py).  This gives the same results as calling record() on each
+	#of its trips in order, including trips with has_other_error set, but every trip is validated only once
+	#and the error counts are computed for many trips at once.
+	#Arguments:
+		#chunk - a TripChunk.  Just like record(), chunks should be given in chronological order
+		#codes - the result of chunk.isValid(), if it has already been computed (it will not be modified)
+	def recordChunk(self, chunk, codes=None):
+		n = len(chunk)
+		if(n==0):
 			return
 		
-		error_code = trip.isValid()
-		if(error_code==Trip.VALID):
-			error_code = Trip.ERR_OTHER
-		
-		self.globalEntry.error_counts[error_code] += 1
-		
-		#Activate the code below, if you want to build a file containing the actual error data
-		
-		#if(error_code != Trip.ERR_DATE):
-		#	self.errorF.writerow(trip.csvLine + [error_code])
-
-				
+		#Validate all trips at once.  Valid trips outside of all cells, and otherwise valid trips
+		#with has_other_error, are counted as ERR_OTHER - just like recordError()
+		if(codes is None):
+			codes = chunk.isValid()
+		else:
+			codes = codes.copy()
+		fromIds = self.getCellIds(chunk.fromLon, chunk.fromLat)
+		toIds = self.getCellIds(chunk.toLon, chunk.toLat)
+		codes[(codes==Trip.VALID) & ((fromIds < 0) | (toIds < 0) | chunk.has_other_error)] = Trip.ERR_OTHER
+		
+		#Trips that don't belong to any hour of this chunk go in the newest hour that has been seen
+		hours = tripBins(chunk, self.binSeconds)
+		
+		#Split the chunk into runs of consecutive trips in the same hour, and record each run
+		run_starts = [0] + (np.flatnonzero(hours[1:] != hours[:-1]) + 1).tolist()
+		run_ends = run_starts[1:] + [n]
+		for (start, end) in zip(run_starts, run_ends):
+			if(hours[start] >= 0):
+				hour = epochToDatetime(hours[start])
+				if(self.advanceTime(hour, epochToDatetime(chunk.pickup_time[start]))):
+					self.lateTrips += end - start
+			elif(self.currentTime==None):
+				#Errors that arrive before the first trip have no hour to be counted in
+				continue
+			else:
+				hour = self.newestTime
+			
+			self.recordRun(self.getAccumulator(hour), chunk, codes, fromIds, toIds, start, end)
 	
-	#Writes the features from all entries into the currently open files (see begin()).
+	#Records a run of trips from a TripChunk into an HourAccumulator - a helper method for recordChunk()
+	def recordRun(self, acc, chunk, codes, fromIds, toIds, start, end):
+		run_codes = codes[start:end]
+		acc.recordErrors(run_codes)
+		
+		#Valid trips are added to the features of their (fromCell, toCell) pairs
+		valid = np.flatnonzero(run_codes==Trip.VALID) + start
+		pairs = fromIds[valid] * len(self.cells) + toIds[valid]
+		driver_hash = None
+		if(self.sketchDrivers):
+			driver_hash = chunk.driver_hash[valid]
+		acc.record(pairs, chunk.time[valid], chunk.dist[valid],
+					chunk.winding_factor[valid], chunk.driver_id[valid], driver_hash)
+
+	#Writes the features of all pairs into the currently open files (see begin()).
 	#Should be called at the END of an hour, before reset() is called.
 	def commitEntry(self):
 		
 		#Ignore the end of the 0th hour, where no data has been recorded yet...
 		if(not self.currentTime is None):
-			
-			weekday = weekdayname[self.currentTime.weekday()]
-			
-						
-			#Write pace features, and pace variance features - this is one value for each entry (pair of regions)
-			line = [str(self.currentTime.date()), self.currentTime.hour, weekday]
-			vline = [str(self.currentTime.date()), self.currentTime.hour, weekday]
-			for fromCell in self.cells:
-				for toCell in self.cells:
-					entry = self.entries[(fromCell, toCell)]
-					if(entry.s_dist==0 or entry.numtrips < MIN_SAMPLE_SIZE):
-						#Bad sample size, output 0 as placeholder
-						pace = 0
-						v_pace = 0
-					else:
-						#Distance-weighted average pace
-						pace = entry.s_time / entry.s_dist
-						#Distance-weighted pace unbiased sample variance
-						correction = entry.s_dist / (entry.s_dist**2 - entry.ss_dist)
-						v_pace = correction * (entry.ss_time_over_dist - (entry.s_time**2)/entry.s_dist)
-
-					line.append(pace)
-					vline.append(v_pace)
-			self.paceF.writerow(line)
-			self.paceFp.flush()
-			self.paceVarF.writerow(vline)
-			self.paceVarFp.flush()
-	
-			#Write count features - one value for each entry (pair of regions)
-			line = [str(self.currentTime.date()), self.currentTime.hour, weekday]
-			for fromCell in self.cells:
-				for toCell in self.cells:
-					entry = self.entries[(fromCell, toCell)]
-					line.append(entry.numtrips)
-			self.countF.writerow(line)
-			self.countFp.flush()
-					
-			#Write "total miles" features - one value for each entry (pair of regions)
-			line = [str(self.currentTime.date()), self.currentTime.hour, weekday]
-			for fromCell in self.cells:
-				for toCell in self.cells:
-					entry = self.entries[(fromCell, toCell)]
-					line.append(entry.s_dist)
-			self.milesF.writerow(line)
-			self.milesFp.flush()
-			
-			
-			#Write unique driver count features - one value for each entry (pair of regions)
-			line = [str(self.currentTime.date()), self.currentTime.hour, weekday]
-			for fromCell in self.cells:
-				for toCell in self.cells:
-					entry = self.entries[(fromCell, toCell)]
-					line.append(len(entry.drivers))
-			self.driversF.writerow(line)
-			self.driversFp.flush()
-			
-			#Write global entry - this contains the same features as above, except for all trips
-			if(self.globalEntry.s_dist==0):
-				pace = 0
-				avg_wind = 0
-				sdev_wind = 0
-			else:
-				pace = self.globalEntry.s_time / self.globalEntry.s_dist
-			
-			#Compute winding vactor if possible
-			if(self.globalEntry.numtrips > 0):
-				avg_wind = self.globalEntry.s_wind / self.globalEntry.numtrips
-				variance = (self.globalEntry.ss_wind / self.globalEntry.numtrips) - (avg_wind)**2
+			acc = self.accumulator
+			(features, globalRow) = computeFeatures(acc)
 
-				sdev_wind = math.sqrt(variance)
-			else:
-				avg_wind = 0
-				sdev_wind = 0
+			self.sink.write(self.currentTime, features, globalRow)
 			
-			self.globalF.writerow([str(self.currentTime.date()), self.currentTime.hour, weekday, self.globalEntry.numtrips, pace, self.globalEntry.s_dist, len(self.globalEntry.drivers), avg_wind, sdev_wind] + self.globalEntry.error_counts)
-			self.globalFp.flush()
+			#One row of drivers_sketch.bin for each row of global_features.csv
+			if(self.sketchDrivers):
+				acc.globalSketch.write(self.sketchFp)
+
+			#The same sums are added to every coarser resolution
+			for rollup in self.rollupWriters:
+				rollup.add(self.currentTime, acc)
 		else:
 			print("self.currentTime is None")
-			
-		
+
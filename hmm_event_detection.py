@@ -9,7 +9,7 @@ from hmmlearn.hmm import MultinomialHMM
 from numpy import array
 
 from tools import *
-from measureOutliers import readGlobalPace, getExpectedPace
+from measureOutliers import readExpectedPace, getExpectedPace
 import csv
 
 
@@ -108,15 +108,19 @@ DEFAULT_EMISSION_MATRIX = array([[.95, .05],
 
 
 
+# The expected pace only depends on the global pace, so callers which detect events many times
+# (e.g. hmm_monte_carlo.py) should compute it once with getExpectedPace() and pass it in
 def detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries,
                       threshold_quant=.95, trans_matrix = DEFAULT_TRANS_MATRIX,
-                      emission_matrix=DEFAULT_EMISSION_MATRIX, initial_state=None):
+                      emission_matrix=DEFAULT_EMISSION_MATRIX, initial_state=None,
+                      expected_pace_timeseries=None):
             
     #Sort the keys of the timeseries chronologically    
     sorted_dates = sorted(mahal_timeseries)
     
     
-    (expected_pace_timeseries, sd_pace_timeseries) = getExpectedPace(global_pace_timeseries)    
+    if(expected_pace_timeseries is None):
+        (expected_pace_timeseries, sd_pace_timeseries) = getExpectedPace(global_pace_timeseries)    
 
     #Generate the list of values of R(t)
     mahal_list = [mahal_timeseries[d] for d in sorted_dates]
@@ -162,9 +166,10 @@ def detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries,
 
 def process_events(outlier_score_file, feature_dir, output_file):
     mahal_timeseries, c_timeseries = readOutlierScores(outlier_score_file)
-    global_pace_timeseries = readGlobalPace(feature_dir)
+    (global_pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) = readExpectedPace(feature_dir)
 
-    events, predictions = detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries)
+    events, predictions = detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries,
+                                            expected_pace_timeseries=expected_pace_timeseries)
     
     new_scores_file = output_file.split(".")[0] + "_scores.csv"
     augment_outlier_scores(outlier_score_file, new_scores_file, predictions)
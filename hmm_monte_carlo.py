@@ -15,7 +15,7 @@ from functools import partial
 import csv
 from collections import defaultdict
 
-from measureOutliers import readGlobalPace
+from measureOutliers import readExpectedPace
 from hmm_event_detection import detect_events_hmm, readOutlierScores, augment_outlier_scores
 from tools import logMsg, DefaultPool
 
@@ -141,29 +141,34 @@ def randomly_draw_parameters(state_remain_mean=.99, state_remain_sd=.03,
 
 
 
-def run_one_simulation(mahal_timeseries, c_timeseries, global_pace_timeseries):
+# The expected pace is computed once (see measureOutliers.readExpectedPace()) and shared by all of the simulations
+def run_one_simulation(mahal_timeseries, c_timeseries, global_pace_timeseries, expected_pace_timeseries=None):
     initial_state, trans_matrix, emission_matrix = randomly_draw_parameters()
     
     events, predictions = detect_events_hmm(mahal_timeseries, c_timeseries,
                         global_pace_timeseries, threshold_quant=.95,
                         trans_matrix = trans_matrix,
-                      emission_matrix=emission_matrix)
+                      emission_matrix=emission_matrix,
+                      expected_pace_timeseries=expected_pace_timeseries)
     
     return match_events(events)
     
 
-def run_many_simulations(num, mahal_timeseries=None , c_timeseries=None, global_pace_timeseries=None):
+def run_many_simulations(num, mahal_timeseries=None , c_timeseries=None, global_pace_timeseries=None,
+                         expected_pace_timeseries=None):
     return [event for i in xrange(num)
-            for event in run_one_simulation(mahal_timeseries, c_timeseries, global_pace_timeseries)]
+            for event in run_one_simulation(mahal_timeseries, c_timeseries, global_pace_timeseries,
+                                            expected_pace_timeseries)]
 
 
 def run_sims_in_parallel(outlier_score_file, feature_dir, output_file):
     pool = Pool(8)
     mahal_timeseries, c_timeseries = readOutlierScores(outlier_score_file)
-    global_pace_timeseries = readGlobalPace(feature_dir)
+    (global_pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) = readExpectedPace(feature_dir)
     
     sim_function = partial(run_many_simulations, mahal_timeseries = mahal_timeseries,
-                           c_timeseries = c_timeseries, global_pace_timeseries=global_pace_timeseries)
+                           c_timeseries = c_timeseries, global_pace_timeseries=global_pace_timeseries,
+                           expected_pace_timeseries=expected_pace_timeseries)
     sim_sizes = [1250]*8
     result = pool.map(sim_function, sim_sizes)
     
@@ -176,7 +181,7 @@ def run_sims_in_parallel(outlier_score_file, feature_dir, output_file):
 def run_random_sims(outlier_score_file, feature_dir):
     
     mahal_timeseries, c_timeseries = readOutlierScores(outlier_score_file)
-    global_pace_timeseries = readGlobalPace(feature_dir)
+    (global_pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) = readExpectedPace(feature_dir)
     
     for p in range(50):
         print ("Sim %d" % p)
@@ -185,7 +190,8 @@ def run_random_sims(outlier_score_file, feature_dir):
         events, predictions = detect_events_hmm(mahal_timeseries, c_timeseries,
                         global_pace_timeseries, threshold_quant=.95,
                         trans_matrix = trans_matrix,
-                      emission_matrix=emission_matrix)
+                      emission_matrix=emission_matrix,
+                      expected_pace_timeseries=expected_pace_timeseries)
         new_scores_file = 'tmp_results/coarse_events_k%d_scores.csv'%p
     
         augment_outlier_scores(outlier_score_file, new_scores_file, predictions)
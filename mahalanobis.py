@@ -8,8 +8,9 @@ from tools import *
 from numpy import transpose, matrix, nonzero, ravel, diag, sqrt, where, square
 from numpy import zeros, multiply, column_stack, arange
 from numpy.linalg import inv, eig
+import numpy as np
 
-from data_preprocessing import pca, scale_and_center
+from data_preprocessing import pca, scale_and_center, stack_vectors
 from op_modified import opursuit
 from tuneparameters import increasing_tolerance_search
 
@@ -438,12 +439,12 @@ def get_zscore_matrix(M,L):
 # how unusual they are.  PCA approximation is used for high dimensional data,
 # and Robust PCA via Outlier Pursuit is available.
 # Params:
-    # vectors - a list of Numpy column vectors
+    # vectors - a list of Numpy column vectors, or a matrix whose columns are the vectors
     # robust - True if RPCA via OP is desired
     # k - Number of PCs to use in PCA
     # gamma - gamma parameter for RPCA
 def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol_perc=1e-06):
-    data_matrix = column_stack(vectors)
+    data_matrix = stack_vectors(vectors)
     if(robust):
         
         if(gamma=="tune"):
@@ -508,6 +509,32 @@ def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol
       
         return mahals5, mahals10, mahals20, mahals50, c_vals, z_scores, gamma_vals, tol_vals, n_pca_d, n_guess, hi_pcs
 
+
+
+# Like computeMahalanobisDistances(), but the group is read from a data matrix which is shared by all
+# of the worker processes through a memory-mapped file, and the z-scores are written into another
+# shared file.  So only the group's index array and its small results are sent between processes.
+# Params:
+    # (key, columns) - the group's key, and an int array of its columns in the data matrix
+    # data_file - a .npy file with the data matrix (columns are observations), opened read-only
+    # zscore_file - a .npy file with the same shape as the data matrix, where the z-scores are written
+    # robust, k, gamma, tol_perc - see computeMahalanobisDistances()
+# Returns:
+    # the same as computeMahalanobisDistances(), except that z_scores is None
+def computeSharedMahalanobisDistances((key, columns), data_file, zscore_file, robust=False, k=10,
+                                      gamma=.5, tol_perc=1e-06):
+    data_matrix = np.load(data_file, mmap_mode="r")
+    group_matrix = np.asmatrix(np.asarray(data_matrix[:,columns]))
+    scores = list(computeMahalanobisDistances((key, group_matrix), robust=robust, k=k,
+                                              gamma=gamma, tol_perc=tol_perc))
+    
+    # Each group writes its own columns, so the workers never write to the same place
+    zscore_matrix = np.load(zscore_file, mmap_mode="r+")
+    zscore_matrix[:,columns] = column_stack(scores[5])
+    zscore_matrix.flush()
+    scores[5] = None
+    return tuple(scores)
+
         
 
 
@@ -6,16 +6,18 @@ Created on Wed Sep 24 12:34:53 2014
 """
 import numpy
 from numpy import matrix, transpose, zeros
-import os, csv
+import os, csv, shutil, tempfile
 from collections import defaultdict
 from multiprocessing import Pool
 from functools import partial
 
-from data_preprocessing import preprocess_data, remove_bad_dimensions_grouped
+from data_preprocessing import preprocess_data, remove_bad_dimensions_indexed
 from mahalanobis import *
 from traffic_estimation.plot_estimates import make_video, build_speed_dicts
 from lof import *
 from tools import *
+from feature_store import is_sparse_store, read_sparse_features, read_time_index, read_pair_names, time_columns
+from feature_store import load_feature_matrix, group_by_weekday_hour
 
 from measureLinkOutliers import load_pace_data, load_from_file
 from sys import stdout
@@ -23,6 +25,7 @@ from sys import stdout
 import pickle
 
 NUM_PROCESSORS = 2
+FEATURE_CACHE_DIR = None    #If set, binary caches of CSV feature files are kept here (see feature_store.load_feature_matrix())
 
 
 #Reads time-series pace data from a file, and sorts it into a convenient format.
@@ -37,6 +40,11 @@ NUM_PROCESSORS = 2
     #trip_names - the names of the trips, which correspond to the dimensions in the vectors (e.g. "E-E")
 def readPaceData(dirName):
     logMsg("Reading files from " + dirName + " ...")
+    
+    #A sparse store (see extractRegionFeaturesParallel.SPARSE_OUTPUT) is read directly, without the missing pairs
+    if(is_sparse_store(dirName)):
+        return readSparsePaceData(dirName)
+    
     #Create filenames
     paceFileName = os.path.join(dirName, "pace_features.csv")
 
@@ -77,6 +85,49 @@ def readPaceData(dirName):
     return (pace_timeseries, pace_grouped, dates_grouped, trip_names)
 
 
+#Reads time-series pace data from a sparse feature store (see feature_store.SparseFeatureSink)
+#Memory scales with the number of observed paces, instead of the number of hours times the number of pairs
+#Arguments:
+    #dirName - the directory of the sparse store
+#Returns: the same as readPaceData(), except that the pace vectors are sparse (scipy.sparse) column vectors.
+    #Missing paces are still 0.  remove_bad_dimensions_grouped() converts them back to dense vectors
+def readSparsePaceData(dirName):
+    pace_timeseries = {}
+    pace_grouped = defaultdict(list)
+    dates_grouped = defaultdict(list)
+    
+    #One column for each hour, so each hour's vector can be sliced out quickly
+    paces = read_sparse_features(dirName, "pace").T.tocsc()
+    times = read_time_index(dirName)
+    for j in xrange(len(times)):
+        (date, hour, weekday) = time_columns(epochToDatetime(times[j]))
+        v = paces[:,j]
+        pace_timeseries[(date, hour, weekday)] = v
+        pace_grouped[(weekday, hour)].append(v)
+        dates_grouped[(weekday, hour)].append(date)
+    
+    trip_names = read_pair_names(dirName)
+    return (pace_timeseries, pace_grouped, dates_grouped, trip_names)
+
+
+#Reads the pace features as one matrix, with the hours grouped by weekday and hour of the day
+#This is much faster than readPaceData(), since the matrix is memory-mapped (or parsed in bulk, and cached in
+#FEATURE_CACHE_DIR if it is set - see feature_store.load_feature_matrix()), and the groups are index arrays instead of lists of vectors
+#Arguments:
+    #dirName - the directory which contains time-series features (produced by extractGridFeatures.py)
+#Returns: (pace_matrix, dates, groups, trip_names).  Breakdown:
+    #pace_matrix - an (hours x trip types) array of average paces.  It is a scipy.sparse matrix for a sparse store
+    #dates - the date (e.g. "2012-03-01") of each row of pace_matrix
+    #groups - a dictionary which maps (weekday, hour) to an int array of the rows of pace_matrix in that group
+    #        for example, ("Wednesday", 5) maps to the rows of all Wednesdays at 5am, in chronological order
+    #trip_names - the names of the trips, which correspond to the columns of pace_matrix (e.g. "E-E")
+def readPaceMatrix(dirName):
+    logMsg("Reading files from " + dirName + " ...")
+    (pace_matrix, times, trip_names) = load_feature_matrix(dirName, "pace", FEATURE_CACHE_DIR)
+    dates = [str(epochToDatetime(t).date()) for t in times]
+    return (pace_matrix, dates, group_by_weekday_hour(times), trip_names)
+
+
 
 
 
@@ -85,28 +136,12 @@ def readPaceData(dirName):
     #dirName - the directory which contains time-series features (produced by extractGridFeatures.py)
 #Returns: - a dictionary which maps (date, hour, weekday) to the average pace of all taxis in that timeslice
 def readGlobalPace(dirName):
-    paceFileName = os.path.join(dirName, "global_features.csv")
-    
-    #Read the pace file
-    r = csv.reader(open(paceFileName, "r"))
-    colIds = getHeaderIds(r.next())
+    #The whole column is read at once (see feature_store.load_feature_matrix())
+    (global_features, times, column_names) = load_feature_matrix(dirName, "global", FEATURE_CACHE_DIR)
+    paces = global_features[:, column_names.index("Pace")].tolist()
     
-    pace_timeseries = {}
-
-        
-    
-    for line in r:
-        #Extract info
-        #First 3 columns
-        date = line[colIds["Date"]]
-        hour = int(line[colIds["Hour"]])
-        weekday = line[colIds["Weekday"]]
-        #Last 16 columns
-        pace = float(line[colIds["Pace"]])
-        
-
-        #Save vector in the timeseries and the group
-        pace_timeseries[(date, hour, weekday)] = pace
+    keys = [tuple(time_columns(epochToDatetime(t))) for t in times]
+    pace_timeseries = dict(zip(keys, paces))
 
     return pace_timeseries
     
@@ -121,37 +156,75 @@ def readGlobalPace(dirName):
 		#expected_pace_timeseries - A dictionary keyed by (date, hour, weekday) which contains expected paces for each hour of the timeseries
 		#expected_pace_timeseries - A dictionary keyed by (date, hour, weekday) which contains the standard deviation of paces at that hour of the time series
 def getExpectedPace(global_pace_timeseries):
+	keys = global_pace_timeseries.keys()
+	paces = numpy.array([global_pace_timeseries[key] for key in keys], dtype=float)
+	
+	#Number the (weekday, hour) groups, and give each timeslice the number of its group
+	group_codes = {}
+	groups = numpy.array([group_codes.setdefault((weekday, hour), len(group_codes)) for (date, hour, weekday) in keys], dtype=int)
+	
 	#First computed grouped counts, sums, and sums of squares
 	#Note that these are leave-one-IN estimates.  This will be converted to leave-one-out in the next step
-	grouped_sum = defaultdict(float)
-	grouped_ss = defaultdict(float)	
-	grouped_count = defaultdict(float)
-	#Iterate through all days, updating the corresponding sums
-	for (date, hour, weekday) in global_pace_timeseries:
-		grouped_sum[weekday, hour] += global_pace_timeseries[date,hour,weekday]
-		grouped_ss[weekday, hour] += global_pace_timeseries[date,hour,weekday] ** 2
-		
-		grouped_count[weekday, hour] += 1
+	grouped_count = numpy.bincount(groups, minlength=len(group_codes)).astype(float)
+	grouped_sum = numpy.bincount(groups, weights=paces, minlength=len(group_codes))
+	grouped_ss = numpy.bincount(groups, weights=paces ** 2, minlength=len(group_codes))
 	
-	expected_pace_timeseries = {}
-	sd_pace_timeseries = {}
-	#Now that the grouped stats are computed, iterate through the timeseries again
-	for (date, hour, weekday) in global_pace_timeseries:
-		#The updated count, sum, and sum of squares are computed by subtracting the observation at hand
-		#i.e. a leave-one-out estimate
-		updated_sum = grouped_sum[weekday, hour] - global_pace_timeseries[date, hour, weekday]
-		updated_ss = grouped_ss[weekday, hour] - global_pace_timeseries[date, hour, weekday] ** 2
-		updated_count = grouped_count[weekday, hour] - 1
-		
-		#Compute the average and standard deviation from these sums
-		expected_pace_timeseries[date, hour, weekday] = updated_sum / updated_count
-		sd_pace_timeseries[date, hour, weekday] = sqrt((updated_ss / updated_count) - expected_pace_timeseries[date, hour, weekday] ** 2)
+	#The updated count, sum, and sum of squares are computed by subtracting the observation at hand
+	#i.e. a leave-one-out estimate
+	updated_sum = grouped_sum[groups] - paces
+	updated_ss = grouped_ss[groups] - paces ** 2
+	updated_count = grouped_count[groups] - 1
+	
+	#Compute the average and standard deviation from these sums
+	#(a group with only one timeslice has no leave-one-out estimate, so it gets NaN)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		expected_paces = updated_sum / updated_count
+		sd_paces = numpy.sqrt((updated_ss / updated_count) - expected_paces ** 2)
 	
 	#Return the computed time series dictionaries
+	expected_pace_timeseries = dict(zip(keys, expected_paces.tolist()))
+	sd_pace_timeseries = dict(zip(keys, sd_paces.tolist()))
 	return (expected_pace_timeseries, sd_pace_timeseries)    
+
+
+
+#Expected paces which have already been computed, keyed by feature directory (see readExpectedPace())
+expected_pace_cache = {}
+
+#Reads the global pace of a feature directory, and computes its expected pace with getExpectedPace()
+#The results are cached, so each directory is only read once
+#Arguments:
+	#dirName - the directory which contains time-series features
+#Returns:
+	#A tuple (global_pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) - see readGlobalPace() and getExpectedPace()
+def readExpectedPace(dirName):
+	if(dirName not in expected_pace_cache):
+		global_pace_timeseries = readGlobalPace(dirName)
+		expected_pace_cache[dirName] = (global_pace_timeseries,) + getExpectedPace(global_pace_timeseries)
+	return expected_pace_cache[dirName]
+    
     
     
+#Reads how many guesses tuning took for each group in a previous run (see generateTimeSeriesOutlierScores())
+#These are used to estimate the cost of each group, so the most expensive groups can be started first
+#Arguments:
+    #filename - a robust_outlier_scores.csv file from a previous run
+#Returns:
+    #a dictionary which maps (weekday, hour) to the num_guess of that group.  It is empty if there is no such file
+def readPreviousGuesses(filename):
+    num_guesses = {}
+    if(not os.path.exists(filename)):
+        return num_guesses
     
+    r = csv.reader(open(filename, "r"))
+    colIds = getHeaderIds(r.next())
+    for line in r:
+        key = (line[colIds["weekday"]], int(line[colIds["hour"]]))
+        num_guesses[key] = float(line[colIds["num_guess"]])
+    return num_guesses
+
+
+
 def reduceOutlierScores(scores, sorted_keys, dates_grouped):
     #weekday_strs = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     #mahals - list of lists
@@ -173,138 +246,264 @@ def reduceOutlierScores(scores, sorted_keys, dates_grouped):
 
     
 
-def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_pcs=10,
-                                    gamma=.5, tol_perc=1e-06, perc_missing_allowed=.05,
-                                    make_zscore_vid=False, pool = DefaultPool()):
-                                 
-
-
-    numpy.set_printoptions(linewidth=1000, precision=4)
-    
-    #Read the time-series data from the file
-    logMsg("Reading files...")
-    stdout.flush()
-    if(use_link_db):
-        file_prefix = "link_"
-        
-        #pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_pace_data(
-        #    num_trips_threshold=consistent_threshold, pool=pool)
+#The state of one outlier analysis, between reading its data and writing its results
+#Its groups are tasks which can be run in any pool, alongside the groups of other analyses (see runOutlierJobs())
+class OutlierJob:
+    #Reads the data, removes bad dimensions, and shares the data matrix with the worker processes
+    #Arguments: the same as generateTimeSeriesOutlierScores()
+    def __init__(self, inDir, use_link_db=False, robust=False, num_pcs=10,
+                 gamma=.5, tol_perc=1e-06, perc_missing_allowed=.05, make_zscore_vid=False):
+        numpy.set_printoptions(linewidth=1000, precision=4)
+        self.inDir = inDir
+        self.make_zscore_vid = make_zscore_vid
+        self.consistent_link_set = None
         
-        pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_from_file(use_link_db)
-
-
-    else:
-        file_prefix = "coarse_"
-        (pace_timeseries, pace_grouped, dates_grouped, trip_names) = readPaceData(inDir)
+        #Read the time-series data from the file
+        logMsg("Reading files...")
+        stdout.flush()
+        if(use_link_db):
+            file_prefix = "link_"
+            
+            #pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_pace_data(
+            #    num_trips_threshold=consistent_threshold, pool=pool)
+            
+            pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_from_file(use_link_db)
+            self.consistent_link_set = consistent_link_set
+            
+            #Put the groups side by side in one matrix (one row per observation), so each group is a range of rows
+            sorted_keys = sorted(pace_grouped)
+            pace_matrix = numpy.column_stack([vect for key in sorted_keys for vect in pace_grouped[key]]).T
+            groups = {}
+            start = 0
+            for key in sorted_keys:
+                groups[key] = numpy.arange(start, start + len(pace_grouped[key]))
+                start += len(pace_grouped[key])
+            del pace_grouped, pace_timeseries
+    
+    
+        else:
+            file_prefix = "coarse_"
+            (pace_matrix, dates, groups, trip_names) = readPaceMatrix(inDir)
+            dates_grouped = dict([(key, [dates[i] for i in groups[key]]) for key in groups])
+            
+    
+    
+        if(robust):
+            if(gamma=="tune"):
+                robustStr = "RPCAtune"
+            else:
+                robustStr = "RPCA%d" % int(gamma*100)
+        else:
+            robustStr = "PCA"
+    
+        file_prefix += "%s_%s_%dpcs_%dpercmiss" % (inDir, robustStr, num_pcs, perc_missing_allowed*100)
+        self.file_prefix = file_prefix
+        self.groups = groups
+        self.dates_grouped = dates_grouped
+    
+    
+        #pace_grouped = preprocess_data(pace_grouped, num_pcs,
+        #                               perc_missing_allowed=perc_missing_allowed)
+        #The columns of data_matrix are the (smaller) pace vectors, and groups gives the columns of each group
+        data_matrix, self.trip_names = remove_bad_dimensions_indexed(pace_matrix, trip_names, perc_missing_allowed)
+        del pace_matrix
+        num_dims = data_matrix.shape[0]
         
-
-
-    if(robust):
+        #The data matrix is shared with the worker processes through a memory-mapped file, and they write
+        #their z-scores into another one (see computeSharedMahalanobisDistances()).  So the groups are not
+        #copied into each task, and the z-scores are not sent back
+        self.tmp_dir = tempfile.mkdtemp(prefix="outliers_")
+        data_file = os.path.join(self.tmp_dir, "data.npy")
+        self.zscore_file = os.path.join(self.tmp_dir, "zscores.npy")
+        numpy.save(data_file, data_matrix)
+        numpy.lib.format.open_memmap(self.zscore_file, mode="w+", dtype=float, shape=data_matrix.shape).flush()
+        del data_matrix
+        # logMsg(trip_names)
+    
+    
+        #Also get global pace information
+        self.global_pace_timeseries = {}
+        self.expected_pace_timeseries = {}
+        self.sd_pace_timeseries = {}
+        if inDir != '':
+            (self.global_pace_timeseries, self.expected_pace_timeseries, self.sd_pace_timeseries) = readExpectedPace(inDir)
+    
         if(gamma=="tune"):
-            robustStr = "RPCAtune"
+            logMsg("Doing RPCA and tuning gamma")
         else:
-            robustStr = "RPCA%d" % int(gamma*100)
-    else:
-        robustStr = "PCA"
-
-    file_prefix += "%s_%s_%dpcs_%dpercmiss" % (inDir, robustStr, num_pcs, perc_missing_allowed*100)
-
-
-    #pace_grouped = preprocess_data(pace_grouped, num_pcs,
-    #                               perc_missing_allowed=perc_missing_allowed)
-    pace_grouped, trip_names = remove_bad_dimensions_grouped(pace_grouped, trip_names, perc_missing_allowed)
-    # logMsg(trip_names)
-
-
-    #Also get global pace information
-    if inDir != '':
-        global_pace_timeseries = readGlobalPace(inDir)
-        (expected_pace_timeseries, sd_pace_timeseries) = getExpectedPace(global_pace_timeseries)
-
-    logMsg("Starting processes")
-    if(gamma=="tune"):
-        logMsg("Doing RPCA and tuning gamma")
-    else:
-        logMsg("Doing RPCA with gamma=%f, k=%d" % (gamma, num_pcs))
-    stdout.flush()
+            logMsg("Doing RPCA with gamma=%f, k=%d" % (gamma, num_pcs))
+        stdout.flush()
+    
+        # Freeze the parameters of the computeSharedMahalanobisDistances() function
+        self.mahalFunc = partial(computeSharedMahalanobisDistances, data_file=data_file, zscore_file=self.zscore_file,
+                                 robust=robust, k=num_pcs, gamma=gamma, tol_perc=tol_perc)
+        
+        # Estimate the cost of each group from its size, times the number of guesses it took in the previous
+        # run (groups which are not in the previous run are assumed to take as many as the worst one)
+        previous_guesses = readPreviousGuesses("results/%s_robust_outlier_scores.csv"%file_prefix)
+        worst_guesses = max(previous_guesses.values() + [1])
+        
+        # One task for each group
+        self.sorted_keys = sorted(groups)    
+        self.tasks = [(key,groups[key]) for key in self.sorted_keys]    
+        self.costs = [max(previous_guesses.get(key, worst_guesses), 1) * num_dims * len(groups[key])
+                      for key in self.sorted_keys]
+    
+    
+    #Removes the temporary files of the job.  This is safe to call more than once, so it can be used
+    #to clean up jobs which never finished
+    def cleanup(self):
+        if(os.path.exists(self.tmp_dir)):
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    
+    
+    #Writes the results, once all of the tasks have finished
+    #Arguments:
+        #outlier_scores - the results of self.mahalFunc for each of self.tasks, in the same order
+        #pool - the pool used to make the z-score video (if make_zscore_vid was given)
+    #Returns:
+        #the c_val of every hour, in chronological order
+    def finish(self, outlier_scores, pool=DefaultPool()):
+        sorted_keys = self.sorted_keys
+        dates_grouped = self.dates_grouped
+        trip_names = self.trip_names
+        file_prefix = self.file_prefix
+        global_pace_timeseries = self.global_pace_timeseries
+        expected_pace_timeseries = self.expected_pace_timeseries
+        sd_pace_timeseries = self.sd_pace_timeseries
+        consistent_link_set = self.consistent_link_set
+        
+        # Put the z-scores back into the results, as column vectors of the shared z-score matrix
+        zscore_matrix = numpy.asmatrix(numpy.load(self.zscore_file, mmap_mode="r"))
+        outlier_scores = list(outlier_scores)
+        for i in xrange(len(sorted_keys)):
+            scores = list(outlier_scores[i])
+            scores[5] = [zscore_matrix[:,j] for j in self.groups[sorted_keys[i]]]
+            outlier_scores[i] = scores
+
+        logMsg("Merging output")
+        #Merge outputs from all of the threads
+        entries = reduceOutlierScores(outlier_scores, sorted_keys, dates_grouped)
 
-    # Freeze the parameters of the computeMahalanobisDistances() function
-    mahalFunc = partial(computeMahalanobisDistances, robust=robust, k=num_pcs,
-                        gamma=gamma, tol_perc=tol_perc)
-    
-    # Compute all mahalanobis distances
-    sorted_keys = sorted(pace_grouped)    
-    groups = [(key,pace_grouped[key]) for key in sorted_keys]    
-    outlier_scores = pool.map(mahalFunc, groups) #Run all of the groups, using as much parallel computing as possible
-
-    logMsg("Merging output")
-    #Merge outputs from all of the threads
-    entries = reduceOutlierScores(outlier_scores, sorted_keys, dates_grouped)
-
-    
-    logMsg("Writing file")
-    #Output outlier scores to file
-    scoreWriter = csv.writer(open("results/%s_robust_outlier_scores.csv"%file_prefix, "w"))
-    scoreWriter.writerow(['date','hour','weekday', 'mahal5', 'mahal10', 'mahal20',
-                          'mahal50' ,'c_val', 'gamma', 'tol', 'pca_dim', 'num_guess',
-                          'hi_pcs', 'global_pace', 'expected_pace', 'sd_pace'])
-    
-    for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
-         n_pca_dim, n_guess, hi_pcs) in sorted(entries):
-        try:
-            gl_pace = global_pace_timeseries[(date, hour, weekday)]
-            exp_pace = expected_pace_timeseries[(date, hour, weekday)]
-            sd_pace = sd_pace_timeseries[(date, hour, weekday)]
-        except:
-            gl_pace = 0
-            exp_pace = 0
-            sd_pace = 0
+    
+        logMsg("Writing file")
+        #Output outlier scores to file
+        scoreWriter = csv.writer(open("results/%s_robust_outlier_scores.csv"%file_prefix, "w"))
+        scoreWriter.writerow(['date','hour','weekday', 'mahal5', 'mahal10', 'mahal20',
+                              'mahal50' ,'c_val', 'gamma', 'tol', 'pca_dim', 'num_guess',
+                              'hi_pcs', 'global_pace', 'expected_pace', 'sd_pace'])
+    
+        for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
+             n_pca_dim, n_guess, hi_pcs) in sorted(entries):
+            try:
+                gl_pace = global_pace_timeseries[(date, hour, weekday)]
+                exp_pace = expected_pace_timeseries[(date, hour, weekday)]
+                sd_pace = sd_pace_timeseries[(date, hour, weekday)]
+            except:
+                gl_pace = 0
+                exp_pace = 0
+                sd_pace = 0
         
-        scoreWriter.writerow([date, hour, weekday,  mahal5, mahal10, mahal20, mahal50,
-                              c_val, gamma, tol, n_pca_dim, n_guess, hi_pcs, 
-                              gl_pace, exp_pace, sd_pace])
+            scoreWriter.writerow([date, hour, weekday,  mahal5, mahal10, mahal20, mahal50,
+                                  c_val, gamma, tol, n_pca_dim, n_guess, hi_pcs, 
+                                  gl_pace, exp_pace, sd_pace])
 
 
-    all_cvals = [c_val for(date, hour, weekday, mahal5, mahal10, mahal20, mahal50,
-                    c_val, z_scores, gamma, tol,n_pca_dim, n_guess, hi_pcs) in sorted(entries)]
+        all_cvals = [c_val for(date, hour, weekday, mahal5, mahal10, mahal20, mahal50,
+                        c_val, z_scores, gamma, tol,n_pca_dim, n_guess, hi_pcs) in sorted(entries)]
 
     
-    zscoreWriter= csv.writer(open("results/%s_zscore.csv"%file_prefix, "w"))
-    zscoreWriter.writerow(['Date','Hour','Weekday'] + trip_names)
-    #Output zscores to file
-    for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
-         n_pca_dim, n_guess, hi_pcs) in sorted(entries):
-        std_vect = z_scores
-        zscoreWriter.writerow([date, hour, weekday] + ravel(std_vect).tolist())
+        zscoreWriter= csv.writer(open("results/%s_zscore.csv"%file_prefix, "w"))
+        zscoreWriter.writerow(['Date','Hour','Weekday'] + trip_names)
+        #Output zscores to file
+        for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
+             n_pca_dim, n_guess, hi_pcs) in sorted(entries):
+            std_vect = z_scores
+            zscoreWriter.writerow([date, hour, weekday] + ravel(std_vect).tolist())
     
     
 
-    #def make_video(tmp_folder, filename_base, pool=DefaultPool(), dates=None, speed_dicts=None)
-    if(make_zscore_vid):
-        logMsg("Making speed dicts")
-        #zscore_list = [zscores[key] for key in sorted(zscores)]
-        date_list = []
-        zscore_list = []
+        #def make_video(tmp_folder, filename_base, pool=DefaultPool(), dates=None, speed_dicts=None)
+        if(self.make_zscore_vid):
+            logMsg("Making speed dicts")
+            #zscore_list = [zscores[key] for key in sorted(zscores)]
+            date_list = []
+            zscore_list = []
         
-        for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
-             n_pca_dim, n_guess, hi_pcs) in sorted(entries):
-            if(date >= '2014-06-01' and date < '2014-07-01'):
-                dt = datetime.strptime(date, '%Y-%m-%d') + timedelta(hours=int(hour))
-                date_list.append(dt)
-                zscore_list.append(z_scores)
+            for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
+                 n_pca_dim, n_guess, hi_pcs) in sorted(entries):
+                if(date >= '2014-06-01' and date < '2014-07-01'):
+                    dt = datetime.strptime(date, '%Y-%m-%d') + timedelta(hours=int(hour))
+                    date_list.append(dt)
+                    zscore_list.append(z_scores)
                 
-        speed_dicts = build_speed_dicts(consistent_link_set, zscore_list)
-        logMsg("Making video with %d frames" % len(zscore_list))
+            speed_dicts = build_speed_dicts(consistent_link_set, zscore_list)
+            logMsg("Making video with %d frames" % len(zscore_list))
         
-        with open('tmp_zscores.pickle', 'w') as f:
-            pickle.dump((date_list, speed_dicts), f)
-        make_video("tmp_vid", "zscore_vid", pool=pool, dates=date_list, speed_dicts=speed_dicts)
+            with open('tmp_zscores.pickle', 'w') as f:
+                pickle.dump((date_list, speed_dicts), f)
+            make_video("tmp_vid", "zscore_vid", pool=pool, dates=date_list, speed_dicts=speed_dicts)
         
         
         
 
-    logMsg("Done.")
+        del zscore_matrix
+        self.cleanup()
+        logMsg("Done.")
+        return all_cvals
+
+
+
+#Runs the groups of several OutlierJobs in one pool, as one batch of tasks.  The most expensive tasks are
+#started first (see tools.mapByCost()), and each job's results are written as soon as its last group finishes
+#Arguments:
+    #jobs - a list of OutlierJobs
+    #pool - a multiprocessing.Pool or a DefaultPool
+#Returns:
+    #a list of the results of each job's finish()
+def runOutlierJobs(jobs, pool=DefaultPool()):
+    tasks = [(job.mahalFunc, task) for job in jobs for task in job.tasks]
+    costs = [cost for job in jobs for cost in job.costs]
+    owners = [(j, i) for j in xrange(len(jobs)) for i in xrange(len(jobs[j].tasks))]
+    
+    scores = [[None] * len(job.tasks) for job in jobs]
+    remaining = [len(job.tasks) for job in jobs]
+    all_cvals = [None] * len(jobs)
+    try:
+        for j in xrange(len(jobs)):
+            if(remaining[j]==0):
+                all_cvals[j] = jobs[j].finish([], pool)
+        
+        for (t, result) in imapByCost(pool, applyTask, tasks, costs):
+            (j, i) = owners[t]
+            scores[j][i] = result
+            remaining[j] -= 1
+            if(remaining[j]==0):
+                logMsg("Finished all groups of %s" % jobs[j].file_prefix)
+                all_cvals[j] = jobs[j].finish(scores[j], pool)
+                scores[j] = None
+    finally:
+        #If a task failed, the jobs which never finished still have their temporary files
+        for job in jobs:
+            job.cleanup()
+    
     return all_cvals
+
+
+
+def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_pcs=10,
+                                    gamma=.5, tol_perc=1e-06, perc_missing_allowed=.05,
+                                    make_zscore_vid=False, pool = DefaultPool()):
+    job = OutlierJob(inDir, use_link_db=use_link_db, robust=robust, num_pcs=num_pcs, gamma=gamma,
+                     tol_perc=tol_perc, perc_missing_allowed=perc_missing_allowed, make_zscore_vid=make_zscore_vid)
+    
+    logMsg("Starting processes")
+    stdout.flush()
+    try:
+        outlier_scores = mapByCost(pool, job.mahalFunc, job.tasks, job.costs) #Run all of the groups, using as much parallel computing as possible
+        return job.finish(outlier_scores, pool)
+    finally:
+        job.cleanup()
     
     #pool.close()
 
@@ -313,12 +512,23 @@ def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_
 def measureOutliersManyRegions():
     pool = Pool(8)
     k_vals = [1,2,3,4,5,6,7,8,9,10,15,20,25,30,35,40,45,50]
-    for k in k_vals:
-        dir_name = "features_imb20_k%d" % k
-        logMsg("==========BEGINNING ANALYSIS WITH %d REGIONS============" % k)
-        generateTimeSeriesOutlierScores(dir_name, use_link_db=False, num_pcs=10000000,
-                             robust=True, gamma="tune",  tol_perc="tune", perc_missing_allowed=.05,
-                             pool=pool)
+    
+    #Every k is read first, then all of their groups are run as one batch, so the pool is not left
+    #partly idle at the end of each k.  The results of each k are written as soon as its last group finishes
+    jobs = []
+    try:
+        for k in k_vals:
+            dir_name = "features_imb20_k%d" % k
+            logMsg("==========READING DATA WITH %d REGIONS============" % k)
+            jobs.append(OutlierJob(dir_name, use_link_db=False, num_pcs=10000000,
+                                 robust=True, gamma="tune",  tol_perc="tune", perc_missing_allowed=.05))
+        
+        logMsg("==========BEGINNING ANALYSIS OF ALL REGIONS============")
+        runOutlierJobs(jobs, pool)
+    finally:
+        #If reading a later k failed, the jobs which were already read still have their temporary files
+        for job in jobs:
+            job.cleanup()
         
 
 
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+A micro-cube of trips: the hourly sums of trip features (count, Σt, Σt², Σd, Σd², Σt²/d, ...) between the
+cells of a fine, fixed grid.  It is stored sparsely - one row for each hour and pair of cells that has trips.
+Since every feature of a pair of regions is computed from these sums, the features of any partition of the
+city into regions can be derived by adding up the rows of the cells in each region (see derive_features()),
+without reading the raw trip files again.
+"""
+import json
+import os
+import numpy as np
+
+from tools import *
+from trip import Trip
+from grid import tripBins, DRIVER_KEY_SIZE, HOUR_SECONDS
+from feature_store import WRITE_BUFFER_BYTES
+
+
+# A grid of roughly 100m x 100m cells which covers New York City: (lLon, rLon, nLon, bLat, tLat, nLat)
+NYC_GRID = (-74.05, -73.70, 300, 40.55, 40.95, 450)
+
+# The sums that are kept for each hour and pair of cells - these are the names of the HourAccumulator arrays
+SUM_FIELDS = ["numtrips", "s_time", "ss_time", "s_dist", "ss_dist", "ss_time_over_dist", "s_wind", "ss_wind"]
+
+# Files of a micro-cube
+HEADER_FILE = "cube.json"      # The grid, and whether drivers were kept
+KEYS_FILE = "keys.i8"          # int64 (hour, pair) of each row.  pair is fromCell*numCells + toCell
+SUMS_FILE = "sums.f8"          # float64 SUM_FIELDS of each row
+ERRORS_FILE = "errors.i8"      # int64 (hour, error_code, count) rows for trips which are not valid
+DRIVERS_FILE = "drivers.i8"    # int64 (hour, pair, driver) rows, one for each distinct driver of a pair in an hour
+
+
+
+# Gives the center of every cell of a grid
+# Params:
+    # grid - a tuple (lLon, rLon, nLon, bLat, tLat, nLat), like the arguments of GridSystem
+# Returns: (lons, lats)
+    # two arrays, with the center of each cell in the order of the cell ids (x*nLat + y)
+def cell_centers(grid):
+    (lLon, rLon, nLon, bLat, tLat, nLat) = grid
+    x = np.repeat(np.arange(nLon), nLat)
+    y = np.tile(np.arange(nLat), nLon)
+    return (lLon + (x + 0.5) * (rLon - lLon) / nLon, bLat + (y + 0.5) * (tLat - bLat) / nLat)
+
+
+# Gives the cell of a grid that contains each of many points
+# Params:
+    # grid - see cell_centers()
+    # lons, lats - arrays of coordinates
+# Returns:
+    # an int array of cell ids (x*nLat + y), with -1 wherever the point is outside of the grid
+def grid_cell_ids(grid, lons, lats):
+    (lLon, rLon, nLon, bLat, tLat, nLat) = grid
+    with np.errstate(invalid='ignore'):
+        x = np.floor((lons - lLon) * nLon / (rLon - lLon))
+        y = np.floor((lats - bLat) * nLat / (tLat - bLat))
+        inside = (x >= 0) & (x < nLon) & (y >= 0) & (y < nLat)
+    return np.where(inside, x * nLat + y, -1).astype(int)
+
+
+
+# Writes the trips of a TripChunk stream into a micro-cube.  Unlike a GridSystem, the trips do not need to be
+# in chronological order, since rows of the same hour and pair are simply added up by derive_features()
+class MicroCubeWriter:
+    # Params:
+        # dir_name - the directory of the micro-cube.  It is created if necessary
+        # grid - the fine grid of cells (see cell_centers())
+        # keep_drivers - if True, the distinct drivers of each pair and hour are kept, so the "drivers" features
+            # can be derived.  This takes about as much space as the sums
+    def __init__(self, dir_name, grid=NYC_GRID, keep_drivers=True):
+        if(not os.path.exists(dir_name)):
+            os.mkdir(dir_name)
+        with open(os.path.join(dir_name, HEADER_FILE), "w") as f:
+            json.dump({"grid":list(grid), "keep_drivers":keep_drivers}, f)
+
+        self.grid = grid
+        self.num_cells = grid[2] * grid[5]
+        self.keep_drivers = keep_drivers
+        self.files = {}
+        for filename in [KEYS_FILE, SUMS_FILE, ERRORS_FILE] + [DRIVERS_FILE]*keep_drivers:
+            self.files[filename] = open(os.path.join(dir_name, filename), "wb", WRITE_BUFFER_BYTES)
+
+        # Trips with has_other_error at the beginning of a chunk belong to the last hour of the previous chunk
+        self.last_hour = None
+
+    # Adds a chunk of trips to the cube
+    # Params:
+        # chunk - a TripChunk
+        # codes - the result of chunk.isValid(), if it has already been computed (it will not be modified)
+    def record_chunk(self, chunk, codes=None):
+        if(len(chunk)==0):
+            return
+        if(codes is None):
+            codes = chunk.isValid()
+        else:
+            codes = codes.copy()
+
+        # Like GridSystem.recordChunk(), valid trips outside of the grid (or with has_other_error) are ERR_OTHER
+        from_ids = grid_cell_ids(self.grid, chunk.fromLon, chunk.fromLat)
+        to_ids = grid_cell_ids(self.grid, chunk.toLon, chunk.toLat)
+        codes[(codes==Trip.VALID) & ((from_ids < 0) | (to_ids < 0) | chunk.has_other_error)] = Trip.ERR_OTHER
+
+        hours = tripBins(chunk, HOUR_SECONDS)
+        if(self.last_hour is not None):
+            hours[hours < 0] = self.last_hour
+        if(hours.max() >= 0):
+            self.last_hour = hours.max()
+
+        # Error counts, by hour and code
+        errors = np.flatnonzero((hours >= 0) & (codes != Trip.VALID))
+        if(len(errors) > 0):
+            num_codes = len(Trip.ERROR_NAMES)
+            (keys, inverse) = np.unique(hours[errors] * num_codes + codes[errors], return_inverse=True)
+            rows = np.column_stack([keys // num_codes, keys % num_codes, np.bincount(inverse)])
+            rows.astype("<i8").tofile(self.files[ERRORS_FILE])
+
+        valid = np.flatnonzero((hours >= 0) & (codes == Trip.VALID))
+        if(len(valid)==0):
+            return
+
+        # Sort the valid trips by (hour, pair), and add up the trips of each (hour, pair)
+        pairs = from_ids[valid].astype(np.int64) * self.num_cells + to_ids[valid]
+        order = np.lexsort((pairs, hours[valid]))
+        valid = valid[order]
+        (hours, pairs) = (hours[valid], pairs[order])
+        starts = np.flatnonzero(np.concatenate([[True], (hours[1:] != hours[:-1]) | (pairs[1:] != pairs[:-1])]))
+
+        time = chunk.time[valid].astype(float)
+        dist = chunk.dist[valid]
+        wind = chunk.winding_factor[valid]
+        weights = [np.ones(len(valid)), time, time**2, dist, dist**2, time**2 / dist, wind, wind**2]
+        sums = np.column_stack([np.add.reduceat(w, starts) for w in weights])
+
+        np.column_stack([hours[starts], pairs[starts]]).astype("<i8").tofile(self.files[KEYS_FILE])
+        sums.astype("<f8").tofile(self.files[SUMS_FILE])
+
+        # Distinct drivers of each (hour, pair)
+        if(self.keep_drivers):
+            rows = np.column_stack([hours, pairs, chunk.driver_id[valid]]).astype(np.int64)
+            rows = rows[np.lexsort((rows[:,2], rows[:,1], rows[:,0]))]
+            distinct = np.concatenate([[True], np.any(rows[1:] != rows[:-1], axis=1)])
+            rows[distinct].astype("<i8").tofile(self.files[DRIVERS_FILE])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+
+# Reads a micro-cube written by a MicroCubeWriter
+# Returns: (header, keys, sums, errors, drivers)
+    # header - a dictionary with the "grid" and "keep_drivers"
+    # keys, sums, errors, drivers - 2D arrays with the rows of each file (see the file constants above).
+        # drivers is None if the drivers were not kept
+def read_cube(dir_name):
+    with open(os.path.join(dir_name, HEADER_FILE), "r") as f:
+        header = json.load(f)
+    keys = np.fromfile(os.path.join(dir_name, KEYS_FILE), dtype="<i8").reshape((-1, 2))
+    sums = np.fromfile(os.path.join(dir_name, SUMS_FILE), dtype="<f8").reshape((-1, len(SUM_FIELDS)))
+    errors = np.fromfile(os.path.join(dir_name, ERRORS_FILE), dtype="<i8").reshape((-1, 3))
+    drivers = None
+    if(header["keep_drivers"]):
+        drivers = np.fromfile(os.path.join(dir_name, DRIVERS_FILE), dtype="<i8").reshape((-1, 3))
+    return (header, keys, sums, errors, drivers)
+
+
+# Sorts the rows of a table by hour, and finds the rows of each hour
+# Params:
+    # row_hours - the hour of each row
+    # hours - the sorted distinct hours to find
+# Returns: (order, starts, ends)
+    # order - the indexes of the rows, sorted by hour.  order[starts[i]:ends[i]] are the rows of hours[i]
+def group_by_hour(row_hours, hours):
+    order = np.argsort(row_hours, kind="mergesort")
+    starts = np.searchsorted(row_hours[order], hours, side="left")
+    ends = np.searchsorted(row_hours[order], hours, side="right")
+    return (order, starts, ends)
+
+
+# Derives the features of a region partition from micro-cubes, and writes them with a GridSystem (or RegionSystem)
+# Each cell of the cube is assigned to the region that contains its center
+# Params:
+    # cube_dirs - the directories of one or more micro-cubes (e.g. one per month), in chronological order
+    # grid_system - a new GridSystem, whose cells are the regions.  It writes the features like it would
+        # if the trips were recorded directly, and it is closed at the end.  Sketch mode is not supported, and
+        # its granularity must be one hour, since micro-cubes are binned by hour
+def derive_features(cube_dirs, grid_system):
+    if(grid_system.sketchDrivers):
+        raise ValueError("Driver sketches can't be derived from a micro-cube")
+    if(grid_system.binSeconds != HOUR_SECONDS):
+        raise ValueError("Micro-cubes are binned by hour, so the granularity must be one hour: " + str(grid_system.granularity))
+
+    num_regions = len(grid_system.cells)
+    cell_regions = None
+    for cube_dir in cube_dirs:
+        logMsg("Deriving features from " + cube_dir)
+        (header, keys, sums, errors, drivers) = read_cube(cube_dir)
+        if(cell_regions is None):
+            grid = tuple(header["grid"])
+            (lons, lats) = cell_centers(grid)
+            cell_regions = grid_system.getCellIds(lons, lats)
+            num_cells = len(cell_regions)
+        elif(tuple(header["grid"]) != grid):
+            raise ValueError("Grid of %s does not match %s" % (cube_dir, cube_dirs[0]))
+        if(drivers is None):
+            logMsg("WARNING: " + cube_dir + " has no drivers.  The drivers features will be 0")
+            drivers = np.zeros((0, 3), dtype=np.int64)
+
+        # Every row of the cube is mapped to a pair of regions, or -1 if either cell is outside of all regions
+        from_regions = cell_regions[keys[:,1] // num_cells]
+        to_regions = cell_regions[keys[:,1] % num_cells]
+        region_pairs = np.where((from_regions >= 0) & (to_regions >= 0), from_regions * num_regions + to_regions, -1)
+
+        driver_from = cell_regions[drivers[:,1] // num_cells]
+        driver_to = cell_regions[drivers[:,1] % num_cells]
+        driver_keys = np.where((driver_from >= 0) & (driver_to >= 0),
+                               (driver_from * num_regions + driver_to) * DRIVER_KEY_SIZE + drivers[:,2], -1)
+
+        hours = np.unique(np.concatenate([keys[:,0], errors[:,0]]))
+        (row_order, row_starts, row_ends) = group_by_hour(keys[:,0], hours)
+        (error_order, error_starts, error_ends) = group_by_hour(errors[:,0], hours)
+        (driver_order, driver_starts, driver_ends) = group_by_hour(drivers[:,0], hours)
+
+        for i in xrange(len(hours)):
+            hour = epochToDatetime(hours[i])
+            grid_system.advanceTime(hour, hour)
+            acc = grid_system.getAccumulator(hour)
+
+            rows = row_order[row_starts[i]:row_ends[i]]
+            inside = rows[region_pairs[rows] >= 0]
+            outside = rows[region_pairs[rows] < 0]
+            for (j, field) in enumerate(SUM_FIELDS):
+                getattr(acc, field)[:] += np.bincount(region_pairs[inside], weights=sums[inside,j], minlength=num_regions**2)
+
+            # Trips between cells outside of the regions are counted as ERR_OTHER, just like GridSystem.recordChunk()
+            hour_errors = errors[error_order[error_starts[i]:error_ends[i]]]
+            acc.error_counts += np.bincount(hour_errors[:,1], weights=hour_errors[:,2],
+                                            minlength=len(Trip.ERROR_NAMES)).astype(int)
+            acc.error_counts[Trip.VALID] += int(sums[inside,0].sum())
+            acc.error_counts[Trip.ERR_OTHER] += int(sums[outside,0].sum())
+
+            hour_keys = driver_keys[driver_order[driver_starts[i]:driver_ends[i]]]
+            acc.driver_keys.append(hour_keys[hour_keys >= 0])
+
+    grid_system.close()
+
+
+
+
+if(__name__=="__main__"):
+    # Derive the features of every partition from the micro-cubes written by extractRegionFeaturesParallel.py
+    # Usage: python micro_cube.py [cube_dir]  (defaults to extractRegionFeaturesParallel.MICRO_CUBE_DIR)
+    import sys
+    from routing.Map import Map
+    from regions import RegionSystem, buildRegionCache
+    from extractRegionFeaturesParallel import MICRO_CUBE_DIR
+    if(len(sys.argv) > 1):
+        MICRO_CUBE_DIR = sys.argv[1]
+    if(MICRO_CUBE_DIR is None):
+        raise ValueError("No micro-cube directory - pass one as an argument, or set MICRO_CUBE_DIR in extractRegionFeaturesParallel.py")
+    cube_dirs = sorted([os.path.join(MICRO_CUBE_DIR, d) for d in os.listdir(MICRO_CUBE_DIR)],
+                       key=lambda d: int(d.split("_")[-1]))
+    for k in [1,2,3,4,5,6,7,8,9,10,15,20,25,30,35,40,45,50]:
+        nodes_fn = 'nyc_map4/nodes_no_nj_imb20_k%d.csv' % k
+        links_fn = 'nyc_map4/links_no_nj_imb20_k%d.csv' % k
+        road_map = Map(nodes_fn, links_fn, limit_bbox=Map.reasonable_nyc_bbox)
+        region_system = RegionSystem('features_imb20_k%d' % k, road_map, buildRegionCache(road_map, nodes_fn))
+        derive_features(cube_dirs, region_system)
@@ -15,6 +15,7 @@ from multiprocessing import Pool
 
 
 from tools import *
+from trip_reader import find_compressed, open_trip_file
 BLOCK_SIZE=32
 NUM_PROCESSORS = 8
 
@@ -29,14 +30,15 @@ def code(orig, cipher):
 
 #Encrypt all medallions and hack_licenses in the file
 def processMonth((year, month, secret)):
-	tripInFile = "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
+	#The input files may be compressed (e.g. trip_data_1.csv.gz)
+	tripInFile = find_compressed("../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv")
 	tripOutFile = "../anon/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
-	fareInFile = "../new_chron/FOIL" + str(year) + "/trip_fare_" + str(month) + ".csv"
+	fareInFile = find_compressed("../new_chron/FOIL" + str(year) + "/trip_fare_" + str(month) + ".csv")
 	fareOutFile = "../anon/FOIL" + str(year) + "/trip_fare_" + str(month) + ".csv"
 	
-	tripInFp = open(tripInFile, "r")
+	tripInFp = open_trip_file(tripInFile)
 	tripOutFp = open(tripOutFile, "w")
-	fareInFp = open(fareInFile, "r")
+	fareInFp = open_trip_file(fareInFile)
 	fareOutFp = open(fareOutFile, "w")
 	
 	tripInCsv = csv.reader(tripInFp)
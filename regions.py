@@ -7,6 +7,9 @@ Created on Sat May  3 12:33:42 2014
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
 import csv
+import os
+import numpy as np
+from scipy.spatial import cKDTree
 from grid import *
 import Image
 
@@ -92,22 +95,121 @@ class ColorMap:
 
         return self.p_array[x][y]
 
+# Values stored in the GraphMap cache which are not region ids
+CACHE_UNKNOWN = -2    # The region of this pixel has not been computed yet
+NO_REGION = -1        # There is no region here
+
+# Scale factors which convert degrees of latitude and longitude into miles in NYC (see tools.approxdist_nyc)
+MILES_PER_LAT = 69.1703234284
+MILES_PER_LON = 52.3831781372
+
+
+# Gives the name of the file where the region cache of a road map is saved.  It is
+# stored next to the nodes file that the road map was loaded from
+# Params:
+    # nodes_fn - the nodes file of the Map (e.g. nyc_map4/nodes_no_nj_imb20_k10.csv)
+    # cache_size - the width and height of the cache, in pixels
+def regionCacheFilename(nodes_fn, cache_size=10000):
+    return "%s.regions%d.npy" % (nodes_fn, cache_size)
+
+
+# Computes the complete region cache for a road map and saves it, unless an up-to-date
+# copy already exists.  Afterwards, any number of processes can memory-map it read-only
+# via GraphMap(road_map, use_cache=True, cache_file=cache_file)
+# Params:
+    # road_map - a Map object, which must not be flattened
+    # nodes_fn - the nodes file that road_map was loaded from
+    # cache_size - the width and height of the cache, in pixels
+# Returns:
+    # the name of the cache file
+def buildRegionCache(road_map, nodes_fn, cache_size=10000):
+    cache_file = regionCacheFilename(nodes_fn, cache_size)
+    if(os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(nodes_fn)):
+        return cache_file
+    
+    logMsg("Computing region cache " + cache_file)
+    graph_map = GraphMap(road_map, use_cache=True, cache_size=cache_size)
+    graph_map.precomputeCache()
+    
+    # Write to a temporary file first, so other processes never see a partial cache
+    tmp_file = cache_file + ".tmp.npy"
+    np.save(tmp_file, graph_map.cache)
+    os.rename(tmp_file, cache_file)
+    return cache_file
+
+
 # Simple wrapper class, which stores a Map object, and can quickly find the
 # region id for a given coordinate, by examining the region_id of the nearest
 # node to that coordinate.  Has the same interface as ColorMap
+# The optional cache is a compact raster of region ids (int16) over the bounding box of the map.
+# Pixels are filled in as they are needed, or all at once with precomputeCache()
 class GraphMap:
-    def __init__(self, road_map, use_cache=False, cache_size=10000):
+    # Params:
+        # road_map - a Map object, whose nodes have region_ids
+        # use_cache - whether lookups should be cached in a raster
+        # cache_size - the width and height of the raster, in pixels
+        # cache_file - a file created by buildRegionCache().  If it exists, it is memory-mapped
+            # (read-only) instead of allocating a new raster
+    def __init__(self, road_map, use_cache=False, cache_size=10000, cache_file=None):
         self.road_map = road_map
+        self.node_tree = None
         
         if(use_cache):
             self.cache_size = cache_size
-            self.cache = [[None]*cache_size for x in xrange(cache_size)]
+            if(cache_file != None and os.path.exists(cache_file)):
+                self.cache = np.load(cache_file, mmap_mode='r')
+            else:
+                self.cache = np.empty((cache_size, cache_size), dtype=np.int16)
+                self.cache.fill(CACHE_UNKNOWN)
         else:
             self.cache = None
 
+    # Builds a KD-tree over the coordinates of all nodes, so many nearest-node
+    # queries can be answered at once.  Coordinates are scaled to miles first.
+    def buildNodeTree(self):
+        nodes = self.road_map.nodes
+        coords = np.array([(node.lat * MILES_PER_LAT, node.long * MILES_PER_LON) for node in nodes])
+        self.node_tree = cKDTree(coords)
+        self.node_regions = np.array([node.region_id for node in nodes], dtype=np.int16)
+
+    # Finds the region_id of the nearest node to many coordinates at once
+    # Params:
+        # lats - an array of latitudes
+        # lons - an array of longitudes
+    # Returns:
+        # an int16 array of region ids
+    def nearestRegions(self, lats, lons):
+        if(self.node_tree is None):
+            self.buildNodeTree()
+        _, nearest = self.node_tree.query(np.column_stack((lats * MILES_PER_LAT, lons * MILES_PER_LON)))
+        return self.node_regions[nearest]
+
+    # Gives the coordinates at the center of cache pixels
+    # Params:
+        # i - an array of pixel indexes in the longitude direction
+        # j - an array of pixel indexes in the latitude direction
+    # Returns:
+        # a tuple (lats, lons) of arrays
+    def pixelCenters(self, i, j):
+        mid_lon = (i+.5)/self.cache_size * (self.road_map.max_lon - self.road_map.min_lon) + self.road_map.min_lon
+        mid_lat = (j+.5)/self.cache_size * (self.road_map.max_lat - self.road_map.min_lat) + self.road_map.min_lat
+        return (mid_lat, mid_lon)
+
+    # Fills in every pixel of the cache which has not been computed yet, one block of rows at a time
+    def precomputeCache(self, rows_per_block=100):
+        j = np.arange(self.cache_size)
+        for lo in range(0, self.cache_size, rows_per_block):
+            hi = min(lo + rows_per_block, self.cache_size)
+            block = self.cache[lo:hi]
+            unknown_i, unknown_j = np.nonzero(block==CACHE_UNKNOWN)
+            if(len(unknown_i) > 0):
+                (lats, lons) = self.pixelCenters(unknown_i + lo, j[unknown_j])
+                block[unknown_i, unknown_j] = self.nearestRegions(lats, lons)
+            logPerc(hi, self.cache_size, 2)
+
     def regionAt(self, lat, lon):
         
-        if(self.cache==None):
+        if(self.cache is None):
             nearest_node = self.road_map.get_nearest_node(lat, lon)
             
             if(nearest_node==None):
@@ -120,14 +222,61 @@ class GraphMap:
             if(i < 0 or i >= self.cache_size or j < 0 or j >= self.cache_size):
                 return None
             
-            if(self.cache[i][j]==None):
-                mid_lon = (i+.5)/self.cache_size * (self.road_map.max_lon - self.road_map.min_lon) + self.road_map.min_lon
-                mid_lat = (j+.5)/self.cache_size * (self.road_map.max_lat - self.road_map.min_lat) + self.road_map.min_lat
-                nearest_node = self.road_map.get_nearest_node(mid_lat, mid_lon)
-                self.cache[i][j] = nearest_node.region_id 
-            return self.cache[i][j]
+            region = int(self.cache[i, j])
+            if(region==CACHE_UNKNOWN):
+                (mid_lat, mid_lon) = self.pixelCenters(i, j)
+                region = int(self.nearestRegions(np.array([mid_lat]), np.array([mid_lon]))[0])
+                # A memory-mapped cache is read-only, but it should already be complete
+                if(self.cache.flags.writeable):
+                    self.cache[i, j] = region
+            
+            if(region==NO_REGION):
+                return None
+            return region
                 
     
+    # Finds the regions of many coordinates at once (e.g. all of the pickups in a TripChunk)
+    # Gives the same answers as regionAt(), using the cache if there is one, and the KD-tree of nodes otherwise
+    # Params:
+        # lats - an array of latitudes
+        # lons - an array of longitudes
+    # Returns:
+        # an int array of region ids, with -1 (NO_REGION) for coordinates which are out of bounds
+    def regionsAt(self, lats, lons):
+        regions = np.empty(len(lats), dtype=int)
+        regions.fill(NO_REGION)
+        
+        lon_range = self.road_map.max_lon - self.road_map.min_lon
+        lat_range = self.road_map.max_lat - self.road_map.min_lat
+        
+        if(self.cache is None):
+            inside = ((lons >= self.road_map.min_lon) & (lons <= self.road_map.max_lon) &
+                      (lats >= self.road_map.min_lat) & (lats <= self.road_map.max_lat))
+            regions[inside] = self.nearestRegions(lats[inside], lons[inside])
+            return regions
+        
+        # Compute pixel coordinates the same way as regionAt() - int() truncates towards zero
+        with np.errstate(invalid='ignore'):
+            i = np.trunc(self.cache_size * (lons - self.road_map.min_lon) / lon_range)
+            j = np.trunc(self.cache_size * (lats - self.road_map.min_lat) / lat_range)
+            inside = (i >= 0) & (i < self.cache_size) & (j >= 0) & (j < self.cache_size)
+        i = i[inside].astype(int)
+        j = j[inside].astype(int)
+        
+        found = self.cache[i, j].astype(int)
+        
+        # Compute any pixels that are not in the cache yet
+        unknown = np.flatnonzero(found==CACHE_UNKNOWN)
+        if(len(unknown) > 0):
+            (mid_lats, mid_lons) = self.pixelCenters(i[unknown], j[unknown])
+            found[unknown] = self.nearestRegions(mid_lats, mid_lons)
+            # A memory-mapped cache is read-only, but it should already be complete
+            if(self.cache.flags.writeable):
+                self.cache[i[unknown], j[unknown]] = found[unknown]
+        
+        regions[inside] = found
+        return regions
+    
     def getCells(self):
         unique_regions = set()
         for node in self.road_map.nodes:
@@ -158,7 +307,16 @@ class RegionSystem(GridSystem):
     #Simple constructor, designed for NYC regions
     #Arguments:
         #dirName - the folder in which to output files
-    def __init__(self, dirName, road_map):
+        #road_map - a Map object whose nodes have region_ids
+        #cache_file - an optional precomputed region cache (see buildRegionCache())
+        #sketch_drivers - if True, unique drivers are estimated with bounded-memory sketches (see GridSystem)
+        #output_format - "csv", "binary", or "sparse" (see GridSystem)
+        #start_time, end_time - optional datetimes of the first and last hours to output (see GridSystem)
+        #reorder_hours - the number of hours to keep open for trips that arrive out of order (see GridSystem)
+        #granularity - a timedelta, the length of each row of features (see GridSystem)
+        #rollups - a list of coarser timedeltas, whose features are also output (see GridSystem)
+    def __init__(self, dirName, road_map, cache_file=None, sketch_drivers=False, output_format="csv", start_time=None, end_time=None,
+                 reorder_hours=0, granularity=HOUR_GRANULARITY, rollups=[]):
         
         """         
         #OLD CODE that manually specifies regions via an image file
@@ -172,12 +330,19 @@ class RegionSystem(GridSystem):
         self.regionMap = ColorMap(BOUNDARY_FILE_NAME, (-74.08339, 40.8493, -73.86366, 40.68289))        
         """      
         
-        self.regionMap = GraphMap(road_map, use_cache=True)
+        self.regionMap = GraphMap(road_map, use_cache=True, cache_file=cache_file)
         self.cells = self.regionMap.getCells()
         
         
         #Save the dirName
         self.dirName = dirName
+        self.sketchDrivers = sketch_drivers
+        self.outputFormat = output_format
+        self.startTime = start_time
+        self.endTime = end_time
+        self.reorderHours = reorder_hours
+        self.granularity = granularity
+        self.rollups = rollups
         
         #Open files for output
         self.begin()
@@ -200,6 +365,24 @@ class RegionSystem(GridSystem):
         #The cells are indexed by the color index
         return self.cells[region]
     
+    #Determines which cells many coordinates fall in (see GridSystem.getCellIds())
+    #Arguments:
+        #lons - an array of longitudes
+        #lats - an array of latitudes
+    #Returns:
+        #An int array of region ids (which are also indexes into self.cells), -1 for untracked regions
+    def getCellIds(self, lons, lats):
+        return self.regionsAt(lats, lons)
+    
+    #Determines the regions of many coordinates at once, e.g. all of the pickups in a TripChunk
+    #Arguments:
+        #lats - an array of latitudes
+        #lons - an array of longitudes
+    #Returns:
+        #An int array of region ids, -1 for coordinates that are not in any region
+    def regionsAt(self, lats, lons):
+        return self.regionMap.regionsAt(lats, lons)
+    
 #A simple unit test
 if(__name__=="__main__"):
     r = csv.reader(open("sample_data.csv", "r"))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+HyperLogLog sketches, which estimate the number of distinct items (e.g. drivers) in a set
+using a small, fixed amount of memory.  Two sketches can be merged (the union of the sets)
+by taking the element-wise maximum of their registers, so counts for days, weeks, or months
+can be computed from hourly sketches without re-reading the trips.
+"""
+import hashlib
+import numpy as np
+
+
+# Computes a 64-bit hash of each string.  Unlike hash(), the result does not depend on
+# the process or the platform, so sketches from different runs can be merged
+# Params:
+    # strings - a list of strings
+# Returns:
+    # a uint64 array, the same length as strings
+def hash_strings(strings):
+    digests = b"".join([hashlib.md5(s).digest()[:8] for s in strings])
+    return np.frombuffer(digests, dtype="<u8").astype(np.uint64)
+
+
+
+# Estimates the number of distinct items from the registers of one or more sketches
+# Params:
+    # registers - a uint8 array of registers.  The last axis has one element for each register
+# Returns:
+    # a float array of estimated counts, with one fewer axis than registers
+def estimate_counts(registers):
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+
+    # The raw HyperLogLog estimate (harmonic mean of 2^register)
+    estimates = alpha * m**2 / np.sum(np.ldexp(1.0, -registers.astype(int)), axis=-1)
+
+    # Small cardinalities are more accurate with linear counting (i.e. how many registers are still empty)
+    zeros = np.sum(registers==0, axis=-1)
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(float(m) / zeros)
+    return np.where((estimates <= 2.5*m) & (zeros > 0), linear, estimates)
+
+
+# Merges the sketches which have the same group key, e.g. to get daily counts from hourly sketches
+# Params:
+    # registers - a 2D uint8 array, with one row of registers for each sketch
+    # group_keys - an array with one key for each row (e.g. the date of each hour)
+# Returns: (keys, counts)
+    # keys - the sorted unique group keys
+    # counts - the estimated number of distinct items in each group
+def rollup_counts(registers, group_keys):
+    keys, groups = np.unique(group_keys, return_inverse=True)
+    order = np.argsort(groups, kind="mergesort")
+    starts = np.searchsorted(groups[order], np.arange(len(keys)))
+    merged = np.maximum.reduceat(registers[order], starts, axis=0)
+    return keys, estimate_counts(merged)
+
+
+# Reads sketches that were written to a file with HyperLogLog.write()
+# Params:
+    # filename - the file to read
+    # precision - the precision of the sketches in the file
+# Returns:
+    # a read-only 2D uint8 array, with one row of registers for each sketch in the file
+def read_sketches(filename, precision):
+    registers = np.fromfile(filename, dtype=np.uint8)
+    return registers.reshape((-1, 2**precision))
+
+
+
+# A set of HyperLogLog sketches, which can be updated with many items at once
+# Each sketch uses 2^precision bytes of memory, and has a relative error of about 1.04/sqrt(2^precision)
+class HyperLogLog:
+    # Params:
+        # num_sketches - the number of independent sketches (e.g. one for each pair of regions)
+        # precision - the number of hash bits which select a register, between 4 and 16
+    def __init__(self, num_sketches, precision):
+        self.precision = precision
+        self.registers = np.zeros((num_sketches, 2**precision), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.registers)
+
+    # Adds items to the sketches
+    # Params:
+        # sketch_ids - an int array, which gives the sketch that each item belongs to
+        # hashes - a uint64 array of item hashes (see hash_strings()), the same length as sketch_ids
+    def add(self, sketch_ids, hashes):
+        # The low bits pick a register.  The register remembers the longest run of leading zeros
+        # in the high 32 bits of any hash that it has seen
+        index = (hashes & np.uint64(2**self.precision - 1)).astype(np.intp)
+        high = (hashes >> np.uint64(32)).astype(float)
+        with np.errstate(divide='ignore'):
+            rank = np.where(high > 0, 32 - np.floor(np.log2(high)), 33).astype(np.uint8)
+        np.maximum.at(self.registers, (sketch_ids, index), rank)
+
+    # Merges another set of sketches into this one, sketch by sketch
+    # Params:
+        # other - a HyperLogLog with the same number of sketches and the same precision
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    # Returns:
+        # a float array with the estimated number of distinct items in each sketch
+    def count(self):
+        return estimate_counts(self.registers)
+
+    # Appends the registers of every sketch to an open binary file (see read_sketches())
+    def write(self, f):
+        self.registers.tofile(f)
@@ -7,10 +7,13 @@ Created on Sat May  3 12:33:42 2014
 @author: brian
 """
 from datetime import datetime, timedelta
+from functools import partial
+from itertools import imap
 import math
 import re
 #import psycopg2
 from numpy.linalg import norm
+import numpy as np
 import os
 
 program_start = datetime.now()
@@ -83,6 +86,18 @@ def approxdist_nyc((lat1,lon1), (lat2,lon2)):
 		return math.sqrt(squared)
 	else:
 		return 0
+
+#A vectorized version of approxdist_nyc(), which works on whole Numpy arrays of coordinates at once
+#Arguments:
+	#lat1, lon1 - arrays representing the first coordinates
+	#lat2, lon2 - arrays representing the second coordinates
+#Returns:
+	#An array of approximate distances in miles (0 wherever approxdist_nyc() would return 0)
+def approxdist_nyc_array(lat1, lon1, lat2, lon2):
+	squared = (4784.533643189461*(lat1-lat2)*(lat1-lat2) + 2743.9973517536278*(lon1-lon2)*(lon1-lon2))
+	
+	with np.errstate(invalid='ignore'):
+		return np.where(squared > 0, np.sqrt(np.maximum(squared, 0)), 0.0)
 	 
 #Normalizes a vector in-place
 #Arguments:
@@ -122,6 +137,26 @@ def roundTime(dt, granularity):
 	return start_time + rounded*granularity
 
 
+#Trip files contain naive (local) times - these are converted to integer seconds since this date
+EPOCH = datetime(year=1970, month=1, day=1)
+
+#Converts a datetime into integer seconds since EPOCH
+#Arguments:
+	#dt - a datetime object
+#Returns:
+	#an integer number of seconds
+def datetimeToEpoch(dt):
+	return int((dt - EPOCH).total_seconds())
+
+#Converts integer seconds since EPOCH back into a datetime
+#Arguments:
+	#seconds - an integer (or Numpy integer) number of seconds
+#Returns:
+	#a datetime object
+def epochToDatetime(seconds):
+	return EPOCH + timedelta(seconds=int(seconds))
+
+
 #Extracts column IDs from a table header
 #Arguments:
 	#header_row - a list of strings representing the header of a table
@@ -168,7 +203,64 @@ def allBut(l, x):
 #Returns:
 	#A datetime object
 def parseUtc(dateStr):
-	return datetime(year = int(dateStr[0:4]), month = int(dateStr[5:7]), day = int(dateStr[8:10]), hour = int(dateStr[11:13]), minute = int(dateStr[14:16]), second = int(dateStr[18:]))
+	return datetime(year = int(dateStr[0:4]), month = int(dateStr[5:7]), day = int(dateStr[8:10]), hour = int(dateStr[11:13]), minute = int(dateStr[14:16]), second = int(dateStr[17:19]))
+
+#Positions of the separators in a "YYYY-MM-DD HH:MM:SS" string - every other character is a digit
+UTC_SEPARATORS = {4:'-', 7:'-', 10:' ', 13:':', 16:':'}
+DIGIT_POSITIONS = [i for i in range(19) if not i in UTC_SEPARATORS]
+
+#Days before the first of each month, in a non-leap year
+DAYS_BEFORE_MONTH = np.array([0,0,31,59,90,120,151,181,212,243,273,304,334])
+DAYS_IN_MONTH = np.array([0,31,29,31,30,31,30,31,31,30,31,30,31])
+
+#Parses many "YYYY-MM-DD HH:MM:SS" strings at once, with digit arithmetic instead of datetime objects
+#Arguments:
+	#dateStrs - a list or array of strings
+#Returns:
+	#An int64 array of times, in seconds since EPOCH.  The hour of each time is simply (t // 3600) * 3600
+#Raises:
+	#ValueError if any of the strings is not a valid date and time (between the years 1970 and 2099)
+def parseUtcArray(dateStrs):
+	strs = np.asarray(dateStrs, dtype=str)
+	if(len(strs)==0):
+		return np.zeros(0, dtype=np.int64)
+	if(strs.dtype.itemsize != 19):
+		raise ValueError("Dates should have the format YYYY-MM-DD HH:MM:SS")
+	
+	#One row of characters per string.  Shorter strings are padded with zero bytes, which fail the checks below
+	chars = strs.view(np.uint8).reshape((len(strs), 19))
+	digits = chars - np.uint8(ord('0'))		#Wraps around (to > 9) for characters below '0'
+	if((digits.max(axis=0)[DIGIT_POSITIONS] > 9).any()):
+		raise ValueError("Dates should have the format YYYY-MM-DD HH:MM:SS")
+	for (i, sep) in UTC_SEPARATORS.items():
+		if((chars[:,i] != ord(sep)).any()):
+			raise ValueError("Dates should have the format YYYY-MM-DD HH:MM:SS")
+	
+	#Reads the number whose digits begin at position i
+	def number(i, length):
+		value = digits[:,i].astype(np.int32)
+		for j in range(i+1, i+length):
+			value = value*10 + digits[:,j]
+		return value
+	year = number(0, 4)
+	month = number(5, 2)
+	day = number(8, 2)
+	hour = number(11, 2)
+	minute = number(14, 2)
+	second = number(17, 2)
+	
+	#Check the ranges of each field, including the length of each month
+	#Between 1970 and 2099, every fourth year is a leap year
+	if(((year < 1970) | (year > 2099) | (month < 1) | (month > 12)).any()):
+		raise ValueError("Date out of range")
+	leap = (year%4==0)
+	if(((day < 1) | (day > DAYS_IN_MONTH[month] - (~leap & (month==2))) | (hour > 23) | (minute > 59) | (second > 59)).any()):
+		raise ValueError("Date out of range")
+	
+	#Days since EPOCH.  Leap days of the previous years are added, and this year's if it is past February
+	days = (year - 1970)*365 + (year - 1969)//4 + DAYS_BEFORE_MONTH[month] + (leap & (month > 2)) + day - 1
+	
+	return days.astype(np.int64)*86400 + hour*3600 + minute*60 + second
 
 
 
@@ -291,7 +383,42 @@ class DefaultPool():
     def map(self, fun, args):
         return map(fun, args)
     
+    def imap_unordered(self, fun, args, chunksize=1):
+        return imap(fun, args)
+    
     def close(self):
         pass
+
+
+# Calls a function, and gives back the index of its task with the result - see mapByCost()
+def indexedCall(fun, (i, arg)):
+    return (i, fun(arg))
+
+# Runs a function on many tasks with a Pool, starting with the most expensive tasks.  The tasks are
+# handed out one at a time (imap_unordered() with a chunksize of 1), so one slow task which starts
+# last does not leave the other processes idle at the end
+# Params:
+    # pool - a multiprocessing.Pool or a DefaultPool
+    # fun - the function to run.  It must be picklable (e.g. a module-level function or a partial of one)
+    # tasks - a list of arguments for fun
+    # costs - the estimated cost of each task.  Only their order matters
+# Returns:
+    # a list of the results, in the same order as tasks (like Pool.map())
+def mapByCost(pool, fun, tasks, costs):
+    results = [None] * len(tasks)
+    for (i, result) in imapByCost(pool, fun, tasks, costs):
+        results[i] = result
+    return results
+
+# Like mapByCost(), but gives each result as soon as it is ready
+# Returns:
+    # an iterator of (i, result) pairs, where i is the index of the task in tasks
+def imapByCost(pool, fun, tasks, costs):
+    order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)
+    return pool.imap_unordered(partial(indexedCall, fun), [(i, tasks[i]) for i in order], chunksize=1)
+
+# Calls the function of a (fun, arg) task - so tasks with different functions can share one imapByCost()
+def applyTask((fun, arg)):
+    return fun(arg)
     
 	
\ No newline at end of file
@@ -6,6 +6,8 @@ Created on Wed Aug  6 14:17:57 2014
 
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
+import numpy as np
+
 from tools import *
 
 #A single taxi trip - contains information such as coordinates, times, etc...
@@ -92,6 +94,9 @@ class Trip:
     ERR_DATE = 23
     ERR_OTHER = 24
     
+    #Names of the error codes above, in order - these are used as column names in the output files
+    ERROR_NAMES = ['VALID','BAD_GPS','ERR_GPS','BAD_LO_STRAIGHTLINE','BAD_HI_STRAIGHTLINE','ERR_LO_STRAIGHTLINE','ERR_HI_STRAIGHTLINE','BAD_LO_DIST','BAD_HI_DIST','ERR_LO_DIST','ERR_HI_DIST','BAD_LO_WIND','BAD_HI_WIND','ERR_LO_WIND','ERR_HI_WIND','BAD_LO_TIME','BAD_HI_TIME','ERR_LO_TIME','ERR_HI_TIME','BAD_LO_PACE','BAD_HI_PACE','ERR_LO_PACE','ERR_HI_PACE','ERR_DATE','ERR_OTHER']
+    
     #This method implements data filtering
     #Tells whether the trip is valid, by applying various thresholds to the features.
     #Returns: An integer error code.  0 means it is a valid trip, 1-24 are different types of errors, listed above
@@ -190,3 +195,137 @@ class Trip:
         
         s = "<<TRIP>>\n" + "driver " + self.driver_id + "\ntime " + str(self.time) + "\n" + "dist " + str(self.dist) + "\n"
         return s
+
+
+
+#Trips picked up between these times (in seconds since tools.EPOCH) are given the ERR_DATE code
+#I.E. August and September of 2010 - see Trip.isValid()
+ERR_DATE_START = datetimeToEpoch(datetime(2010, 8, 1))
+ERR_DATE_END = datetimeToEpoch(datetime(2010, 10, 1))
+
+#Counts the number of trips with each error code
+#Arguments:
+    #codes - an array of error codes, such as the output of TripChunk.isValid()
+#Returns:
+    #An array with one count for each code in Trip.ERROR_NAMES
+def countErrorCodes(codes):
+    return np.bincount(codes, minlength=len(Trip.ERROR_NAMES))
+
+
+#Many taxi trips, stored as parallel Numpy column arrays rather than one Trip object per trip
+#Holds the same features as Trip (time, pace, straightline distance, winding factor), but they are
+#computed with whole-array expressions.  Chunks are normally built by trip_reader.read_trip_chunks()
+class TripChunk:
+    #Arguments:
+        #fromLon, fromLat, toLon, toLat - float arrays of pickup and dropoff coordinates (in degrees)
+        #dist - float array of metered distances (in miles)
+        #pickup_time, dropoff_time - int64 arrays of times, in seconds since tools.EPOCH
+        #medallion, driver_id - int32 arrays of codes for the medallion and hack_license strings (see trip_reader.IdCodebook)
+        #driver_hash - an optional uint64 array of hack_license hashes, for counting distinct drivers with sketches.HyperLogLog
+    def __init__(self, fromLon, fromLat, toLon, toLat, dist, pickup_time, dropoff_time, medallion, driver_id, driver_hash=None):
+        self.fromLon = fromLon
+        self.fromLat = fromLat
+        self.toLon = toLon
+        self.toLat = toLat
+        self.dist = dist
+        
+        self.pickup_time = pickup_time
+        self.dropoff_time = dropoff_time
+        self.medallion = medallion
+        self.driver_id = driver_id
+        self.driver_hash = driver_hash
+        
+        #Duration in seconds
+        self.time = dropoff_time - pickup_time
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            #Pace is 0 wherever the distance is 0, just like Trip
+            self.pace = np.where(dist==0, 0.0, self.time / dist)
+            
+            self.straight_line_dist = approxdist_nyc_array(fromLat, fromLon, toLat, toLon)
+            
+            #Winding factor is 1 wherever the straightline distance is not positive, just like Trip
+            self.winding_factor = np.where(self.straight_line_dist <= 0, 1.0, dist / self.straight_line_dist)
+        
+        #Flags trips with errors that can't be found from the trip itself (e.g. trips in the wrong month file)
+        self.has_other_error = np.zeros(len(dist), dtype=bool)
+    
+    def __len__(self):
+        return len(self.dist)
+    
+    #Vectorized version of Trip.isValid().  Applies exactly the same thresholds, in the same order,
+    #so every trip receives the same error code that Trip.isValid() would give it
+    #Returns: An int8 array of error codes, one for each trip.  0 means a valid trip, 1-24 are the errors listed in Trip
+    def isValid(self):
+        toLat, fromLat, toLon, fromLon = self.toLat, self.fromLat, self.toLon, self.fromLon
+        
+        #Each check is a boolean array, paired with the error code that it produces
+        #A trip gets the code of the FIRST check that it fails
+        checks = [
+            #These two months contain a very high number of errors, so they cannot be trusted
+            ((self.pickup_time >= ERR_DATE_START) & (self.pickup_time < ERR_DATE_END), Trip.ERR_DATE),
+            
+            #GPS coordinates (in degrees) not reasonable
+            ((toLat < 40.4) | (fromLat < 40.4) | (toLat > 41.1) | (fromLat > 41.1) |
+             (toLon < -74.25) | (fromLon < -74.25) | (toLon > -73.5) | (fromLon > -73.5), Trip.ERR_GPS),
+            
+            #Distance between start and end coordinates (in miles) not reasonable
+            (self.straight_line_dist < .001, Trip.ERR_LO_STRAIGHTLINE),
+            (self.straight_line_dist > 20, Trip.ERR_HI_STRAIGHTLINE),
+            
+            #Metered distance (in miles) not reasonable
+            (self.dist < .001, Trip.ERR_LO_DIST),
+            (self.dist > 20, Trip.ERR_HI_DIST),
+            
+            #Winding factor must be >= 1, with some room for rounding errors and GPS noise
+            (self.winding_factor < .95, Trip.ERR_LO_WIND),
+            
+            #Unreasonable trip time (in seconds)
+            (self.time < 10, Trip.ERR_LO_TIME),
+            (self.time > 7200, Trip.ERR_HI_TIME),
+            
+            #Unreasonable pace (in second/mile)
+            (self.pace < 10, Trip.ERR_LO_PACE),
+            (self.pace > 7200, Trip.ERR_HI_PACE),
+            
+            #Restrict analysis to Manhattan and a small surrounding area
+            ((toLat < 40.6) | (fromLat < 40.6) | (toLat > 40.9) | (fromLat > 40.9) |
+             (toLon < -74.05) | (fromLon < -74.05) | (toLon > -73.7) | (fromLon > -73.7), Trip.BAD_GPS),
+            
+            #Really long trips (in miles) are not representative
+            (self.straight_line_dist > 8, Trip.BAD_HI_STRAIGHTLINE),
+            (self.dist > 15, Trip.BAD_HI_DIST),
+            
+            #A high winding factor indicates that the taxi did not proceed directly to its destination
+            (self.winding_factor > 5, Trip.BAD_HI_WIND),
+            
+            #Really short or really long trips are not representative
+            (self.time < 60, Trip.BAD_LO_TIME),
+            (self.time > 3600, Trip.BAD_HI_TIME),
+            
+            #These speeds are technically possible, but not indicative of overall traffic
+            (self.pace < 40, Trip.BAD_LO_PACE),
+            (self.pace > 3600, Trip.BAD_HI_PACE)]
+        
+        codes = np.zeros(len(self), dtype=np.int8)
+        unassigned = np.ones(len(self), dtype=bool)
+        for (failed, error_code) in checks:
+            codes[unassigned & failed] = error_code
+            unassigned &= ~failed
+        
+        return codes
+    
+    #Selects some of the trips in this chunk
+    #Arguments:
+        #rows - a boolean mask or an array of indexes
+    #Returns:
+        #A new TripChunk which contains only the selected trips
+    def subset(self, rows):
+        driver_hash = None
+        if(self.driver_hash is not None):
+            driver_hash = self.driver_hash[rows]
+        chunk = TripChunk(self.fromLon[rows], self.fromLat[rows], self.toLon[rows], self.toLat[rows],
+                          self.dist[rows], self.pickup_time[rows], self.dropoff_time[rows],
+                          self.medallion[rows], self.driver_id[rows], driver_hash)
+        chunk.has_other_error = self.has_other_error[rows]
+        return chunk
@@ -0,0 +1,882 @@
+# -*- coding: utf-8 -*-
+"""
+Reads raw taxi trip files in large blocks of lines, and parses each block into a
+TripChunk (a set of Numpy column arrays) instead of building one Trip object per line.
+"""
+import bz2
+import collections
+import csv
+import gzip
+import io
+import json
+import os
+import Queue
+import shutil
+import struct
+import sys
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+# The lzma module (for .xz files) is only in the standard library of Python 3 - it's optional here
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from tools import *
+from trip import TripChunk
+from sketches import hash_strings
+
+
+# Location of the raw trip data - see README.md
+DATA_DIR = "../new_chron"
+
+# Approximate number of bytes of the file that are parsed into each TripChunk
+# (roughly 100,000 trips)
+DEFAULT_CHUNK_BYTES = 16*1024*1024
+
+# Every line of a trip_data file has these 14 columns:
+# medallion, hack_license, vendor_id, rate_code, store_and_fwd_flag, pickup_datetime,
+# dropoff_datetime, passenger_count, trip_time_in_secs, trip_distance, pickup_longitude,
+# pickup_latitude, dropoff_longitude, dropoff_latitude
+NUM_TRIP_COLUMNS = 14
+MEDALLION, HACK_LICENSE = 0, 1
+PICKUP_DATETIME, DROPOFF_DATETIME = 5, 6
+TRIP_DISTANCE = 9
+PICKUP_LONGITUDE, PICKUP_LATITUDE, DROPOFF_LONGITUDE, DROPOFF_LATITUDE = 10, 11, 12, 13
+FLOAT_COLUMNS = [TRIP_DISTANCE, PICKUP_LONGITUDE, PICKUP_LATITUDE, DROPOFF_LONGITUDE, DROPOFF_LATITUDE]
+
+
+
+# Gives the name of the raw trip file for a given month
+# If the plain .csv file does not exist, but a compressed copy does (e.g. trip_data_1.csv.gz), that is used instead
+# Params:
+    # year - an integer, 2010 through 2013
+    # month - an integer, 1 through 12
+# Returns:
+    # the filename, as a string
+def trip_filename(year, month):
+    return find_compressed(DATA_DIR + "/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv")
+
+
+
+# Extensions of compressed files, and the magic bytes at the beginning of each format
+COMPRESSED_EXTENSIONS = {".gz":"gzip", ".bgz":"gzip", ".bz2":"bz2", ".xz":"xz"}
+MAGIC_BYTES = [("\x1f\x8b", "gzip"), ("BZh", "bz2"), ("\xfd7zXZ\x00", "xz")]
+
+# Number of threads used to decompress a block-compressed (bgzip) file
+DECOMPRESS_THREADS = 4
+
+
+# Finds a file, or a compressed copy of it
+# Params:
+    # filename - the name of the uncompressed file
+# Returns:
+    # filename if it exists, otherwise the first of filename + ".gz", ".bz2", ".xz" (etc...) that exists.
+    # If none of them exist, filename
+def find_compressed(filename):
+    if(os.path.exists(filename)):
+        return filename
+    for extension in sorted(COMPRESSED_EXTENSIONS):
+        if(os.path.exists(filename + extension)):
+            return filename + extension
+    return filename
+
+
+# Removes the compression extension (if any) from a filename, e.g. trip_data_1.csv.gz --> trip_data_1.csv
+def strip_compression(filename):
+    (base, extension) = os.path.splitext(filename)
+    if(extension in COMPRESSED_EXTENSIONS):
+        return base
+    return filename
+
+
+# Determines the compression format of a file from its magic bytes (or its extension, if it is empty)
+# Returns:
+    # "plain", "gzip", "bgzip" (block gzip, which can be decompressed in parallel), "bz2", or "xz"
+def compression_format(filename):
+    with open(filename, 'rb') as f:
+        header = f.read(18)
+    if(len(header)==0):
+        return COMPRESSED_EXTENSIONS.get(os.path.splitext(filename)[1], "plain")
+
+    for (magic, file_format) in MAGIC_BYTES:
+        if(header.startswith(magic)):
+            # A bgzip file is a series of gzip members, whose extra field holds the size of the block
+            if(file_format=="gzip" and is_bgzf_header(header)):
+                return "bgzip"
+            return file_format
+    return "plain"
+
+
+# Opens a trip file for reading in binary mode, decompressing it if necessary
+# Compressed files can only be read from the beginning - they can't be split into byte ranges
+# Params:
+    # filename - a plain or compressed (.gz, .bz2, .xz, or bgzip) file
+    # threads - the number of threads used to decompress a bgzip file
+# Returns:
+    # a file-like object, which supports read(), readline(), and readlines()
+def open_trip_file(filename, threads=DECOMPRESS_THREADS):
+    file_format = compression_format(filename)
+    if(file_format=="gzip"):
+        return gzip.open(filename, 'rb')
+    if(file_format=="bgzip"):
+        return io.BufferedReader(BgzfReader(open(filename, 'rb'), threads), DEFAULT_CHUNK_BYTES)
+    if(file_format=="bz2"):
+        return bz2.BZ2File(filename, 'rb')
+    if(file_format=="xz"):
+        if(lzma is None):
+            raise IOError("Reading .xz files requires the lzma module (pip install backports.lzma): " + filename)
+        return lzma.LZMAFile(filename, 'rb')
+    return open(filename, 'rb')
+
+
+# Tells whether a file can be read starting from any byte (i.e. it is not compressed)
+def is_seekable(filename):
+    return compression_format(filename)=="plain"
+
+
+# Tells whether a gzip header (at least 18 bytes) belongs to a BGZF block, i.e. its extra field has a "BC" subfield
+def is_bgzf_header(header):
+    FEXTRA = 4
+    return (ord(header[3]) & FEXTRA) and header[12:14]=="BC"
+
+
+# Reads a BGZF (bgzip) file - a series of independent gzip blocks of up to 64KB each.
+# Batches of blocks are decompressed in parallel by a pool of threads (zlib releases the GIL)
+class BgzfReader(io.RawIOBase):
+    # Params:
+        # f - the compressed file, opened in binary mode
+        # threads - the number of decompression threads
+    def __init__(self, f, threads):
+        self.f = f
+        self.pool = ThreadPool(threads)
+        self.batch_size = threads * 16
+        self.buffers = collections.deque()
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    # Reads the next compressed block
+    # Returns:
+        # the raw deflate data of the block, or None at the end of the file
+    def read_block(self):
+        header = self.f.read(18)
+        if(len(header) < 18):
+            return None
+        if(not header.startswith("\x1f\x8b") or not is_bgzf_header(header)):
+            raise IOError("Corrupt bgzip block")
+        extra_length = struct.unpack("<H", header[10:12])[0]
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        rest = self.f.read(block_size - 18)
+        # The data sits between the extra field and the CRC32 and ISIZE fields
+        return rest[extra_length - 6:-8]
+
+    # Decompresses the next batch of blocks into self.buffers
+    def fill(self):
+        blocks = []
+        while(len(blocks) < self.batch_size):
+            block = self.read_block()
+            if(block is None):
+                self.finished = True
+                break
+            blocks.append(block)
+        self.buffers.extend(self.pool.map(inflate_raw, blocks))
+
+    def readinto(self, b):
+        while(len(self.buffers)==0 or len(self.buffers[0])==0):
+            if(len(self.buffers) > 0):
+                self.buffers.popleft()
+            elif(self.finished):
+                return 0
+            else:
+                self.fill()
+
+        data = self.buffers[0]
+        n = min(len(b), len(data))
+        b[:n] = data[:n]
+        self.buffers[0] = data[n:]
+        return n
+
+    def close(self):
+        if(not self.closed):
+            self.pool.close()
+            self.f.close()
+        io.RawIOBase.close(self)
+
+
+# Decompresses raw deflate data (without a zlib or gzip header)
+def inflate_raw(data):
+    return zlib.decompress(data, -zlib.MAX_WBITS)
+
+
+
+# Assigns a small integer code to every distinct string that it sees (e.g. hack_licenses).
+# The same string always receives the same code, as long as the same IdCodebook is used.
+# Each string also gets a 64-bit hash, which is the same in every IdCodebook (see sketches.py)
+class IdCodebook:
+    def __init__(self):
+        self.codes = {}   # string --> code
+        self.keys = []    # code --> string
+        self.hashes = np.zeros(0, dtype=np.uint64)  # code --> hash
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Encodes an array of strings, adding new strings to the codebook if necessary
+    # Params:
+        # strings - a Numpy array of strings
+    # Returns:
+        # an int32 array of codes, the same length as strings
+    def encode(self, strings):
+        # Only the distinct strings need to be looked up in the dictionary
+        uniques, inverse = np.unique(strings, return_inverse=True)
+        unique_codes = np.empty(len(uniques), dtype=np.int32)
+        num_known = len(self.keys)
+        for i, key in enumerate(uniques.tolist()):
+            code = self.codes.get(key)
+            if(code is None):
+                code = len(self.keys)
+                self.codes[key] = code
+                self.keys.append(key)
+            unique_codes[i] = code
+
+        if(len(self.keys) > num_known):
+            self.hashes = np.concatenate([self.hashes, hash_strings(self.keys[num_known:])])
+
+        return unique_codes[inverse]
+
+
+
+# Converts an array of "YYYY-MM-DD HH:MM:SS" strings into seconds since tools.EPOCH
+# Raises a ValueError if any of the strings cannot be parsed
+def parse_times(strings):
+    return parseUtcArray(strings)
+
+
+# Builds a TripChunk from lists of columns (i.e. the transpose of a list of CSV rows)
+# Raises a ValueError if any of the values cannot be parsed
+def columns_to_chunk(columns, codebook):
+    [dist, fromLon, fromLat, toLon, toLat] = [np.array(columns[c]).astype(float) for c in FLOAT_COLUMNS]
+    pickup_time = parse_times(columns[PICKUP_DATETIME])
+    dropoff_time = parse_times(columns[DROPOFF_DATETIME])
+
+    medallion = codebook.encode(np.array(columns[MEDALLION]))
+    driver_id = codebook.encode(np.array(columns[HACK_LICENSE]))
+
+    return TripChunk(fromLon, fromLat, toLon, toLat, dist, pickup_time, dropoff_time,
+                     medallion, driver_id, driver_hash=codebook.hashes[driver_id])
+
+
+# Tests whether a list of CSV rows can all be parsed, i.e. columns_to_chunk() would not raise a ValueError
+def rows_parse(rows):
+    columns = zip(*rows)
+    try:
+        for c in FLOAT_COLUMNS:
+            np.array(columns[c]).astype(float)
+        parse_times(columns[PICKUP_DATETIME])
+        parse_times(columns[DROPOFF_DATETIME])
+        return True
+    except ValueError:
+        return False
+
+
+# Finds the CSV rows that can be parsed.  This is only used when a chunk contains a bad value, so the
+# offending rows can be discarded.  The rows are split in half until the bad ones are isolated, so a few
+# bad rows only cost a few extra (vectorized) parses
+# Returns:
+    # a list of the indexes of the rows which can be parsed
+def find_parseable_rows(rows, first=0):
+    if(len(rows)==0):
+        return []
+    if(rows_parse(rows)):
+        return range(first, first + len(rows))
+    if(len(rows)==1):
+        return []
+    half = len(rows) // 2
+    return find_parseable_rows(rows[:half], first) + find_parseable_rows(rows[half:], first + half)
+
+
+# Parses a block of lines from a trip file into a TripChunk.  Lines that cannot
+# be parsed are skipped (just like a Trip which raises a ValueError)
+# Params:
+    # lines - a list of strings, each of which is one line of a trip_data file
+    # codebook - an IdCodebook which is used to encode medallions and hack_licenses
+# Returns:
+    # a TripChunk, or None if none of the lines could be parsed
+def parse_trip_lines(lines, codebook):
+    (chunk, line_numbers) = parse_trip_lines_numbered(lines, codebook)
+    return chunk
+
+
+# Same as parse_trip_lines(), but also tells which lines were parsed
+# Returns: (chunk, line_numbers)
+    # chunk - a TripChunk, or None if none of the lines could be parsed
+    # line_numbers - a list with the index (in lines) of each trip in the chunk
+def parse_trip_lines_numbered(lines, codebook):
+    numbered_rows = [(i, row) for (i, row) in enumerate(csv.reader(lines)) if len(row)==NUM_TRIP_COLUMNS]
+    if(len(numbered_rows)==0):
+        return (None, [])
+
+    try:
+        chunk = columns_to_chunk(zip(*[row for (i, row) in numbered_rows]), codebook)
+    except ValueError:
+        # At least one line is malformed - parse the rest of them
+        numbered_rows = [numbered_rows[j] for j in find_parseable_rows([row for (i, row) in numbered_rows])]
+        if(len(numbered_rows)==0):
+            return (None, [])
+        chunk = columns_to_chunk(zip(*[row for (i, row) in numbered_rows]), codebook)
+
+    return (chunk, [i for (i, row) in numbered_rows])
+
+
+# Reads blocks of whole lines from a trip_data file
+# Params:
+    # filename - the trip_data file to be read.  The first line is a header, and will be skipped
+    # chunk_bytes - the approximate size of each block, in bytes
+    # start, end - an optional byte range of the file to read (see read_trip_chunks())
+# Yields: (offset, lines)
+    # offset - the byte offset of the first line of the block
+    # lines - a list of strings, one for each line
+def read_line_blocks(filename, chunk_bytes=DEFAULT_CHUNK_BYTES, start=0, end=None):
+    with open_trip_file(filename) as f:
+        if(start==0):
+            # Discard the header
+            position = len(f.readline())
+        elif(is_seekable(filename)):
+            f.seek(start)
+            position = start
+        else:
+            # A compressed file has to be decompressed up to the start of the range
+            position = 0
+            while(position < start):
+                skipped = len(f.read(min(start - position, chunk_bytes)))
+                if(skipped==0):
+                    break
+                position += skipped
+
+        while(end is None or position < end):
+            lines = f.readlines(chunk_bytes)
+            if(len(lines)==0):
+                break
+
+            # Only keep the lines which end within the range
+            offset = position
+            lengths = np.cumsum([len(line) for line in lines])
+            if(end is not None and position + lengths[-1] > end):
+                lines = lines[:np.searchsorted(lengths, end - position, side='right')]
+                position = end
+            else:
+                position += lengths[-1]
+
+            yield (offset, lines)
+
+
+# Reads a trip_data file, one large block of lines at a time
+# If the file has an up-to-date trip cache (see build_trip_cache()), the trips are read from the cache instead
+# Params:
+    # filename - the trip_data file to be read.  The first line is a header, and will be skipped
+    # chunk_bytes - the approximate size of each block, in bytes
+    # codebook - an IdCodebook for medallions and hack_licenses.  Should be shared if
+        # codes need to be consistent between several files
+    # start, end - an optional byte range of the file to read, e.g. a shard from plan_shards().
+        # Both should be at the beginning of a line.  By default, the whole file is read
+    # prefetch_depth - if positive, the file is read by a background thread, which stays up to this many
+        # blocks ahead of the parsing (see prefetch())
+# Yields:
+    # TripChunks, in the same order as the lines of the file
+def read_trip_chunks(filename, chunk_bytes=DEFAULT_CHUNK_BYTES, codebook=None, start=0, end=None, prefetch_depth=0):
+    if(codebook is None):
+        codebook = IdCodebook()
+
+    cache = load_trip_cache(filename)
+    if(cache is not None):
+        rows = cache.row_range(start, end)
+        if(rows is not None):
+            for chunk in prefetch(cache.read_chunks(codebook, rows[0], rows[1], chunk_bytes // CSV_BYTES_PER_ROW), prefetch_depth):
+                yield chunk
+            return
+
+    for (offset, lines) in prefetch(read_line_blocks(filename, chunk_bytes, start, end), prefetch_depth):
+        chunk = parse_trip_lines(lines, codebook)
+        if(chunk is not None):
+            yield chunk
+
+
+# Runs an iterator in a background thread, which stays up to depth items ahead of the consumer
+# This lets disk reads (and decompression) overlap with the processing of earlier items
+# Params:
+    # items - an iterator, e.g. read_line_blocks()
+    # depth - the maximum number of items waiting in the queue.  If it is 0, items are not prefetched
+# Yields:
+    # the same items, in the same order.  If the iterator raises an exception, it is raised here
+def prefetch(items, depth):
+    if(depth <= 0):
+        for item in items:
+            yield item
+        return
+
+    queue = Queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    # Puts a message in the queue, unless the consumer has stopped
+    def put(message):
+        while(not stopped.is_set()):
+            try:
+                queue.put(message, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if(not put(("item", item))):
+                    return
+            put(("end", None))
+        except Exception:
+            put(("error", sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while(True):
+            (kind, value) = queue.get()
+            if(kind=="end"):
+                break
+            if(kind=="error"):
+                raise value[0], value[1], value[2]
+            yield value
+    finally:
+        # Stops the thread if the consumer gives up early (e.g. the generator is closed)
+        stopped.set()
+
+
+
+# Gives the pickup hour of a line from a trip_data file, as a "YYYY-MM-DD HH" string
+# (which sorts chronologically), or None if the line does not have a pickup time
+def line_pickup_hour(line):
+    columns = line.split(",", PICKUP_DATETIME + 1)
+    if(len(columns) <= PICKUP_DATETIME or not columns[PICKUP_DATETIME][:4].isdigit()):
+        return None
+    return columns[PICKUP_DATETIME][:13]
+
+
+# Finds the first line at or after an offset which begins a new hour - i.e. its pickup hour is later
+# than the pickup hour of every line in the lookback window before it.  Splitting the file there
+# keeps each hour in one shard, even though a few trips are slightly out of order
+# Params:
+    # f - a trip_data file, opened in binary mode
+    # offset - the byte offset to start searching from
+    # lookback_bytes - the size of the window before offset which is used to find the current hour
+    # valid_hours - a (first, last) pair of "YYYY-MM-DD HH" strings.  Lines outside of this range
+        # (e.g. trips in the wrong month file) are ignored
+# Returns: (boundary, hour)
+    # boundary - the byte offset of the first line of the new hour, or None if the end of the file was reached
+    # hour - the pickup time of that line, rounded down to the hour, in seconds since tools.EPOCH
+def find_hour_boundary(f, offset, lookback_bytes, valid_hours):
+    # Move to the beginning of a line inside of the lookback window
+    f.seek(max(offset - lookback_bytes, 0))
+    f.readline()
+
+    current_hour = None
+    while(True):
+        position = f.tell()
+        line = f.readline()
+        if(line==""):
+            return (None, None)
+
+        hour = line_pickup_hour(line)
+        if(hour is None or hour < valid_hours[0] or hour > valid_hours[1]):
+            continue
+
+        if(current_hour is None or hour > current_hour):
+            # A malformed time (e.g. "2012-03-01 99") could sort after every real hour, so it is never
+            # accepted as the current hour (the same as build_hour_index())
+            try:
+                hour_time = parse_times([hour + ":00:00"])[0]
+            except ValueError:
+                continue
+            if(position >= offset and current_hour is not None):
+                return (position, hour_time)
+            current_hour = hour
+
+
+# Splits a trip_data file into byte ranges that can be processed in parallel, at hour transitions
+# Every shard contains whole hours (besides trips that are out of order), so shards can be processed
+# independently by GridSystems, and their outputs can be concatenated in order
+# Params:
+    # filename - the trip_data file to split
+    # num_shards - the desired number of shards.  Fewer may be returned for small files
+    # start_time, end_time - the time range of trips that belong in this file, in seconds since tools.EPOCH.
+        # Trips outside of this range do not create hour boundaries
+    # lookback_bytes - see find_hour_boundary()
+    # align_seconds - shards only begin at times which are a multiple of this many seconds since tools.EPOCH,
+        # e.g. 86400 keeps each day in one shard, so daily rollups (see grid.Rollup) are not split
+# Returns:
+    # a list of (start, end, start_hour) tuples, in the order of the file.  start and end are byte
+    # offsets (end is None for the last shard).  start_hour is the first hour of the shard, in seconds
+    # since tools.EPOCH, or None for the first shard.  If there are fewer than num_shards, a message is logged
+def plan_shards(filename, num_shards, start_time, end_time, lookback_bytes=64*1024, align_seconds=3600):
+    # Every shard of a compressed file would have to decompress everything before it
+    if(not is_seekable(filename)):
+        return [(0, None, None)]
+
+    size = os.path.getsize(filename)
+    valid_hours = (epochToDatetime(start_time).strftime("%Y-%m-%d %H"),
+                   epochToDatetime(end_time - 1).strftime("%Y-%m-%d %H"))
+    boundaries = [(0, None)]
+    index = load_hour_index(filename)
+    with open(filename, 'rb') as f:
+        for i in range(1, num_shards):
+            offset = size * i // num_shards
+            while(True):
+                if(index is not None):
+                    # The index already knows where every hour begins
+                    (boundary, hour) = index_hour_boundary(index, offset)
+                else:
+                    (boundary, hour) = find_hour_boundary(f, offset, lookback_bytes, valid_hours)
+                # Skip to the next hour transition until an aligned one is found
+                if(boundary is None or hour % align_seconds == 0):
+                    break
+                offset = boundary + 1
+            # Small files, or very large hours, may give the same boundary twice.  If no boundary was found
+            # after this offset, later offsets are still tried
+            if(boundary is not None and boundary > boundaries[-1][0]):
+                boundaries.append((boundary, hour))
+
+    if(len(boundaries) < num_shards):
+        logMsg("WARNING: %s was split into %d shards instead of %d" % (filename, len(boundaries), num_shards))
+    ends = [start for (start, hour) in boundaries[1:]] + [None]
+    return [(start, end, hour) for ((start, hour), end) in zip(boundaries, ends)]
+
+
+
+# Gives the name of the hour index for a trip_data file
+def hour_index_filename(filename):
+    return os.path.splitext(strip_compression(filename))[0] + ".hours.npy"
+
+
+# Builds an index of the hours in a trip_data file.  Since the file is in chronological order, the
+# trips of any time window can then be found without scanning the whole file (see iter_trips())
+# Params:
+    # filename - the trip_data file
+    # start_time, end_time - the time range of trips that belong in this file, in seconds since tools.EPOCH.
+        # Trips outside of this range (which are in the wrong file) are not indexed
+# Returns:
+    # the index - an int64 array with one (hour, offset) row for every trip which begins a new hour.
+    # hour is in seconds since tools.EPOCH, and offset is the byte offset of the trip's line
+def build_hour_index(filename, start_time, end_time):
+    # A trip cache already has the index
+    cache = load_trip_cache(filename)
+    if(cache is not None):
+        index = cache.hour_index()
+    else:
+        valid_hours = (epochToDatetime(start_time).strftime("%Y-%m-%d %H"),
+                       epochToDatetime(end_time - 1).strftime("%Y-%m-%d %H"))
+        rows = []
+        current_hour = None
+        for (offset, lines) in read_line_blocks(filename):
+            for line in lines:
+                hour = line_pickup_hour(line)
+                if(hour is not None and valid_hours[0] <= hour <= valid_hours[1] and
+                   (current_hour is None or hour > current_hour)):
+                    try:
+                        rows.append((parse_times([hour + ":00:00"])[0], offset))
+                        current_hour = hour
+                    except ValueError:
+                        pass
+                offset += len(line)
+        index = np.array(rows, dtype=np.int64).reshape((-1, 2))
+
+    np.save(hour_index_filename(filename), index)
+    return index
+
+
+# Loads the hour index of a trip_data file, from an index file or a trip cache
+# Returns:
+    # the index (see build_hour_index()), or None if the file has not been indexed
+def load_hour_index(filename):
+    index_fn = hour_index_filename(filename)
+    if(os.path.exists(index_fn) and os.path.getmtime(index_fn) >= os.path.getmtime(filename)):
+        return np.load(index_fn)
+
+    cache = load_trip_cache(filename)
+    if(cache is not None):
+        return cache.hour_index()
+    return None
+
+
+# Finds the first hour transition at or after a byte offset - see find_hour_boundary()
+# Params:
+    # index - an hour index (see build_hour_index())
+    # offset - a byte offset of the trip_data file
+def index_hour_boundary(index, offset):
+    # The first hour of the file is not a boundary between two shards
+    i = max(np.searchsorted(index[:,1], offset), 1)
+    if(i >= len(index)):
+        return (None, None)
+    return (int(index[i,1]), int(index[i,0]))
+
+
+# Reads the trips in a time window, from the trip_data files of every month that overlaps it
+# If the files have hour indexes (or trip caches), only the part of each file around the window is read
+# Params:
+    # start, end - datetimes.  Trips with start <= pickup_time < end are returned
+    # chunk_bytes - see read_trip_chunks()
+    # codebook - an IdCodebook, shared by all files (see read_trip_chunks())
+# Yields:
+    # TripChunks, in chronological order
+def iter_trips(start, end, chunk_bytes=DEFAULT_CHUNK_BYTES, codebook=None):
+    if(codebook is None):
+        codebook = IdCodebook()
+    start_time = datetimeToEpoch(start)
+    end_time = datetimeToEpoch(end)
+
+    (year, month) = (start.year, start.month)
+    while(datetime(year, month, 1) < end):
+        filename = trip_filename(year, month)
+        (first_byte, last_byte) = (0, None)
+
+        index = load_hour_index(filename)
+        if(index is not None):
+            # Begin at the start of the first hour, and read one extra hour at the end
+            # so trips which are slightly out of order are not missed
+            i = np.searchsorted(index[:,0], start_time // 3600 * 3600, side='right') - 1
+            if(i > 0):
+                first_byte = int(index[i,1])
+            j = np.searchsorted(index[:,0], end_time + 3600, side='left')
+            if(j < len(index)):
+                last_byte = int(index[j,1])
+
+        for chunk in read_trip_chunks(filename, chunk_bytes, codebook, first_byte, last_byte):
+            in_window = (chunk.pickup_time >= start_time) & (chunk.pickup_time < end_time)
+            if(in_window.any()):
+                yield chunk.subset(in_window)
+
+        (year, month) = (year + month/12, month%12 + 1)
+
+
+
+# Builds a TripChunk from a list of Trip objects (e.g. for code that still produces
+# one Trip at a time)
+# Params:
+    # trips - a list of Trip objects
+    # codebook - an IdCodebook which is used to encode medallions and hack_licenses
+# Returns:
+    # a TripChunk with one row for each Trip, in the same order
+def trips_to_chunk(trips, codebook):
+    chunk = columns_to_chunk(zip(*[trip.csvLine for trip in trips]), codebook)
+    chunk.has_other_error = np.array([trip.has_other_error for trip in trips], dtype=bool)
+    return chunk
+
+
+
+# A trip cache stores the parsed trips of one trip_data file as binary columns, so they can be
+# memory-mapped instead of parsed again.  The file begins with CACHE_MAGIC, the length of the
+# header, and a JSON header which gives the dtype, offset, and length of each column
+CACHE_MAGIC = "TRIPCACHE1\n"
+CACHE_ALIGNMENT = 64
+
+# The trip columns, in the order of the TripChunk constructor
+CACHE_TRIP_COLUMNS = [("fromLon", "<f4"), ("fromLat", "<f4"), ("toLon", "<f4"), ("toLat", "<f4"),
+                      ("dist", "<f4"), ("pickup_time", "<i8"), ("dropoff_time", "<i8"),
+                      ("medallion", "<i4"), ("driver_id", "<i4")]
+
+# Other columns:
+    # keys, hashes - the strings and hashes of the IdCodebook that encoded medallion and driver_id
+    # transition_rows, transition_offsets, transition_hours - the row, CSV byte offset, and pickup hour
+        # (in seconds since tools.EPOCH) of every trip which begins a new hour.  These allow
+        # byte ranges of the CSV file (see plan_shards()) to be found in the cache
+
+# Approximate size of a line of a trip_data file, used to choose the number of rows in a chunk
+CSV_BYTES_PER_ROW = 160
+
+
+# Gives the name of the trip cache for a trip_data file
+def trip_cache_filename(filename):
+    return os.path.splitext(strip_compression(filename))[0] + ".trips"
+
+
+# Parses a trip_data file, and writes its trips to a trip cache.  This only needs to be done once -
+# afterwards, read_trip_chunks() and plan_shards() use the cache automatically
+# Coordinates and distances are stored as float32, so they may differ from the CSV values in the 7th digit
+# Params:
+    # filename - the trip_data file
+    # start_time, end_time - the time range of trips that belong in this file, in seconds since tools.EPOCH.
+        # Only these trips can begin a new hour (see plan_shards())
+    # chunk_bytes - the size of each block of the file which is parsed at once
+# Returns:
+    # the name of the trip cache
+def build_trip_cache(filename, start_time, end_time, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    cache_fn = trip_cache_filename(filename)
+    tmp_names = dict([(name, cache_fn + "." + name + ".tmp") for (name, dtype) in CACHE_TRIP_COLUMNS])
+    tmp_files = dict([(name, open(tmp_names[name], "wb")) for (name, dtype) in CACHE_TRIP_COLUMNS])
+
+    codebook = IdCodebook()
+    num_rows = 0
+    last_hour = None
+    transitions = []
+    for (offset, lines) in read_line_blocks(filename, chunk_bytes):
+        (chunk, line_numbers) = parse_trip_lines_numbered(lines, codebook)
+        if(chunk is None):
+            continue
+
+        for (name, dtype) in CACHE_TRIP_COLUMNS:
+            getattr(chunk, name).astype(dtype).tofile(tmp_files[name])
+
+        # Find the trips which begin a new hour (ignoring trips in the wrong file), and their CSV offsets
+        hours = chunk.pickup_time // 3600 * 3600
+        hours = np.where((chunk.pickup_time >= start_time) & (chunk.pickup_time < end_time), hours, -1)
+        running_max = np.maximum.accumulate(np.concatenate([[-1 if last_hour is None else last_hour], hours]))
+        new_hours = np.flatnonzero(hours > running_max[:-1])
+        if(len(new_hours) > 0):
+            line_offsets = offset + np.concatenate([[0], np.cumsum([len(line) for line in lines])])
+            for i in new_hours.tolist():
+                transitions.append((num_rows + i, line_offsets[line_numbers[i]], hours[i]))
+        last_hour = running_max[-1]
+        num_rows += len(chunk)
+
+    for f in tmp_files.values():
+        f.close()
+
+    transitions = np.array(transitions, dtype=np.int64).reshape((-1, 3))
+    tables = [("keys", np.array(codebook.keys, dtype=str)), ("hashes", codebook.hashes.astype("<u8")),
+              ("transition_rows", transitions[:,0]), ("transition_offsets", transitions[:,1]),
+              ("transition_hours", transitions[:,2])]
+
+    # Lay out the columns one after another, each aligned to CACHE_ALIGNMENT bytes
+    columns = {}
+    sources = []
+    position = 0
+    for (name, dtype) in CACHE_TRIP_COLUMNS:
+        columns[name] = (dtype, position, num_rows)
+        sources.append((position, tmp_names[name], None))
+        position = (position + num_rows * np.dtype(dtype).itemsize + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+    for (name, values) in tables:
+        columns[name] = (values.dtype.str, position, len(values))
+        sources.append((position, None, values))
+        position = (position + values.nbytes + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+    header = json.dumps({"columns":columns, "num_rows":num_rows, "csv_size":os.path.getsize(filename)})
+    data_start = (len(CACHE_MAGIC) + 8 + len(header) + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+    # Write to a temporary file first, so a partial cache is never used
+    with open(cache_fn + ".tmp", "wb") as f:
+        f.write(CACHE_MAGIC)
+        np.array([len(header)], dtype="<u8").tofile(f)
+        f.write(header)
+        for (column_start, tmp_name, values) in sources:
+            f.seek(data_start + column_start)
+            if(tmp_name is not None):
+                with open(tmp_name, "rb") as tmp_file:
+                    shutil.copyfileobj(tmp_file, f)
+            else:
+                values.tofile(f)
+    os.rename(cache_fn + ".tmp", cache_fn)
+
+    for tmp_name in tmp_names.values():
+        os.remove(tmp_name)
+    return cache_fn
+
+
+# Opens the trip cache of a trip_data file, if it has one that is up to date
+# Returns:
+    # a TripCache, or None if there is no usable cache
+def load_trip_cache(filename):
+    cache_fn = trip_cache_filename(filename)
+    if(not os.path.exists(cache_fn) or os.path.getmtime(cache_fn) < os.path.getmtime(filename)):
+        return None
+
+    cache = TripCache(cache_fn)
+    if(cache.header["csv_size"] != os.path.getsize(filename)):
+        return None
+    return cache
+
+
+# A memory-mapped trip cache (see build_trip_cache())
+class TripCache:
+    def __init__(self, cache_fn):
+        with open(cache_fn, "rb") as f:
+            if(f.read(len(CACHE_MAGIC)) != CACHE_MAGIC):
+                raise ValueError("Not a trip cache: " + cache_fn)
+            header_length = int(np.fromfile(f, dtype="<u8", count=1)[0])
+            self.header = json.loads(f.read(header_length))
+        data_start = (len(CACHE_MAGIC) + 8 + header_length + CACHE_ALIGNMENT - 1) // CACHE_ALIGNMENT * CACHE_ALIGNMENT
+
+        self.columns = {}
+        for (name, (dtype, offset, length)) in self.header["columns"].items():
+            if(length==0):
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(cache_fn, dtype=dtype, mode="r", offset=data_start + offset, shape=(length,))
+
+    def __len__(self):
+        return self.header["num_rows"]
+
+    # Finds the rows of the cache that correspond to a byte range of the CSV file
+    # Params:
+        # start, end - a byte range from plan_shards() (end may be None for the end of the file)
+    # Returns:
+        # a (first_row, last_row) pair, or None if the range does not begin and end at hour transitions
+    def row_range(self, start, end):
+        offsets = self.columns["transition_offsets"]
+        rows = self.columns["transition_rows"]
+        bounds = []
+        for (offset, default) in [(start, 0), (end, len(self))]:
+            if(offset is None or (offset==0 and default==0)):
+                bounds.append(default)
+                continue
+            i = np.searchsorted(offsets, offset)
+            if(i==len(offsets) or offsets[i] != offset):
+                return None
+            bounds.append(int(rows[i]))
+        return tuple(bounds)
+
+    # Returns:
+        # an hour index of the CSV file (see build_hour_index())
+    def hour_index(self):
+        return np.column_stack([self.columns["transition_hours"], self.columns["transition_offsets"]])
+
+    # Reads rows of the cache as TripChunks
+    # Params:
+        # codebook - an IdCodebook.  The medallions and hack_licenses are re-encoded with it
+        # first_row, last_row - the range of rows to read
+        # chunk_rows - the number of rows in each chunk
+    # Yields:
+        # TripChunks, in order
+    def read_chunks(self, codebook, first_row, last_row, chunk_rows):
+        # Translate the cache's codes into the codebook's codes
+        recode = codebook.encode(np.array(self.columns["keys"]))
+        hashes = codebook.hashes
+
+        for start in xrange(first_row, last_row, max(chunk_rows, 1)):
+            end = min(start + chunk_rows, last_row)
+            columns = [self.columns[name][start:end] for (name, dtype) in CACHE_TRIP_COLUMNS]
+            [fromLon, fromLat, toLon, toLat, dist] = [c.astype(float) for c in columns[:5]]
+            [pickup_time, dropoff_time] = [np.array(c, dtype=np.int64) for c in columns[5:7]]
+            medallion = recode[columns[7]]
+            driver_id = recode[columns[8]]
+            yield TripChunk(fromLon, fromLat, toLon, toLat, dist, pickup_time, dropoff_time,
+                            medallion, driver_id, driver_hash=hashes[driver_id])
+
+
+
+# Builds the trip cache and hour index of every month, so later runs don't need to parse the CSV files
+if(__name__=="__main__"):
+    for year in [2010, 2011, 2012, 2013]:
+        for month in range(1, 13):
+            filename = trip_filename(year, month)
+            logMsg("Building trip cache for " + filename)
+            month_start = datetimeToEpoch(datetime(year, month, 1))
+            month_end = datetimeToEpoch(datetime(year + month/12, month%12 + 1, 1))
+            build_trip_cache(filename, month_start, month_end)
+            build_hour_index(filename, month_start, month_end)
@@ -13,7 +13,7 @@ from numpy import  square
 from numpy import column_stack, arange
 import numpy as np
 
-from data_preprocessing import remove_bad_dimensions_grouped
+from data_preprocessing import remove_bad_dimensions_grouped, stack_vectors
 from op_modified import opursuit, multiple_op, obj_func
 
 
@@ -102,7 +102,7 @@ def guess_param(current_val, lo_bound, hi_bound, SEARCH_RATE=5, BACKTRACK_PROB=.
 # in such a way that the number of outliers in the C matrix and the rank of the L
 # matrix meet some target values
 # Params:
-    # vectors - The data to perform RPCA on, a list of Numpy column vectors
+    # vectors - The data to perform RPCA on, a list of Numpy column vectors (or a matrix, see stack_vectors())
     # gamma_guess - an intial guess for gamma
     # tol_guess - an initial guess for the tolerance
     # lo_target_c_perc - lower bound for the desired percentage of outliers
@@ -119,7 +119,7 @@ def tune_gamma_and_tol(vectors, gamma_guess=.5, tol_guess=1e-2,
     num_resets = 0
 
     
-    data_matrix = column_stack(vectors)
+    data_matrix = stack_vectors(vectors)
     O = (data_matrix!=0)*1 # Observation matrix - 1 where we have data, 0 where we do not
 
     #Initially, we don't have any bounds on our search
@@ -222,7 +222,7 @@ def tune_gamma_and_tol(vectors, gamma_guess=.5, tol_guess=1e-2,
 # 5% and 10%, and that the rank of the data is between 10 and 15.  The rank bounds
 # are increased if lower values fail
 # Params:
-    # vectors - the data to perform RPCA on. A list of Numpy column vectors
+    # vectors - the data to perform RPCA on. A list of Numpy column vectors (or a matrix, see stack_vectors())
 def increasing_tolerance_search(vectors):
     
     hi_num_pcs = 15